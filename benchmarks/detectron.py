@@ -0,0 +1,115 @@
+"""
+Accuracy and latency report of the CPU optimizations of the Detectron, run on the fixed image set of the tests
+(`tests/test_images/test_detectron`, pulled with Git LFS). The expected detections of the tests are used as reference:
+a detection is correct if it has the same class and its IoU with a reference box is at least 0.5. Run from the
+project root:
+
+    python benchmarks/detectron.py
+
+"""
+
+import sys
+import time
+import statistics
+from pathlib import Path
+
+import cv2
+
+root = Path(__file__).resolve().parents[1]
+sys.path.append(root.joinpath("src").as_posix())
+sys.path.append(root.joinpath("tests").as_posix())
+
+from mock_data import exp_val_detectron  # noqa: E402
+from locator.detectron import Detectron  # noqa: E402
+
+SETTINGS = {
+    "baseline": {},
+    "rpn 300": {"rpn_pre_nms_topk": 500, "rpn_post_nms_topk": 300},
+    "min size 600": {"min_size": 600, "max_size": 1000},
+    "min size 480": {"min_size": 480, "max_size": 800},
+    "quantized": {"quantize": True},
+    "traced": {"engine": "traced"},
+    "combined": {"min_size": 600, "max_size": 1000, "rpn_pre_nms_topk": 500, "rpn_post_nms_topk": 300, "quantize": True, "engine": "traced"}
+}
+
+
+def iou(a, b):
+    width = min(a["x2"], b["x2"]) - max(a["x1"], b["x1"])
+    height = min(a["y2"], b["y2"]) - max(a["y1"], b["y1"])
+    if width <= 0 or height <= 0:
+        return 0
+
+    intersection = width * height
+    area_a = (a["x2"] - a["x1"]) * (a["y2"] - a["y1"])
+    area_b = (b["x2"] - b["x1"]) * (b["y2"] - b["y1"])
+
+    return intersection / (area_a + area_b - intersection)
+
+
+def match(expected, predicted, min_iou=0.5):
+    """ Greedily matches the predicted boxes to the expected ones, returns the number of matches and their IoUs. """
+
+    unmatched = list(expected)
+    ious = []
+    for prediction in predicted:
+        candidates = [(iou(reference, prediction), idx) for idx, reference in enumerate(unmatched) if reference["class"] == prediction["class"]]
+        if candidates:
+            best_iou, best_idx = max(candidates)
+            if best_iou >= min_iou:
+                ious.append(best_iou)
+                unmatched.pop(best_idx)
+
+    return ious
+
+
+def evaluate(detectron, images, repeats):
+    latencies = []
+    n_expected, n_predicted, ious = 0, 0, []
+    for image_name, img, expected in images:
+        durations = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            predicted = detectron.predict("benchmark", image_name, img)
+            durations.append(time.perf_counter() - start)
+        latencies.append(min(durations))
+
+        n_expected += len(expected)
+        n_predicted += len(predicted)
+        ious += match(expected, predicted)
+
+    precision = len(ious) / n_predicted if n_predicted else 0
+    recall = len(ious) / n_expected if n_expected else 0
+    mean_iou = statistics.mean(ious) if ious else 0
+
+    return statistics.median(latencies), precision, recall, mean_iou
+
+
+if __name__ == "__main__":
+    images = []
+    for image_name, expected in exp_val_detectron:
+        img = cv2.imread(root.joinpath("tests", "test_images", "test_detectron", image_name).as_posix())
+        if img is None:
+            sys.exit(f"Could not read {image_name}, make sure the Git LFS files are pulled.")
+        images.append((image_name, img, expected))
+    height, width = images[0][1].shape[:2]
+
+    print(f"Detecting objects on {len(images)} images of {width}x{height}")
+    print(f"{'setting':>14} {'engine':>8} {'latency (s)':>12} {'speedup':>8} {'precision':>10} {'recall':>8} {'mean IoU':>9}")
+
+    baseline_latency = None
+    for name, options in SETTINGS.items():
+        detectron = Detectron(
+            base_img_path=root.joinpath("images").as_posix(),
+            model_config="COCO-Detection/faster_rcnn_R_50_FPN_3x.yaml",
+            threshold=0.5,
+            image_dims=(height, width),
+            **options
+        )
+        detectron.warm_up(height, width)
+
+        latency, precision, recall, mean_iou = evaluate(detectron, images, repeats=3)
+        baseline_latency = baseline_latency or latency
+        print(
+            f"{name:>14} {detectron.engine:>8} {latency:>12.3f} {baseline_latency / latency:>7.2f}x "
+            f"{precision:>10.2f} {recall:>8.2f} {mean_iou:>9.3f}"
+        )
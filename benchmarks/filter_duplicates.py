@@ -0,0 +1,41 @@
+"""
+Benchmark of duplicate filtering, comparing the grid based `filter_duplicates` with the original pairwise implementation
+on sessions with thousands of detections. Run from the project root:
+
+    python benchmarks/filter_duplicates.py
+
+"""
+
+import sys
+import copy
+import time
+from pathlib import Path
+
+root = Path(__file__).resolve().parents[1]
+sys.path.append(root.joinpath("src").as_posix())
+sys.path.append(root.joinpath("tests").as_posix())
+
+import legacy_coord_conversion  # noqa: E402
+from utils.coord_conversion import filter_duplicates  # noqa: E402
+from test_coord_conversion import generate_objects  # noqa: E402
+
+
+def measure(func, objects, repeats):
+    durations = []
+    for _ in range(repeats):
+        objects_copy = copy.deepcopy(objects)
+        start = time.perf_counter()
+        func(objects_copy)
+        durations.append(time.perf_counter() - start)
+
+    return min(durations)
+
+
+if __name__ == "__main__":
+    print(f"{'detections':>10} {'legacy (s)':>12} {'grid (s)':>12} {'speedup':>10}")
+    for n_objects in (250, 500, 1000, 2000):
+        # Each object shows up on 3 images on average
+        objects = generate_objects(n_objects, 3, 100, seed=n_objects)
+        legacy = measure(legacy_coord_conversion.filter_duplicates, objects, repeats=1)
+        grid = measure(filter_duplicates, objects, repeats=3)
+        print(f"{len(objects):>10} {legacy:>12.4f} {grid:>12.4f} {legacy / grid:>9.1f}x")
@@ -0,0 +1,491 @@
+"""
+Load test of the WebSocket server, which simulates Raspberry Pis speaking the protocol of `src/server.py`. In each
+session, a simulated arm sends its images with `recv_img_proc` while rotating, requests the commands with
+`get_commands_of_session`, waits while executing them, sends the after images with `recv_img_after`, then requests
+the stitching of the after images with `stitch_after_image`. Throughput, latency percentiles and error rates are
+reported for each command. The images are read from `--images`, or synthetic frames are generated if those are not
+available (eg. Git LFS files are not pulled).
+
+With `--serve`, the server is started in a subprocess with `MODE=loadtest`, which replaces Postgres and S3 with the
+in-memory stand-ins of `utils.stand_ins`, so no network access is needed. The models are still loaded, so the weights
+have to be available, and the dispatcher has to use threads (the stand-ins are not shared between processes).
+Run from the project root:
+
+    python benchmarks/load_test.py --serve --arms 4 --sessions 2
+
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import subprocess
+import urllib.error
+import urllib.request
+from pathlib import Path
+from collections import Counter, defaultdict, deque
+
+import cv2
+import numpy as np
+import websockets
+
+root = Path(__file__).resolve().parents[1]
+sys.path.append(root.joinpath("src").as_posix())
+
+from utils import framing  # noqa: E402
+from stitching import generate_images  # noqa: E402
+
+# Result of the requests whose connection was closed before the reply arrived
+CLOSED = object()
+
+COMMANDS = ("recv_img_proc", "get_commands_of_session", "recv_img_after", "stitch_after_image")
+
+ARM_CONSTANTS = {
+    "arm_radius": 1500,
+    "dist_max_as_pw": 2050,
+    "dist_min_as_pw": 1150,
+    "rotation_range_as_deg": 130,
+    "rotation_range_as_pw": 1400
+}
+
+
+def load_images(images_path):
+    images = {}
+    for img_path in sorted(Path(images_path).glob("*.jpg")):
+        img_bytes = img_path.read_bytes()
+        # Git LFS pointers are text files
+        if not img_bytes.startswith(b"\xff\xd8"):
+            return None
+        images[img_path.name] = img_bytes
+
+    return images or None
+
+
+def generate_jpegs(n_images):
+    return {image_name: cv2.imencode(".jpg", img)[1].tobytes() for image_name, img in generate_images(n_images).items()}
+
+
+def split_frames(headers, payload, chunk_size):
+    """
+    Frames an image, in chunks if it's larger than `chunk_size`, see `ChunkAssembler`.
+
+    """
+
+    if len(payload) <= chunk_size:
+        return [framing.encode(headers, payload)]
+
+    return [
+        framing.encode(dict(headers, total_size=len(payload), offset=offset), payload[offset:offset + chunk_size])
+        for offset in range(0, len(payload), chunk_size)
+    ]
+
+
+def is_success(command, reply):
+    if command == "get_commands_of_session":
+        return isinstance(reply, list)
+    if command == "stitch_after_image":
+        return isinstance(reply, dict)
+
+    return reply is True
+
+
+class LoadStats:
+    """
+    Latencies and errors of the requests sent by the simulated arms.
+
+    """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(Counter)
+        self.sessions = Counter()
+        self.bytes_sent = 0
+
+    def record(self, command, latency, error=None):
+        """
+        Records a request.
+
+        Parameters
+        ----------
+        command : str
+            Command of the request.
+        latency : float
+            Time in seconds from sending the request until its reply arrived.
+        error : str, optional
+            Kind of the error, like `failed`, `timeout` or `closed`. The latency of failed requests is not recorded.
+
+        """
+
+        if error:
+            self.errors[command][error] += 1
+        else:
+            self.latencies[command].append(latency)
+
+    def report(self, duration):
+        """
+        Summarizes the load test.
+
+        Parameters
+        ----------
+        duration : float
+            Duration of the load test in seconds.
+
+        Returns
+        -------
+        report : dict
+            Dict containing the `duration`, the number of `sessions` by outcome, the throughput of the processed images
+            and uploaded bytes, and for each command the number of requests, errors, error rate and latency percentiles.
+
+        """
+
+        commands = {}
+        for command in [command for command in COMMANDS if command in self.latencies or command in self.errors]:
+            latencies = np.array(self.latencies[command])
+            errors = sum(self.errors[command].values())
+            count = len(latencies) + errors
+            commands[command] = {
+                "count": count,
+                "errors": dict(self.errors[command]),
+                "error_rate": errors / count,
+                "throughput": len(latencies) / duration,
+                **{
+                    f"p{percentile}": float(np.percentile(latencies, percentile)) if len(latencies) else None
+                    for percentile in (50, 90, 99)
+                },
+                "max": float(latencies.max()) if len(latencies) else None
+            }
+
+        return {
+            "duration": duration,
+            "sessions": dict(self.sessions),
+            "images_per_second": len(self.latencies["recv_img_proc"]) / duration,
+            "megabytes_per_second": self.bytes_sent / 2 ** 20 / duration,
+            "commands": commands
+        }
+
+
+class Connection:
+    """
+    Connection of a simulated arm. Replies of recv_img_proc messages with a request id are matched by the id, every
+    other reply is matched to the requests in the order they were sent.
+
+    Parameters
+    ----------
+    websocket : WebSocketClientProtocol
+        The open connection.
+
+    """
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self.replies = deque()
+        self.acks = {}
+        self.reader = asyncio.ensure_future(self.read())
+
+    async def read(self):
+        try:
+            async for message in self.websocket:
+                reply = json.loads(message)
+                if isinstance(reply, dict) and reply.get("request_id") in self.acks:
+                    future, result = self.acks.pop(reply["request_id"]), reply["success"]
+                elif self.replies:
+                    future, result = self.replies.popleft(), reply
+                else:
+                    print("Unexpected reply:", reply)
+                    continue
+                # Requests which timed out keep their place in the order, their late reply is dropped
+                if not future.done():
+                    future.set_result(result)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for future in list(self.replies) + list(self.acks.values()):
+                if not future.done():
+                    future.set_result(CLOSED)
+
+    async def send(self, message, payload=None, chunk_size=2 ** 20):
+        """
+        Sends a request.
+
+        Parameters
+        ----------
+        message : dict
+            The JSON message, or the headers if a payload is sent.
+        payload : bytes, optional
+            Image sent with the headers in binary messages.
+        chunk_size : int, optional
+            Images larger than this are sent in chunks.
+
+        Returns
+        -------
+        reply : asyncio.Future
+            Future of the reply.
+
+        """
+
+        reply = asyncio.get_event_loop().create_future()
+        if "request_id" in message:
+            self.acks[message["request_id"]] = reply
+        else:
+            self.replies.append(reply)
+
+        if payload is None:
+            await self.websocket.send(json.dumps(message))
+        else:
+            for frame in split_frames(message, payload, chunk_size):
+                await self.websocket.send(frame)
+
+        return reply
+
+    async def close(self):
+        await self.websocket.close()
+        await self.reader
+
+
+class SimulatedArm:
+    """
+    Simulates the sessions of a Raspberry Pi controlling an arm.
+
+    Parameters
+    ----------
+    url : str
+        URL of the WebSocket server.
+    arm_id : str
+        Unique identifier of the simulated arm.
+    images : dict
+        Bytes of the JPEG images by image name, sent in each session both before and after executing the commands.
+    stats : LoadStats
+        Records the requests.
+    pipelined : bool, optional
+        If True, images are sent with request ids without waiting for the previous one to be processed.
+    interval : float, optional
+        Time in seconds between taking two images, while the arm rotates.
+    command_time : float, optional
+        Time in seconds the arm takes to execute a command.
+    jitter : float, optional
+        Pauses are randomly changed by up to this fraction, so the arms don't run in lockstep.
+    timeout : float, optional
+        Requests without a reply after this many seconds are counted as errors.
+    chunk_size : int, optional
+        Images larger than this are sent in chunks.
+
+    """
+
+    def __init__(self, url, arm_id, images, stats, pipelined=False, interval=0.5, command_time=1., jitter=0.2, timeout=120., chunk_size=2 ** 20):
+        self.url = url
+        self.arm_id = arm_id
+        self.images = images
+        self.stats = stats
+        self.pipelined = pipelined
+        self.interval = interval
+        self.command_time = command_time
+        self.jitter = jitter
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+
+    async def pause(self, seconds):
+        await asyncio.sleep(seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+    async def run(self, sessions, start_delay=0.):
+        """
+        Runs the sessions of the arm one after the other, each on a new connection.
+
+        Parameters
+        ----------
+        sessions : int
+            Number of sessions.
+        start_delay : float, optional
+            Time in seconds to wait before the first session, to ramp up the load.
+
+        """
+
+        await asyncio.sleep(start_delay)
+        for idx in range(sessions):
+            session_id = f"{time.strftime('%Y-%m-%d_%H-%M-%S')}_{self.arm_id}_{idx}"
+            try:
+                websocket = await websockets.connect(self.url, max_size=2 ** 22)
+            except (OSError, websockets.WebSocketException) as error:
+                print(f"Arm '{self.arm_id}' could not connect: {error!r}")
+                self.stats.sessions["connection_failed"] += 1
+                continue
+
+            connection = Connection(websocket)
+            try:
+                completed = await self.run_session(connection, session_id)
+                self.stats.sessions["completed" if completed else "failed"] += 1
+            except websockets.ConnectionClosed:
+                self.stats.sessions["closed"] += 1
+            finally:
+                await connection.close()
+
+    async def send(self, connection, message, payload=None):
+        start = time.perf_counter()
+        reply = await connection.send(message, payload, self.chunk_size)
+        self.stats.bytes_sent += len(payload) if payload is not None else 0
+
+        return start, reply
+
+    async def wait(self, command, start, reply):
+        try:
+            result = await asyncio.wait_for(asyncio.shield(reply), self.timeout)
+        except asyncio.TimeoutError:
+            self.stats.record(command, None, "timeout")
+            return False, None
+
+        if result is CLOSED:
+            self.stats.record(command, None, "closed")
+            return False, None
+
+        success = is_success(command, result)
+        self.stats.record(command, time.perf_counter() - start, None if success else "failed")
+        return success, result
+
+    async def call(self, connection, message, payload=None):
+        return await self.wait(message["command"], *await self.send(connection, message, payload))
+
+    async def run_session(self, connection, session_id):
+        """
+        Runs a session on an open connection.
+
+        Parameters
+        ----------
+        connection : Connection
+            Connection to the server.
+        session_id : str
+            Unique identifier of the session.
+
+        Returns
+        -------
+        completed : bool
+            True if every request of the session succeeded.
+
+        """
+
+        results = []
+
+        # Take the images while rotating, in pipelined mode the replies are awaited at the end
+        pending = []
+        for image_name, img_bytes in self.images.items():
+            headers = {"command": "recv_img_proc", "arm_id": self.arm_id, "session_id": session_id, "image_name": image_name}
+            if self.pipelined:
+                headers["request_id"] = f"{session_id}/{image_name}"
+                pending.append(asyncio.ensure_future(self.wait("recv_img_proc", *await self.send(connection, headers, img_bytes))))
+            else:
+                results.append(await self.call(connection, headers, img_bytes))
+            await self.pause(self.interval)
+        results += await asyncio.gather(*pending)
+
+        success, commands = await self.call(connection, {
+            "command": "get_commands_of_session",
+            "arm_constants": dict(ARM_CONSTANTS, arm_id=self.arm_id),
+            "session_id": session_id
+        })
+        results.append((success, commands))
+
+        # Execute the commands, then take the after images while rotating back
+        await self.pause(self.command_time * len(commands or []))
+        for image_name, img_bytes in self.images.items():
+            headers = {"command": "recv_img_after", "arm_id": self.arm_id, "session_id": session_id, "image_name": image_name}
+            results.append(await self.call(connection, headers, img_bytes))
+            await self.pause(self.interval)
+
+        results.append(await self.call(connection, {"command": "stitch_after_image", "arm_id": self.arm_id, "session_id": session_id}))
+
+        return all(success for success, _ in results)
+
+
+def wait_until_ready(health_url, server, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise Exception(f"Server exited with code {server.returncode} during startup.")
+        try:
+            with urllib.request.urlopen(health_url, timeout=5) as response:
+                if response.status == 200:
+                    return
+        except (OSError, urllib.error.URLError):
+            pass
+        time.sleep(1)
+
+    raise Exception(f"Server was not ready after {timeout} seconds.")
+
+
+async def run_load_test(args, images):
+    stats = LoadStats()
+    arms = [
+        SimulatedArm(
+            url=args.url,
+            arm_id=f"loadtest_arm_{idx}",
+            images=images,
+            stats=stats,
+            pipelined=args.pipelined,
+            interval=args.interval,
+            command_time=args.command_time,
+            jitter=args.jitter,
+            timeout=args.timeout,
+            chunk_size=args.chunk_size
+        ) for idx in range(args.arms)
+    ]
+
+    start = time.perf_counter()
+    await asyncio.gather(*[arm.run(args.sessions, start_delay=args.ramp_up * idx / args.arms) for idx, arm in enumerate(arms)])
+
+    return stats.report(time.perf_counter() - start)
+
+
+def print_report(report, n_images):
+    def seconds(value):
+        return f"{value:.3f}" if value is not None else "-"
+
+    print(f"Sessions: {report['sessions']} in {report['duration']:.1f} s, {n_images} images per session")
+    print(f"Throughput: {report['images_per_second']:.2f} images/s, {report['megabytes_per_second']:.2f} MB/s uploaded")
+    print(f"{'command':>24} {'count':>6} {'req/s':>7} {'error rate':>10} {'p50 (s)':>8} {'p90 (s)':>8} {'p99 (s)':>8} {'max (s)':>8}  errors")
+    for command, row in report["commands"].items():
+        print(
+            f"{command:>24} {row['count']:>6} {row['throughput']:>7.2f} {row['error_rate']:>10.1%} {seconds(row['p50']):>8} "
+            f"{seconds(row['p90']):>8} {seconds(row['p99']):>8} {seconds(row['max']):>8}  {row['errors'] or ''}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load test of the WebSocket server with simulated arms.")
+    parser.add_argument("--url", default="ws://localhost:6000", help="URL of the WebSocket server.")
+    parser.add_argument("--serve", action="store_true", help="Start the server with in-memory Postgres and S3 stand-ins.")
+    parser.add_argument("--startup-timeout", type=float, default=600, help="Seconds to wait for the started server to load the models.")
+    parser.add_argument("--arms", type=int, default=4, help="Number of simulated arms.")
+    parser.add_argument("--sessions", type=int, default=1, help="Number of sessions of each arm.")
+    parser.add_argument("--images", default=root.joinpath("tests", "test_images", "test_main").as_posix(), help="Folder of the JPEG images of a session.")
+    parser.add_argument("--synthetic-images", type=int, default=8, help="Number of generated images if the image folder is not available.")
+    parser.add_argument("--pipelined", action="store_true", help="Send the images with request ids without waiting for the replies.")
+    parser.add_argument("--interval", type=float, default=0.5, help="Seconds between images, while the arm rotates.")
+    parser.add_argument("--command-time", type=float, default=1., help="Seconds to execute a command.")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Random variation of the pauses, as a fraction.")
+    parser.add_argument("--ramp-up", type=float, default=5., help="Seconds until every arm started its first session.")
+    parser.add_argument("--timeout", type=float, default=120., help="Seconds to wait for a reply.")
+    parser.add_argument("--chunk-size", type=int, default=2 ** 20, help="Images larger than this many bytes are sent in chunks.")
+    parser.add_argument("--output", help="Path of a JSON file the report is written to.")
+    args = parser.parse_args()
+
+    images = load_images(args.images)
+    if images is None:
+        print(f"Images in '{args.images}' are not available, using {args.synthetic_images} synthetic images.")
+        images = generate_jpegs(args.synthetic_images)
+
+    server = None
+    if args.serve:
+        server = subprocess.Popen([sys.executable, root.joinpath("src", "server.py").as_posix()], cwd=root.as_posix(), env=dict(os.environ, MODE="loadtest"))
+        wait_until_ready(args.url.replace("ws://", "http://", 1).rstrip("/") + "/health", server, args.startup_timeout)
+
+    try:
+        report = asyncio.get_event_loop().run_until_complete(run_load_test(args, images))
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+    print_report(report, len(images))
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=4))
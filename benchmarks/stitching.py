@@ -0,0 +1,123 @@
+"""
+Benchmark of panorama stitching, comparing the previous full OpenCV pipeline (registration at 0.6 and seam estimation at
+0.1 megapixels) with downscaled registration settings and the incremental composition. Seam quality is measured as the
+PSNR of each panorama against the previous path's output, resized to the same dimensions. Uses the session images in
+`tests/test_images/test_main`, or synthetic overlapping frames if those are not available (eg. Git LFS files are not
+pulled). Run from the project root:
+
+    python benchmarks/stitching.py
+
+"""
+
+import sys
+import time
+import shutil
+import tempfile
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+root = Path(__file__).resolve().parents[1]
+sys.path.append(root.joinpath("src").as_posix())
+
+from stitcher.stitcher import stitch_images  # noqa: E402
+from stitcher.incremental import IncrementalStitcher, compose_panorama  # noqa: E402
+
+SETTINGS = {
+    "previous": {"registration_resol": 0.6, "seam_resol": 0.1},
+    "downscaled 0.3": {"registration_resol": 0.3, "seam_resol": 0.05},
+    "downscaled 0.15": {"registration_resol": 0.15, "seam_resol": 0.05}
+}
+
+
+def load_test_images():
+    images = {}
+    for img_path in sorted(root.joinpath("tests", "test_images", "test_main").glob("*.jpg")):
+        img = cv2.imread(img_path.as_posix())
+        if img is None:
+            return None
+        images[img_path.name] = img
+
+    return images or None
+
+
+def generate_images(n_images=8, width=1280, height=960, step=360, seed=0):
+    rng = np.random.default_rng(seed)
+    scene = np.full((height, width + step * (n_images - 1), 3), 200, dtype=np.uint8)
+    for _ in range(n_images * 60):
+        x, y = int(rng.integers(0, scene.shape[1])), int(rng.integers(0, height))
+        color = tuple(int(channel) for channel in rng.integers(0, 255, 3))
+        if rng.random() < 0.5:
+            cv2.circle(scene, (x, y), int(rng.integers(10, 60)), color, -1)
+        else:
+            cv2.rectangle(scene, (x, y), (x + int(rng.integers(20, 120)), y + int(rng.integers(20, 120))), color, -1)
+        cv2.putText(scene, str(int(rng.integers(0, 1000))), (x, y), cv2.FONT_HERSHEY_SIMPLEX, 1.5, (0, 0, 0), 3)
+
+    return {f"{1000 + idx * 50}.jpg": scene[:, idx * step:idx * step + width].copy() for idx in range(n_images)}
+
+
+def psnr(reference, candidate):
+    candidate = cv2.resize(candidate, (reference.shape[1], reference.shape[0]), interpolation=cv2.INTER_AREA)
+    mse = np.mean((reference.astype(np.float64) - candidate.astype(np.float64)) ** 2)
+
+    return float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+def run(base_img_path, session_id, images_with_objects, stitch, repeats):
+    durations = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = stitch()
+        durations.append(time.perf_counter() - start)
+
+    panorama = cv2.imread(result["stitched_path"]) if result["success"] else None
+    return min(durations), panorama
+
+
+if __name__ == "__main__":
+    images = load_test_images()
+    source = "tests/test_images/test_main"
+    if images is None:
+        images = generate_images()
+        source = "synthetic frames"
+
+    base_img_path = Path(tempfile.mkdtemp())
+    arm_id, session_id = "benchmark", "benchmark"
+    for directory in ("original", "bboxes_original"):
+        base_img_path.joinpath(session_id, directory).mkdir(parents=True)
+    for image_name, img in images.items():
+        cv2.imwrite(base_img_path.joinpath(session_id, "original", image_name).as_posix(), img)
+    images_with_objects = [{"image_name": image_name, "bboxes": np.zeros((0, 4), dtype=int)} for image_name in images]
+
+    print(f"Stitching {len(images)} images of {source}, {images[next(iter(images))].shape[1]}x{images[next(iter(images))].shape[0]} each")
+    print(f"{'mode':>16} {'time (s)':>10} {'size':>12} {'PSNR (dB)':>10}")
+
+    results = {}
+    for name, options in SETTINGS.items():
+        results[name] = run(
+            base_img_path, session_id, images_with_objects,
+            lambda: stitch_images(base_img_path.as_posix(), session_id, "original", images_with_objects, **options), repeats=2
+        )
+
+    incremental = IncrementalStitcher()
+    start = time.perf_counter()
+    for image_name, img in images.items():
+        incremental.add_image(arm_id, session_id, image_name, img)
+    registration_duration = time.perf_counter() - start
+    transforms = incremental.get_transforms(arm_id, session_id, list(images))
+    if transforms is not None:
+        results["incremental"] = run(
+            base_img_path, session_id, images_with_objects,
+            lambda: compose_panorama(base_img_path.as_posix(), session_id, "original", images_with_objects, transforms), repeats=2
+        )
+
+    reference = results["previous"][1]
+    for name, (duration, panorama) in results.items():
+        size = "failed" if panorama is None else f"{panorama.shape[1]}x{panorama.shape[0]}"
+        quality = "-" if panorama is None or reference is None else f"{psnr(reference, panorama):.2f}"
+        print(f"{name:>16} {duration:>10.3f} {size:>12} {quality:>10}")
+    if transforms is not None:
+        print(f"Incremental registration took {registration_duration:.3f} s in total while the images arrived")
+
+    shutil.rmtree(base_img_path)
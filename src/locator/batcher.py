@@ -0,0 +1,133 @@
+"""
+Micro-batching scheduler, which collects items submitted concurrently from multiple threads and processes them together.
+
+"""
+
+import time
+import queue
+import atexit
+import threading
+from concurrent.futures import Future
+
+
+class MicroBatcher:
+    """
+    Collects items submitted from different threads into batches and processes each batch with a single call.
+    A batch is closed when it reaches `max_batch_size` items or when `max_wait_ms` elapsed since its first item arrived,
+    whichever happens first. The results are handed back to the submitting threads in the original order.
+    The batcher's thread is stopped by `close`, which is also called on exit.
+
+    Parameters
+    ----------
+    run_batch : function
+        Function that takes a list of items and returns a list of results of the same length.
+    max_batch_size : int
+        Maximum number of items processed together.
+    max_wait_ms : float
+        Maximum time in milliseconds to wait for other items after the first item of a batch arrived.
+
+    """
+
+    def __init__(self, run_batch, max_batch_size, max_wait_ms):
+        self.run_batch = run_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+
+        self.queue = queue.Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self.process_batches, name="micro-batcher", daemon=True)
+        self.thread.start()
+
+        atexit.register(self.close)
+
+    def submit(self, item):
+        """
+        Adds an item to the next batch and blocks until its result is available.
+
+        Parameters
+        ----------
+        item : any
+            Item to be processed.
+
+        Returns
+        -------
+        result : any
+            Result corresponding to the submitted item. Exceptions raised while processing the batch are re-raised here.
+
+        Raises
+        ------
+        RuntimeError
+            If the batcher is closed.
+
+        """
+
+        if self.closed:
+            raise RuntimeError("The batcher is closed.")
+
+        future = Future()
+        self.queue.put((item, future))
+
+        return future.result()
+
+    def process_batches(self):
+        """
+        Loop running on the batcher's thread, which collects the submitted items and processes them in batches.
+
+        """
+
+        while True:
+            first = self.queue.get()
+            # None is used as a sentinel to stop the loop
+            if first is None:
+                return
+
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    entry = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if entry is None:
+                    # Put back sentinel, so the loop stops after processing the current batch
+                    self.queue.put(None)
+                    break
+                batch.append(entry)
+
+            items = [item for item, _ in batch]
+            try:
+                results = list(self.run_batch(items))
+                if len(results) != len(batch):
+                    raise ValueError(f"Batch of {len(batch)} items returned {len(results)} results.")
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except BaseException as error:
+                # Every submitter is answered and the loop keeps running, whatever went wrong
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(error)
+
+    def close(self):
+        """
+        Stops the batcher's thread after the already submitted items are processed. Items submitted while closing
+        are failed, so their submitters don't wait forever. Safe to call multiple times.
+
+        """
+
+        if self.closed:
+            return
+
+        self.closed = True
+        self.queue.put(None)
+        self.thread.join()
+
+        while True:
+            try:
+                entry = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if entry is not None:
+                entry[1].set_exception(RuntimeError("The batcher is closed."))
@@ -8,6 +8,7 @@ https://github.com/facebookresearch/detectron2
 
 import os
 import cv2
+import torch
 import numpy as np
 from pathlib import Path
 from detectron2 import model_zoo
@@ -15,6 +16,10 @@ from detectron2.engine import DefaultPredictor
 from detectron2.config import get_cfg
 from detectron2.utils.logger import setup_logger
 
+from locator.batcher import MicroBatcher
+from locator.optimization import TracedBackbone, model_input_example, quantize_box_head
+from utils.frame_store import attach
+
 
 class Detectron:
     """
@@ -30,13 +35,64 @@ class Detectron:
         The value should contain any subfolders and the extension as well.
     threshold : float
         Object detection threshold for Detectron2.
+    batch_size : int, optional
+        Maximum number of images, submitted concurrently from different threads, to be processed in a single
+        forward pass. Use 1 to disable batching and run each image separately.
+    max_wait_ms : float, optional
+        Maximum time in milliseconds to wait for other images to fill a batch after the first one arrived.
+    min_size : int, optional
+        Length of the shorter side of the images after resizing. Smaller inputs are faster, but small objects might
+        not be found. If None, the value of the model config is used.
+    max_size : int, optional
+        Maximum length of the longer side of the images after resizing. If None, the value of the model config is used.
+    rpn_pre_nms_topk : int, optional
+        Number of proposals kept per feature map by the RPN before non-maximum suppression. If None, the value of the
+        model config is used.
+    rpn_post_nms_topk : int, optional
+        Number of proposals passed to the box head after non-maximum suppression. Since there are only a few objects on
+        each image, much less than the default 1000 are usually enough. If None, the value of the model config is used.
+    num_threads : int, optional
+        Number of threads used by Torch for intra-op parallelism. Note that this setting is global for the process.
+        If None, Torch's default is kept.
+    quantize : bool, optional
+        If True, the fully connected layers of the box head are quantized to int8 dynamically.
+    engine : str, optional
+        `eager` runs the model as it is, `traced` runs the backbone traced with TorchScript for images of size
+        `image_dims`. Images of other sizes are processed by the eager backbone.
+    image_dims : tuple, optional
+        Height and width of the camera images, used to trace the backbone.
+    export_path : str, optional
+        If provided, the traced backbone is saved to this path.
+    min_similarity : float, optional
+        The feature maps of the traced backbone are compared with the eager backbone's results when the Detectron is
+        created. If the cosine similarity is lower than this, the eager engine is used.
 
     """
 
-    def __init__(self, base_img_path, model_config, threshold=0.7):
+    def __init__(
+            self,
+            base_img_path,
+            model_config,
+            threshold=0.7,
+            batch_size=1,
+            max_wait_ms=0,
+            min_size=None,
+            max_size=None,
+            rpn_pre_nms_topk=None,
+            rpn_post_nms_topk=None,
+            num_threads=None,
+            quantize=False,
+            engine="eager",
+            image_dims=(1232, 1640),
+            export_path=None,
+            min_similarity=0.99):
         self.base_img_path = base_img_path
         self.model_config = model_config
         self.threshold = threshold
+        self.batch_size = batch_size
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
 
         # Setup config
         self.cfg = get_cfg()
@@ -45,12 +101,45 @@ class Detectron:
         self.cfg.MODEL.DEVICE = "cpu"
         self.cfg.MODEL.ROI_HEADS.NUM_CLASSES = 2
 
+        # Override the resolution and the number of proposals of the model config
+        if min_size:
+            self.cfg.INPUT.MIN_SIZE_TEST = min_size
+        if max_size:
+            self.cfg.INPUT.MAX_SIZE_TEST = max_size
+        if rpn_pre_nms_topk:
+            self.cfg.MODEL.RPN.PRE_NMS_TOPK_TEST = rpn_pre_nms_topk
+        if rpn_post_nms_topk:
+            self.cfg.MODEL.RPN.POST_NMS_TOPK_TEST = rpn_post_nms_topk
+
         # Get pretrained weights
         self.cfg.MODEL.WEIGHTS = Path(__file__).parents[2].joinpath("weights", "model_final.pth").resolve().as_posix()
 
         # Create predictor
         self.predictor = DefaultPredictor(self.cfg)
 
+        if quantize:
+            quantize_box_head(self.predictor.model)
+
+        # Trace the backbone and use it only if its results match the original one's
+        self.engine = "eager"
+        self.similarity = None
+        if engine == "traced":
+            example = model_input_example(self.predictor.model, *image_dims, self.predictor.transform_gen)
+            traced_backbone = TracedBackbone(self.predictor.model.backbone, example)
+            self.similarity = traced_backbone.validate(example)
+            if self.similarity >= min_similarity:
+                self.predictor.model.backbone = traced_backbone
+                self.engine = engine
+                if export_path:
+                    traced_backbone.save(export_path)
+            else:
+                print(f"Cosine similarity of the traced backbone's feature maps is {self.similarity:.4f}, falling back to the eager engine.")
+        elif engine != "eager":
+            raise ValueError(f"Unknown engine: '{engine}'. Possible values: eager and traced.")
+
+        # Create scheduler to collect images arriving at the same time into batches
+        self.batcher = MicroBatcher(self.predict_batch, batch_size, max_wait_ms) if batch_size > 1 else None
+
         setup_logger()
 
     def predict(self, session_id, image_name, img):
@@ -64,8 +153,8 @@ class Detectron:
             with the POST request.
         image_name : str
             Name of the image saved in the `images/original` folder.
-        img : np.array
-            Image to be processed as Numpy array.
+        img : np.array or str
+            Image to be processed as Numpy array, or the name of a frame published to the frame store.
 
         Returns
         -------
@@ -75,8 +164,13 @@ class Detectron:
 
         """
 
+        img = attach(img)
+
         # Use Detectron2 to predict bounding boxes
-        outputs = self.predictor(img)
+        if self.batcher:
+            outputs = self.batcher.submit(img)
+        else:
+            outputs = self.predictor(img)
 
         img_height = outputs["instances"].image_size[0]
         img_width = outputs["instances"].image_size[1]
@@ -99,3 +193,60 @@ class Detectron:
         results = [create_result(box, cl) for box, cl in zip(boxes, classes)]
 
         return results
+
+    def warm_up(self, height, width):
+        """
+        Runs the model on a blank image, so the lazy initialization of Torch happens before the first request.
+        If batching is enabled, the batched path is warmed up as well.
+
+        Parameters
+        ----------
+        height : int
+            Height of the blank image, should match the size of the camera images.
+        width : int
+            Width of the blank image.
+
+        """
+
+        img = np.zeros((height, width, 3), dtype=np.uint8)
+        self.predictor(img)
+        if self.batcher:
+            self.predict_batch([img, img])
+
+    def close(self):
+        """
+        Stops the thread of the micro-batcher, if batching is enabled.
+
+        """
+
+        if self.batcher:
+            self.batcher.close()
+
+    def predict_batch(self, imgs):
+        """
+        Runs a single forward pass on multiple images. Preprocessing is the same as in `DefaultPredictor`, but the
+        inputs are passed to the model together, which is padded to the largest image of the batch.
+
+        Parameters
+        ----------
+        imgs : list
+            List of images as Numpy arrays in BGR format.
+
+        Returns
+        -------
+        outputs : list
+            List of dicts containing the predicted `instances`, one for each image.
+
+        """
+
+        with torch.no_grad():
+            inputs = []
+            for img in imgs:
+                if self.predictor.input_format == "RGB":
+                    img = img[:, :, ::-1]
+                height, width = img.shape[:2]
+                image = self.predictor.transform_gen.get_transform(img).apply_image(img)
+                image = torch.as_tensor(image.astype("float32").transpose(2, 0, 1))
+                inputs.append({"image": image, "height": height, "width": width})
+
+            return self.predictor.model(inputs)
@@ -0,0 +1,153 @@
+"""
+Optimizations of the Detectron2 model for inference on CPU: tracing the backbone with TorchScript for a fixed image
+size and quantizing the fully connected layers of the box head.
+
+"""
+
+import torch
+import numpy as np
+
+
+class BackboneOutputs(torch.nn.Module):
+    """
+    Wraps a Detectron2 backbone to return its feature maps as a tuple instead of a dict, since tracing only supports
+    tensors and tuples of tensors as outputs.
+
+    Parameters
+    ----------
+    backbone : detectron2.modeling.Backbone
+        The backbone of the model.
+    feature_names : list
+        Names of the feature maps, in the order of the returned tuple.
+
+    """
+
+    def __init__(self, backbone, feature_names):
+        super().__init__()
+        self.backbone = backbone
+        self.feature_names = feature_names
+
+    def forward(self, images):
+        features = self.backbone(images)
+        return tuple(features[name] for name in self.feature_names)
+
+
+class TracedBackbone(torch.nn.Module):
+    """
+    Drop-in replacement of a Detectron2 backbone, which runs a traced copy of it for inputs with the traced height and
+    width, and the original backbone for any other size. The traced graph contains the shapes of the feature maps,
+    so it is only valid for the size it was traced with.
+
+    Parameters
+    ----------
+    backbone : detectron2.modeling.Backbone
+        The backbone of the model.
+    example : torch.Tensor
+        Normalized and padded input of shape (1, 3, height, width), as the model passes it to the backbone.
+
+    """
+
+    def __init__(self, backbone, example):
+        super().__init__()
+        self.backbone = backbone
+        self.feature_names = list(backbone.output_shape().keys())
+        self.traced_size = tuple(example.shape[-2:])
+        with torch.no_grad():
+            self.traced = torch.jit.trace(BackboneOutputs(backbone, self.feature_names), example)
+
+    @property
+    def size_divisibility(self):
+        return self.backbone.size_divisibility
+
+    def output_shape(self):
+        return self.backbone.output_shape()
+
+    def forward(self, images):
+        if tuple(images.shape[-2:]) != self.traced_size:
+            return self.backbone(images)
+
+        return dict(zip(self.feature_names, self.traced(images)))
+
+    def save(self, path):
+        """
+        Saves the traced backbone, so it can be loaded with `torch.jit.load` without Detectron2's Python code.
+
+        Parameters
+        ----------
+        path : str
+            Path of the saved TorchScript file.
+
+        """
+
+        self.traced.save(path)
+
+    def validate(self, example):
+        """
+        Compares the feature maps of the traced backbone with the original one.
+
+        Parameters
+        ----------
+        example : torch.Tensor
+            Input of the traced size.
+
+        Returns
+        -------
+        similarity : float
+            The lowest cosine similarity between the corresponding feature maps, flattened.
+
+        """
+
+        with torch.no_grad():
+            expected = self.backbone(example)
+            actual = self(example)
+
+        return min(
+            float(torch.nn.functional.cosine_similarity(expected[name].flatten(1), actual[name].flatten(1), dim=1).min())
+            for name in self.feature_names
+        )
+
+
+def model_input_example(model, height, width, transform_gen):
+    """
+    Creates a random input of the size the model's backbone receives for images of the provided size, after resizing,
+    normalization and padding.
+
+    Parameters
+    ----------
+    model : detectron2.modeling.GeneralizedRCNN
+        The model.
+    height : int
+        Height of the original images.
+    width : int
+        Width of the original images.
+    transform_gen : detectron2.data.transforms.TransformGen
+        Resizing applied to the images before they are passed to the model, like `DefaultPredictor.transform_gen`.
+
+    Returns
+    -------
+    example : torch.Tensor
+        Random tensor of shape (1, 3, padded_height, padded_width).
+
+    """
+
+    img = np.zeros((height, width, 3), dtype=np.uint8)
+    new_height, new_width = transform_gen.get_transform(img).apply_image(img).shape[:2]
+    image = torch.rand((3, new_height, new_width), generator=torch.Generator().manual_seed(0)) * 255
+
+    with torch.no_grad():
+        return model.preprocess_image([{"image": image}]).tensor
+
+
+def quantize_box_head(model):
+    """
+    Quantizes the fully connected layers of the box head and box predictor to int8 dynamically. The convolutions of
+    the backbone and the RPN are not affected by dynamic quantization.
+
+    Parameters
+    ----------
+    model : detectron2.modeling.GeneralizedRCNN
+        The model, which is modified in place.
+
+    """
+
+    torch.quantization.quantize_dynamic(model.roi_heads, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
@@ -8,9 +8,6 @@ import cv2
 import boto3
 import traceback
 import numpy as np
-import concurrent.futures
-from imutils import paths
-import multiprocessing as mp
 from yaml import load, Loader, YAMLError
 from pathlib import Path
 from dotenv import load_dotenv
@@ -18,73 +15,251 @@ import torchvision.transforms as transforms
 
 from locator.detectron import Detectron
 from vectorizer.vectorizer import Vectorizer
-from utils.postgres import Postgres
+from stitcher.stitcher import StitchingPool
+from stitcher.incremental import IncrementalStitcher
+from utils.postgres import Postgres, SESSION_OBJECT_COLUMNS
 from utils.logger import logger
 from utils.S3 import S3
-from utils.coord_conversion import object_to_polar, filter_duplicates
+from utils.stand_ins import MemoryPostgres, MemoryS3
+from utils.uploader import Uploader
+from utils.image_cache import ImageCache
+from utils.frame_store import FrameStore, attach
+from utils.startup import Startup
+from utils.timing import Timings
+from utils.profiling import Profiler, profiled, parse_targets
+from utils.coord_conversion import objects_to_polar, filter_duplicates_array, polar_to_dicts
+
+
+def load_config(config_path="config.yaml"):
+    """
+    Parses the config file.
+
+    Parameters
+    ----------
+    config_path : str, optional
+        Path of the config file.
+
+    Returns
+    -------
+    config : dict
+        Dict containing one section for each module.
+
+    """
+
+    with open(config_path, 'r') as stream:
+        try:
+            return load(stream, Loader)
+        except YAMLError as error:
+            logger.error("Error while opening config.yaml ", error)
 
 
 class Main:
     """
     Main class for controlling image processing. When instantiated, it loads all neccessary environment
-    variables and config files and instantiates all needed modules.
+    variables and config files and instantiates all needed modules. The duration of each startup phase is measured,
+    and the models are warmed up with an inference on a blank image, so the first request doesn't pay for
+    lazy initialization.
 
     Parameters
     ----------
     base_img_path : str
         Location where the downloaded images should be stored.
+    startup : Startup, optional
+        Records the startup phases and marks the service ready when Main is constructed.
+    role : str, optional
+        Parts of the service run by this instance. `standalone` runs everything in one process, which is used with a
+        thread pool dispatcher. With a process pool dispatcher, the server process uses `server`, which submits the
+        stitching jobs but doesn't load the models, and each worker process uses `worker`, which loads the models but
+        doesn't start a stitching pool. Images are only registered incrementally for stitching in `standalone` mode,
+        since the images of a session are processed by different worker processes otherwise.
 
     """
 
-    def __init__(self, base_img_path):
+    def __init__(self, base_img_path, startup=None, role="standalone"):
+        if role not in ("standalone", "server", "worker"):
+            raise ValueError(f"Unknown role: '{role}'. Possible values: standalone, server and worker.")
+
         # Load environment from .env in project root
         load_dotenv()
 
         # Assign logger to main (this way tests can disable HTTPHandler)
         self.logger = logger
+        self.startup = startup or Startup(self.logger)
 
         # Parse config.yaml
-        with open("config.yaml", 'r') as stream:
-            try:
-                config = load(stream, Loader)
-            except YAMLError as error:
-                self.logger.error("Error while opening config.yaml ", error)
+        with self.startup.phase("config"):
+            config = load_config()
 
+        self.config = config
         self.base_img_path = base_img_path
-
-        if os.getenv("MODE") != "local":
-            session = boto3.Session(region_name=os.getenv("DEPLOY_REGION"))
-            self.ssm = session.client('ssm')
-            self.s3 = S3(base_img_path=self.base_img_path, logger_instance=self.logger)
-            self.bucket_name = f'sorterbot-{self.ssm.get_parameters(Names=["RESOURCE_SUFFIX"])["Parameters"][0]["Value"]}'
-
-        self.postgres = Postgres()
-        self.detectron = Detectron(
-            base_img_path=self.base_img_path,
-            model_config=config["DETECTRON"]["MODEL_CONFIG"],
-            threshold=config["DETECTRON"]["THRESHOLD"]
+        self.role = role
+        # Stages running in the same process share the decoded images in memory, frames are only written for other processes
+        self.publish_frames = role == "worker"
+
+        # Durations of the stages of processing images and sessions, aggregated to histograms and exportable per session
+        self.timings = Timings(
+            window=config["TIMING"]["WINDOW"],
+            max_sessions=config["TIMING"]["MAX_SESSIONS"],
+            max_spans=config["TIMING"]["MAX_SPANS"]
         )
-        self.vectorizer = Vectorizer(
+
+        # Handlers are profiled for the arms and sessions listed in the config or the PROFILE environment variable
+        arms, sessions, everything = parse_targets(os.getenv("PROFILE"))
+        self.profiler = Profiler(
             base_img_path=self.base_img_path,
-            model_name=config["VECTORIZER"]["MODEL"],
-            input_dimensions=config["VECTORIZER"]["INPUT_DIMS"],
-            batch_size=config["VECTORIZER"]["BATCH_SIZE"]
+            arms=arms | set(config["PROFILING"]["ARMS"]),
+            sessions=sessions | set(tuple(session.split("/", 1)) for session in config["PROFILING"]["SESSIONS"]),
+            everything=everything or config["PROFILING"]["ENABLED"],
+            memory=config["PROFILING"]["MEMORY"],
+            top=config["PROFILING"]["TOP"]
         )
 
-    def process_image(self, arm_id, session_id, image_name, img_bytes):
+        with self.startup.phase("aws"):
+            if os.getenv("MODE") == "loadtest":
+                # Uploads are only recorded in memory, so load tests don't need network access
+                self.s3 = MemoryS3()
+                self.bucket_name = "sorterbot-loadtest"
+            elif os.getenv("MODE") != "local":
+                session = boto3.Session(region_name=os.getenv("DEPLOY_REGION"))
+                self.ssm = session.client('ssm')
+                self.s3 = S3(base_img_path=self.base_img_path, logger_instance=self.logger)
+                self.bucket_name = f'sorterbot-{self.ssm.get_parameters(Names=["RESOURCE_SUFFIX"])["Parameters"][0]["Value"]}'
+
+        with self.startup.phase("background_workers"):
+            # Uploads to s3 are executed in the background by a fixed number of threads
+            self.uploader = Uploader(
+                s3=self.s3 if os.getenv("MODE") != "local" else None,
+                bucket_name=self.bucket_name if os.getenv("MODE") != "local" else None,
+                logger_instance=self.logger,
+                workers=config["UPLOADER"]["WORKERS"],
+                queue_size=config["UPLOADER"]["QUEUE_SIZE"],
+                max_retries=config["UPLOADER"]["MAX_RETRIES"],
+                timings=self.timings
+            )
+
+            # Worker processes publish the decoded frames as memory-mapped files, so other workers can attach to them without decoding
+            self.frame_store = FrameStore(
+                base_img_path=self.base_img_path,
+                idle_ttl=config["FRAME_STORE"]["IDLE_TTL"],
+                sweep_interval=config["FRAME_STORE"]["SWEEP_INTERVAL"]
+            )
+
+            # Panoramas are stitched in the background by separate processes, owned by the process which receives the status queries
+            self.stitcher = None if role == "worker" else StitchingPool(
+                base_img_path=self.base_img_path,
+                logger_instance=self.logger,
+                uploader=self.uploader,
+                workers=config["STITCHER"]["WORKERS"],
+                max_pending=config["STITCHER"]["MAX_PENDING"],
+                cv_threads=config["STITCHER"]["CV_THREADS"],
+                options={
+                    "registration_resol": config["STITCHER"]["REGISTRATION_RESOL"],
+                    "seam_resol": config["STITCHER"]["SEAM_RESOL"],
+                    "compositing_resol": config["STITCHER"]["COMPOSITING_RESOL"],
+                    "max_output_side": config["STITCHER"]["MAX_OUTPUT_SIDE"],
+                    "jpeg_quality": config["STITCHER"]["JPEG_QUALITY"]
+                },
+                frame_store=self.frame_store,
+                timings=self.timings
+            )
+
+            # Images are registered to their neighbors as they arrive, so the panorama can be composed quickly at the end
+            self.incremental_stitcher = IncrementalStitcher(
+                scale=config["STITCHER"]["INCREMENTAL_SCALE"],
+                max_sessions=config["STITCHER"]["INCREMENTAL_MAX_SESSIONS"],
+                logger_instance=self.logger
+            ) if config["STITCHER"]["INCREMENTAL"] and role == "standalone" else None
+
+        with self.startup.phase("postgres"):
+            self.postgres = MemoryPostgres() if os.getenv("MODE") == "loadtest" else Postgres()
+
+        # Decoded images are shared by detection, feature extraction and cropping
+        self.image_cache = ImageCache(max_bytes=config["IMAGE_CACHE"]["MAX_MB"] * 2 ** 20)
+
+        # The server process of a process pool dispatcher only submits stitching jobs, the workers run the models
+        self.detectron = None
+        self.vectorizer = None
+        if role != "server":
+            with self.startup.phase("detectron"):
+                self.detectron = Detectron(
+                    base_img_path=self.base_img_path,
+                    model_config=config["DETECTRON"]["MODEL_CONFIG"],
+                    threshold=config["DETECTRON"]["THRESHOLD"],
+                    batch_size=config["DETECTRON"]["BATCH_SIZE"],
+                    max_wait_ms=config["DETECTRON"]["MAX_WAIT_MS"],
+                    min_size=config["DETECTRON"]["MIN_SIZE"],
+                    max_size=config["DETECTRON"]["MAX_SIZE"],
+                    rpn_pre_nms_topk=config["DETECTRON"]["RPN_PRE_NMS_TOPK"],
+                    rpn_post_nms_topk=config["DETECTRON"]["RPN_POST_NMS_TOPK"],
+                    num_threads=config["DETECTRON"]["THREADS"],
+                    quantize=config["DETECTRON"]["QUANTIZE"],
+                    engine=config["DETECTRON"]["ENGINE"],
+                    image_dims=config["DETECTRON"]["IMAGE_DIMS"],
+                    export_path=config["DETECTRON"]["EXPORT_PATH"],
+                    min_similarity=config["DETECTRON"]["MIN_SIMILARITY"]
+                )
+                self.logger.info(f"Detectron uses the '{self.detectron.engine}' engine, cosine similarity to eager: {self.detectron.similarity}.")
+
+
+            with self.startup.phase("vectorizer"):
+                self.vectorizer = Vectorizer(
+                    base_img_path=self.base_img_path,
+                    model_name=config["VECTORIZER"]["MODEL"],
+                    input_dimensions=config["VECTORIZER"]["INPUT_DIMS"],
+                    batch_size=config["VECTORIZER"]["BATCH_SIZE"],
+                    streaming=config["VECTORIZER"]["STREAMING"],
+                    save_crops=config["VECTORIZER"]["SAVE_CROPS"],
+                    image_cache=self.image_cache,
+                    frame_store=self.frame_store,
+                    weights_path=Path(__file__).resolve().parents[1].joinpath(config["VECTORIZER"]["WEIGHTS"]).as_posix(),
+                    engine=config["VECTORIZER"]["ENGINE"],
+                    quantize=config["VECTORIZER"]["QUANTIZE"],
+                    channels_last=config["VECTORIZER"]["CHANNELS_LAST"],
+                    min_similarity=config["VECTORIZER"]["MIN_SIMILARITY"],
+                    timings=self.timings,
+                    cache_sessions=config["VECTORIZER"]["CACHE_MAX_SESSIONS"]
+                )
+                self.logger.info(f"Vectorizer uses the '{self.vectorizer.engine}' engine, cosine similarity to eager: {self.vectorizer.similarity}.")
+        self.precompute_vectors = config["VECTORIZER"]["PRECOMPUTE"]
+
+        if config["STARTUP"]["WARM_UP"] and role != "server":
+            with self.startup.phase("warm_up"):
+                self.warm_up()
+
+        self.startup.set_ready()
+
+    def warm_up(self):
+        """
+        Runs the models once on blank inputs, so the lazy initialization of Torch (like allocating buffers and
+        selecting kernels) doesn't slow down the first real request. Detectron is warmed up with the size of the
+        camera images, which is also the size the traced backbone is exported for.
+
+        """
+
+        height, width = self.config["DETECTRON"]["IMAGE_DIMS"]
+        self.detectron.warm_up(height, width)
+        self.vectorizer.warm_up()
+
+    @profiled
+    def process_image(self, arm_id, session_id, image_name, img_bytes, queue_wait=0.):
         """
         This method runs object recognition on the passed image and saves the result to the database.
+        It executes the stages of the image pipeline (`decode_image`, `detect_objects` and `persist_results`) one after the other.
 
         Parameters
         ----------
+        arm_id : str
+            Unique identifier of the robot arm.
         session_id : str
             Datetime based unique identifier of the current session. It is generated by the Raspberry Pi and passed
             with the POST request.
         image_name : str
             Name of the image to be processed. The image has to be uploaded to the s3 bucket. Value is passed
             with the POST request.
-        img_bytes : bytes
+        img_bytes : bytes or memoryview
             Image to be processed as raw bytes.
+        queue_wait : float, optional
+            Time in seconds the image waited before processing started, recorded with the `decode` span.
 
         Returns
         -------
@@ -94,56 +269,168 @@ class Main:
         """
 
         try:
-            step = Path(image_name).stem
-            log_args = {"arm_id": arm_id, "session_id": session_id, "log_type": step}
-            self.logger.info(f"Image '{image_name} received, started processing.", dict(bm_id=2, **log_args))
+            img = self.decode_image(arm_id, session_id, image_name, img_bytes, queue_wait)
+            results = self.detect_objects(arm_id, session_id, image_name, img)
+            return self.persist_results(arm_id, session_id, image_name, img, img_bytes, results)
 
-            # Create table in Postgres for current session if it does not exist yet
-            table_created = self.postgres.create_table(schema_name=arm_id, table_name=session_id)
-            if table_created:
-                self.logger.info(f"Postgres table created.", log_args)
+        except Exception:
+            traceback.print_exc()
+            return False
 
-            # Create folders for original and cropped images if they do not exist
-            Path(os.path.join(self.base_img_path, session_id, "original")).mkdir(parents=True, exist_ok=True)
-            Path(os.path.join(self.base_img_path, session_id, "cropped")).mkdir(parents=True, exist_ok=True)
-            Path(os.path.join(self.base_img_path, session_id, "after")).mkdir(parents=True, exist_ok=True)
-            Path(os.path.join(self.base_img_path, session_id, "bboxes_original")).mkdir(parents=True, exist_ok=True)
-            Path(os.path.join(self.base_img_path, session_id, "bboxes_after")).mkdir(parents=True, exist_ok=True)
+    @profiled
+    def decode_image(self, arm_id, session_id, image_name, img_bytes, queue_wait=0.):
+        """
+        First stage of processing an image: prepares the session's table and folders, then decodes the image.
+        In worker processes of a process pool dispatcher, the decoded image is published to the frame store as well.
 
-            # Convert image bytes to np.array and normalize it to ImageNet stats
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        image_name : str
+            Name of the image to be processed.
+        img_bytes : bytes or memoryview
+            Image to be processed as raw bytes.
+        queue_wait : float, optional
+            Time in seconds the image waited in the queue of the stage.
+
+        Returns
+        -------
+        img : np.array
+            Decoded, read-only image, shared through the image cache.
+
+        """
+
+        log_args = {"arm_id": arm_id, "session_id": session_id, "log_type": Path(image_name).stem}
+        self.logger.info(f"Image '{image_name} received, started processing.", dict(bm_id=2, **log_args))
+
+        # Create table in Postgres for current session if it does not exist yet
+        with self.timings.span("create_table", arm_id, session_id, image_name):
+            table_created = self.postgres.create_table(schema_name=arm_id, table_name=session_id)
+        if table_created:
+            self.logger.info(f"Postgres table created.", log_args)
+
+        # Create folders for original and cropped images if they do not exist
+        Path(os.path.join(self.base_img_path, session_id, "original")).mkdir(parents=True, exist_ok=True)
+        Path(os.path.join(self.base_img_path, session_id, "cropped")).mkdir(parents=True, exist_ok=True)
+        Path(os.path.join(self.base_img_path, session_id, "after")).mkdir(parents=True, exist_ok=True)
+        Path(os.path.join(self.base_img_path, session_id, "bboxes_original")).mkdir(parents=True, exist_ok=True)
+        Path(os.path.join(self.base_img_path, session_id, "bboxes_after")).mkdir(parents=True, exist_ok=True)
+
+        with self.timings.span("decode", arm_id, session_id, image_name, queue_wait, len(img_bytes)):
+            # Convert image bytes to np.array
             img = cv2.imdecode(np.frombuffer(img_bytes, np.uint8), cv2.IMREAD_COLOR)
-            # normalize = transforms.Normalize(mean=[144., 142., 139.], std=[68., 69.7, 77.])
-            # to_tensor = transforms.ToTensor()
-            # img = normalize(to_tensor(img)).permute(1, 2, 0).numpy().astype("uint8")
+            if img is None:
+                raise ValueError(f"Image '{image_name}' could not be decoded.")
 
-            # Run detectron to get bounding boxes
+            # Publish the decoded image for the other worker processes, the stages of this process share the array in memory
+            if self.publish_frames:
+                self.frame_store.publish(arm_id, session_id, image_name, img)
+            return self.image_cache.put(arm_id, session_id, image_name, img)
+
+    @profiled
+    def detect_objects(self, arm_id, session_id, image_name, img, queue_wait=0.):
+        """
+        Second stage of processing an image: runs object detection and registers the image for stitching.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        image_name : str
+            Name of the image to be processed.
+        img : np.array or str
+            Decoded image or the name of its published frame.
+        queue_wait : float, optional
+            Time in seconds the image waited in the queue of the stage.
+
+        Returns
+        -------
+        results : list
+            List of dicts containing the results of the object detection, see `Detectron.predict`.
+
+        """
+
+        log_args = {"arm_id": arm_id, "session_id": session_id, "log_type": Path(image_name).stem}
+
+        # Run detectron to get bounding boxes
+        with self.timings.span("detect", arm_id, session_id, image_name, queue_wait, attach(img).nbytes):
             results = self.detectron.predict(session_id=session_id, image_name=image_name, img=img)
-            self.logger.info(f"Bounding boxes predicted.", dict(bm_id=3, **log_args))
+        self.logger.info(f"Bounding boxes predicted.", dict(bm_id=3, **log_args))
+
+        # Extract features of the image and register it to its neighbors for stitching
+        if self.incremental_stitcher:
+            with self.timings.span("register", arm_id, session_id, image_name):
+                self.incremental_stitcher.add_image(arm_id, session_id, image_name, attach(img))
+            self.logger.info(f"Image registered for stitching.", log_args)
+
+        return results
 
-            # Insert bounding box locations to postgres
-            self.postgres.insert_results(schema_name=arm_id, table_name=session_id, results=results)
-            self.logger.info(f"Results saved to Postgres.", log_args)
+    @profiled
+    def persist_results(self, arm_id, session_id, image_name, img, img_bytes, results, queue_wait=0.):
+        """
+        Last stage of processing an image: saves the detected objects to the database, computes the feature vectors
+        of the items, then writes the image to disk and queues its upload to s3.
 
-            # Generate image paths on disk and s3
-            img_disk_path = Path(self.base_img_path).joinpath(session_id, "original", image_name)
-            img_s3_path = f'{arm_id}/{session_id}/{image_name}'
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        image_name : str
+            Name of the image to be processed.
+        img : np.array or str
+            Decoded image or the name of its published frame.
+        img_bytes : bytes or memoryview
+            Image as raw bytes, which is written to disk.
+        results : list
+            Results of the object detection, as returned by `detect_objects`.
+        queue_wait : float, optional
+            Time in seconds the image waited in the queue of the stage.
 
-            # Write to disk and upload to s3 async
-            executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
-            executor.submit(self.save_and_upload_image, img_disk_path, img_s3_path, img_bytes, log_args)
+        Returns
+        -------
+        success : bool
+            Boolean indicating if the image was written to disk and its upload was queued.
 
-            self.logger.info(f"Processing image is successful.", dict(bm_id=7, **log_args))
+        """
 
-            return True
+        log_args = {"arm_id": arm_id, "session_id": session_id, "log_type": Path(image_name).stem}
 
-        except Exception:
-            traceback.print_exc()
-            return False
+        # Insert bounding box locations to postgres
+        with self.timings.span("insert", arm_id, session_id, image_name, queue_wait):
+            ids = self.postgres.insert_results(schema_name=arm_id, table_name=session_id, results=results)
+        self.logger.info(f"Results saved to Postgres.", log_args)
+
+        # Compute feature vectors of items now, so it doesn't have to be done after the last image arrived
+        if self.precompute_vectors:
+            items = [
+                {"id": obj_id, "bbox_dims": {"x1": res["x1"], "y1": res["y1"], "x2": res["x2"], "y2": res["y2"]}}
+                for obj_id, res in zip(ids, results) if res["class"] == 0
+            ]
+            self.vectorizer.cache_object_vectors(arm_id, session_id, image_name, attach(img), items)
+            self.logger.info(f"Feature vectors of {len(items)} items computed.", log_args)
+
+        # Generate image paths on disk and s3
+        img_disk_path = Path(self.base_img_path).joinpath(session_id, "original", image_name)
+        img_s3_path = f'{arm_id}/{session_id}/{image_name}'
+
+        # Write to disk and queue upload to s3
+        success = self.save_and_upload_image(img_disk_path, img_s3_path, img_bytes, log_args)
+
+        self.logger.info(f"Processing image is successful.", dict(bm_id=7, **log_args))
+
+        return success
 
     def save_and_upload_image(self, img_path, s3_path, img_bytes, log_args):
         """
-        Takes an image as bytes and writes it to disk, then uploads it to s3. This functionality is not essential
-        to generate the commands, so if this is executed on a separate thread, some speed-up can be gained.
+        Takes an image as bytes and writes it to disk, then queues it to be uploaded to s3. Uploading is not essential
+        to generate the commands, so it is executed in the background by the uploader.
 
         Parameters
         ----------
@@ -151,7 +438,7 @@ class Main:
             Path of the image where it should be saved to disk.
         s3_path : str
             Path of the image where it should be uploaded to s3.
-        img_bytes : bytes
+        img_bytes : bytes or memoryview
             The image as bytes.
         log_args : dict
             Arguments to correctly place log entry on the control panel.
@@ -159,28 +446,28 @@ class Main:
         Returns
         -------
         success : bool
-            Boolean representing if saving to disk and uploading to s3 was successful.
+            Boolean representing if saving to disk and queueing the upload to s3 was successful.
 
         """
 
         try:
-            self.logger.info(f"Starting to save and upload image on a separate thread...", dict(bm_id=4, **log_args))
+            self.logger.info(f"Starting to save and upload image...", dict(bm_id=4, **log_args))
 
             # Write image bytes to disk for later use
-            with open(img_path, "wb") as output_file:
-                output_file.write(img_bytes)
+            with self.timings.span("save", log_args.get("arm_id"), log_args.get("session_id"), Path(img_path).name, payload_bytes=len(img_bytes)):
+                with open(img_path, "wb") as output_file:
+                    output_file.write(img_bytes)
             self.logger.info(f"Image written to disk.", dict(bm_id=5, **log_args))
 
-            # Upload image to s3
-            if os.getenv("MODE") != "local":
-                self.s3.upload_file(self.bucket_name, img_path.as_posix(), s3_path)
-                self.logger.info(f"Image uploaded to s3.", dict(bm_id=6, **log_args))
+            # Upload image to s3 in the background
+            self.uploader.submit(img_path, s3_path, dict(bm_id=6, **log_args))
 
             return True
         except Exception as e:
             self.logger.error(e)
             return False
 
+    @profiled
     def vectorize_session_images(self, arm_constants, session_id, should_stitch=True):
         """
         This method is to be executed after the last image of a session is processed. It gets a list of unique
@@ -194,7 +481,8 @@ class Main:
         session_id : str
             Unique identifier of the session.
         should_stitch : bool
-            Boolean value that enables or disables stitching a panorama image.
+            Boolean value that enables or disables stitching a panorama image. Worker processes have no stitching pool,
+            the server process submits the stitching job with `stitch_session` instead.
 
         Returns
         -------
@@ -203,9 +491,9 @@ class Main:
         session_id : str
             Datetime based unique identifier of the current session. It is generated by the Raspberry Pi and passed
             with the POST request.
-        stitching_process : process
-            Process which is used for stitching. Should be joined after the commands are sent back to Raspberry Pi,
-            this way the Pi is not waiting for it unneccessarily and also the process doesn't become zombie.
+        stitching_job : dict
+            Status of the stitching job, which is executed in the background, so the Pi doesn't wait for it.
+            None if stitching is disabled.
 
         """
 
@@ -214,90 +502,150 @@ class Main:
 
         self.logger.info("Generating session commands started.", dict(bm_id=9, **log_args))
 
-        # Get list of unique image names in current session
-        unique_images = self.postgres.get_unique_images(schema_name=arm_id, table_name=session_id)
-
-        # Create separate lists of items and containers and convert them to absolute polar coordinates
-        items = []
-        conts = []
-        images_with_objects = []
-        unique_images = sorted(unique_images, key=lambda img: int(img.split(".")[0]))
-
-        for image_name in unique_images:
-            # Retrieve bounding boxes from postgres
-            objects_of_image = self.postgres.get_objects_of_image(schema_name=arm_id, table_name=session_id, image_name=image_name)
-
-            # Build list to stitch together images later
-            images_with_objects.append({'image_name': image_name, "objects": objects_of_image})
-            objects_of_image = sorted(objects_of_image, key=lambda obj: obj["id"])
-
-            for obj in objects_of_image:
-                # Transform coordinates to absolute polar coords
-                (items if obj["class"] == 0 else conts).append(object_to_polar(arm_constants=arm_constants, image_name=image_name, obj=obj))
-
-        # Stitch together session images
-        stitching_process = None
-
-        if should_stitch:
-            try:
-                self.stitch_images(arm_id, session_id, "original", images_with_objects)
-            except Exception as e:
-                print("stitch error", e)
-            # stitching_process = mp.Process(target=self.stitch_images, args=(arm_id, session_id, "original", images_with_objects))
-            # stitching_process.start()
-
-        self.logger.info("Bounding boxes retrieved from database.", dict(bm_id=10, **log_args))
-
-        # Filter out duplicates which are the same objects showing up on different images
-        filtered_items = filter_duplicates(items)
-        filtered_conts = filter_duplicates(conts)
-        self.logger.info(f"Duplicate items filtered out.", log_args)
-
-        # Handle case where there are more containers than objects
-        if len(filtered_conts) > len(filtered_items):
-            self.logger.warning(f"There are more containers than objects, skipping the excess.", log_args)
-            filtered_conts = filtered_conts[: len(filtered_items)]
-
-        # Handle case if no containers were found
-        n_containers = len(filtered_conts)
-        if n_containers == 0:
-            self.logger.warning(f"No containers were found!", log_args)
-            return [], [], stitching_process
-        else:
-            self.logger.info(f"{n_containers} containers were found.", log_args)
-
-        self.logger.info(f"Absolute coordinates calculated and duplicates filtered.", dict(bm_id=15, **log_args))
-
-        # Run vectorizer to assign each object to a cluster
-        pairings = self.vectorizer.run(
-            session_id=session_id,
-            unique_images=unique_images,
-            objects=filtered_items,
-            n_containers=n_containers
+        try:
+            # Retrieve bounding boxes of all images in current session from postgres
+            with self.timings.span("query", arm_id, session_id):
+                session_objects = self.postgres.get_session_objects(schema_name=arm_id, table_name=session_id)
+            unique_images = sorted(session_objects, key=lambda img: int(img.split(".")[0]))
+
+            # Concatenate rows of all images, which are already ordered by id within an image
+            if len(unique_images) > 0:
+                rows = np.concatenate([session_objects[image_name] for image_name in unique_images])
+            else:
+                rows = np.empty((0, len(SESSION_OBJECT_COLUMNS)), dtype=np.int64)
+            img_base_angles = np.repeat(
+                [int(Path(image_name).stem) for image_name in unique_images],
+                [len(session_objects[image_name]) for image_name in unique_images]
+            )
+            obj_ids, classes, img_dims, bboxes = rows[:, 0], rows[:, 1], rows[:, 2:4], rows[:, 4:8]
+
+            # Transform coordinates of all objects to absolute polar coords at once, then separate items and containers
+            polar = objects_to_polar(arm_constants, img_base_angles, obj_ids, img_dims, bboxes)
+            is_item = classes == 0
+            items, conts = polar[is_item], polar[~is_item]
+
+            # Stitch together session images in the background
+            stitching_job = None
+
+            if should_stitch and self.stitcher:
+                stitching_job = self.stitch_session(arm_id, session_id, session_objects)
+
+            self.logger.info("Bounding boxes retrieved from database.", dict(bm_id=10, **log_args))
+
+            # Filter out duplicates which are the same objects showing up on different images
+            with self.timings.span("filter", arm_id, session_id):
+                filtered_items = filter_duplicates_array(items)
+                filtered_conts = filter_duplicates_array(conts)
+            self.logger.info(f"Duplicate items filtered out.", log_args)
+
+            # Handle case where there are more containers than objects
+            if len(filtered_conts) > len(filtered_items):
+                self.logger.warning(f"There are more containers than objects, skipping the excess.", log_args)
+                filtered_conts = filtered_conts[: len(filtered_items)]
+
+            # Handle case if no containers were found
+            n_containers = len(filtered_conts)
+            if n_containers == 0:
+                self.logger.warning(f"No containers were found!", log_args)
+                return [], [], stitching_job
+            else:
+                self.logger.info(f"{n_containers} containers were found.", log_args)
+
+            self.logger.info(f"Absolute coordinates calculated and duplicates filtered.", dict(bm_id=15, **log_args))
+
+            # Run vectorizer to assign each object to a cluster
+            pairings = self.vectorizer.run(
+                arm_id=arm_id,
+                session_id=session_id,
+                unique_images=unique_images,
+                objects=polar_to_dicts(filtered_items),
+                n_containers=n_containers
+            )
+            self.logger.info(f"Vectorizer finished for all images.", log_args)
+
+            # Return if no images were found
+            if len(pairings) == 0:
+                self.logger.warning(f"No objects were found!", log_args)
+                return [], [], stitching_job
+
+            # Generate commands
+            clusters = {(pairing["image_id"], pairing["obj_id"]): pairing["cluster"] for pairing in pairings}
+            commands = []
+            for item in filtered_items:
+                target_cont = filtered_conts[clusters[(int(item["img_base_angle"]), int(item["obj_id"]))]]
+                commands.append((tuple(item["polar_coords"].tolist()), tuple(target_cont["polar_coords"].tolist()),))
+            self.logger.info(f"Command generation finished.", dict(bm_id=16, **log_args))
+
+            return commands, pairings, stitching_job
+        finally:
+            # Feature vectors and decoded images are not needed anymore, even if generating the commands failed
+            self.release_session(arm_id, session_id, log_args)
+
+    def release_session(self, arm_id, session_id, log_args):
+        """
+        Removes the cached feature vectors and decoded images of a session, releases the session's reference of its
+        published frames and logs the statistics of the image cache. Frames used by running stitching jobs are deleted
+        when the jobs are finished.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        log_args : dict
+            Arguments to correctly place log entry on the control panel.
+
+        """
+
+        self.vectorizer.vector_cache.release(arm_id, session_id)
+        self.image_cache.release(arm_id, session_id)
+        self.frame_store.release_session(arm_id, session_id)
+
+        stats = self.image_cache.stats()
+        self.logger.info(
+            f"Image cache: {stats['hits']} hits, {stats['misses']} misses, {stats['evictions']} evictions, "
+            f"{stats['resident_bytes'] / 2 ** 20:.1f} MB resident in {stats['images']} images.",
+            log_args
         )
-        self.logger.info(f"Vectorizer finished for all images.", log_args)
 
-        # Return if no images were found
-        if len(pairings) == 0:
-            self.logger.warning(f"No objects were found!", log_args)
-            return [], [], stitching_process
+    def stitch_session(self, arm_id, session_id, session_objects=None):
+        """
+        Submits a job to stitch the original images of a session, with the bounding boxes of the objects drawn on them.
+        With a process pool dispatcher, the server process calls this after the commands are generated by a worker
+        process, so the job runs on the server's stitching pool, whose status can be queried.
 
-        def pairing_matches_item(pairing, item):
-            return pairing["image_id"] == item["img_base_angle"] and pairing["obj_id"] == item["obj_id"]
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        session_objects : dict, optional
+            The session's objects, as returned by `Postgres.get_session_objects`. Queried from the database if not provided.
 
-        # Generate commands
-        commands = []
-        for item in filtered_items:
-            target_cont = next(filtered_conts[pairing["cluster"]] for pairing in pairings if pairing_matches_item(pairing, item))
-            commands.append((item["avg_polar_coords"], target_cont["avg_polar_coords"],))
-        self.logger.info(f"Command generation finished.", dict(bm_id=16, **log_args))
+        Returns
+        -------
+        stitching_job : dict
+            Status of the submitted stitching job.
 
-        return commands, pairings, stitching_process
+        """
+
+        if session_objects is None:
+            session_objects = self.postgres.get_session_objects(schema_name=arm_id, table_name=session_id)
+
+        images_with_objects = [
+            {"image_name": image_name, "bboxes": session_objects[image_name][:, 4:8]}
+            for image_name in sorted(session_objects, key=lambda img: int(img.split(".")[0]))
+        ]
+
+        return self.stitch_images(arm_id, session_id, "original", images_with_objects)
 
     def stitch_images(self, arm_id, session_id, stitch_type, images_with_objects):
         """
-        Stitches together overlapping images to provide an overview on the UI about the area of interest before and after the
-        arm's operation.
+        Submits a job to stitch together overlapping images to provide an overview on the UI about the area of interest
+        before and after the arm's operation. Stitching is executed by the stitching pool's worker processes, this method
+        returns immediately. If all images were registered incrementally, the panorama is composed from the cached transforms.
 
         Parameters
         ----------
@@ -309,81 +657,46 @@ class Main:
         stitch_type : str
             Type of stitch which will be prepended to the file name. Possible values: original and after.
         images_with_objects : list of dicts
-            List of dicts, each dictionary containing 'image_name' and 'objects'. There is one entry for each unique
-            image in a session.
-
-        """
-
-        log_args = {"arm_id": arm_id, "session_id": session_id, "log_type": "comm_gen"}
-
-        self.logger.info("Stitching images started.", dict(bm_id=11, **log_args))
+            List of dicts, each dictionary containing 'image_name' and 'bboxes', which is an array of shape (n_objects, 4)
+            containing the x1, y1, x2, y2 coordinates of the bounding boxes. There is one entry for each unique image in a session.
 
-        # Open images, draw bounding boxes then save them to a new directory
-        for image in images_with_objects:
-            # Open image for drawing and normalize it
-            if stitch_type == "original":
-                image_name = image["image_name"]
-            else:
-                image_name = image
-            img_path = Path(self.base_img_path).joinpath(session_id, stitch_type, image_name)
-            img = cv2.imread(img_path.as_posix())
-            # cv2.normalize(img, img, 0, 255, cv2.NORM_MINMAX)
+        Returns
+        -------
+        stitching_job : dict
+            Status of the submitted stitching job.
 
-            # img = (img - img.mean(axis=(0, 1, 2), keepdims=True)) / img.std(axis=(0, 1, 2), keepdims=True)
+        """
 
-            # normalize = transforms.Normalize(mean=[144., 142., 139.], std=[68., 69.7, 77.])
-            # to_tensor = transforms.ToTensor()
-            # img = normalize(to_tensor(img)).numpy()
+        transforms = None
+        # Only the original images are registered as they arrive, after images are always stitched by the full pipeline
+        if self.incremental_stitcher and stitch_type == "original":
+            # Images without objects are not in the database, but they are part of the panorama too
+            image_names = [image["image_name"] for image in images_with_objects]
+            original_path = Path(self.base_img_path).joinpath(session_id, "original")
+            images_with_objects = images_with_objects + [
+                {"image_name": image_name, "bboxes": np.empty((0, 4), dtype=np.int64)}
+                for image_name in sorted(os.listdir(original_path)) if image_name.endswith(".jpg") and image_name not in image_names
+            ]
+            image_names = [image["image_name"] for image in images_with_objects]
+            transforms = self.incremental_stitcher.get_transforms(arm_id, session_id, image_names)
 
-            if stitch_type == "original":
-                for obj in image["objects"]:
-                    # Draw bounding boxes on image
-                    cv2.rectangle(img, (obj["bbox_dims"]["x1"], obj["bbox_dims"]["y1"]), (obj["bbox_dims"]["x2"], obj["bbox_dims"]["y2"]), (255, 0, 0), 2)
+            # The cached features are not needed anymore once the transforms of the panorama are known
+            self.incremental_stitcher.release(arm_id, session_id)
 
-            # Save image (with drawn bounding boxes in case of original stitch type)
-            cv2.imwrite(Path(self.base_img_path).joinpath(session_id, f"bboxes_{stitch_type}", image_name).as_posix(), img)
+        # Stitching workers attach to the published frames of the original images and read the rest from disk, the job holds a reference until it's finished
+        frames = self.frame_store.acquire(arm_id, session_id, self.frame_store.image_names(arm_id, session_id))
 
-        if stitch_type == "original":
-            self.logger.info("Bounding boxes drawn and new images saved.", dict(bm_id=12, **log_args))
-        else:
-            self.logger.info("New images saved.", dict(bm_id=12, **log_args))
+        return self.stitcher.submit(arm_id, session_id, stitch_type, images_with_objects, transforms, frames)
 
-        image_paths_with_bb = sorted(list(paths.list_images(Path(self.base_img_path).joinpath(session_id, f"bboxes_{stitch_type}"))))
-        basenames_with_bb = [Path(image_path).name for image_path in image_paths_with_bb]
+    def shutdown(self):
+        """
+        Waits for the background work of Main to finish. Should be called before the process exits.
 
-        original_images = sorted(list(paths.list_images(Path(self.base_img_path).joinpath(session_id, "original"))))
+        """
 
-        all_paths = []
-        for orig_image in original_images:
-            if Path(orig_image).name in basenames_with_bb:
-                image_with_bb = next((path_with_bb for path_with_bb in image_paths_with_bb if Path(orig_image).name == Path(path_with_bb).name))
-                all_paths.append(image_with_bb)
-            else:
-                all_paths.append(orig_image)
-
-        # Open images for stitching
-        images_with_bb = []
-        for image_path_with_bb in all_paths:
-            image_with_bb = cv2.imread(image_path_with_bb)
-            images_with_bb.append(image_with_bb)
-
-        # Stitch together images with bounding boxes
-        stitcher = cv2.Stitcher_create(mode=1)
-
-        (stitch_status, stitched_img) = stitcher.stitch(images_with_bb)
-
-        if stitch_status == 0:
-            # Save stitched image to disk
-            self.logger.info("Image stitching successful.", dict(bm_id=13, **log_args))
-            stitched_path = Path(self.base_img_path).joinpath(session_id, f"bboxes_{stitch_type}", f"{stitch_type}_stitch.jpg").as_posix()
-            cv2.imwrite(stitched_path, stitched_img)
-            log_args["log_type"] = "before" if stitch_type == "original" else "after"
-            self.logger.info("Stitched image saved to disk.", dict(bm_id=14, **log_args))
-
-            # Upload stitched image to s3
-            if os.getenv("MODE") != "local":
-                self.s3.upload_file(self.bucket_name, stitched_path, f'{arm_id}/{session_id}/{stitch_type}_stitch.jpg')
-                self.logger.info("Stitched image uploaded to s3.", dict(bm_id=15, **log_args))
-
-        else:
-            self.logger.error("Image stitching failed!", log_args)
+        if self.stitcher:
+            self.stitcher.shutdown()
+        if self.detectron:
+            self.detectron.close()
+        self.frame_store.shutdown()
+        self.uploader.shutdown()
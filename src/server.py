@@ -5,37 +5,161 @@ WebSockets server that listens to messages from the Raspberry Pis and calls the
 
 import os
 # import ssl
+import hmac
 import json
 import asyncio
+import functools
+import traceback
 import websockets
+from http import HTTPStatus
 from pathlib import Path
 from fnmatch import fnmatch
-import multiprocessing as mp
+from urllib.parse import urlsplit, parse_qs
 
-from main import Main
-from utils.logger import logger
+from main import Main, load_config
+from utils import framing
+from utils.logger import logger, log_shipper
+from utils.metrics import Metrics
+from utils.startup import Startup
+from utils.chunks import ChunkAssembler
+from utils.pipeline import Pipeline, queue_wait
+from utils.dispatcher import Dispatcher
+from utils.postgres import AsyncPostgres
 
 
 class WebSockets:
     def __init__(self):
         self.loop = asyncio.get_event_loop()
-        self.main = Main(base_img_path=Path(__file__).resolve().parents[1].joinpath("images"))
-        self.img_meta = {}
+        self.config = load_config()
         self.port = 6000
 
+        # Main is loaded after the server started listening, so health checks can report the progress of the startup
+        self.startup = Startup(logger)
+        self.ready = asyncio.Event()
+        # Set together with `ready` if Main could not be loaded, so waiting connections are closed instead of hanging
+        self.failed = False
+        self.main = None
+        self.dispatcher = None
+        self.postgres = None
+        self.img_meta = {}
+
+        # Metrics are served on a separate port, so they can be scraped without a WebSocket handshake
+        self.metrics = Metrics()
+        if self.config["METRICS"]["ENABLED"]:
+            metrics_port = self.metrics.serve(self.config["METRICS"]["PORT"])
+            print(f"Metrics are served on port {metrics_port}.")
+
         # ssl_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
         # localhost_pem = Path(__file__).parent.parent.joinpath("ssl", "cert.pem")
         # ssl_context.load_cert_chain(localhost_pem)
 
-        start_server = websockets.serve(self.listen, "0.0.0.0", self.port, max_size=2048576, max_queue=None)
+        # Larger images are uploaded in chunks, the bounded queue applies backpressure instead of buffering every frame
+        start_server = websockets.serve(
+            self.listen, "0.0.0.0", self.port, max_size=2048576, max_queue=self.config["UPLOAD"]["MAX_QUEUE"],
+            process_request=self.process_request
+        )
         print(f"SorterBot Cloud WebSocket server starting on port {self.port}.")
         self.loop.run_until_complete(start_server)
-        self.loop.run_forever()
+        self.loop.create_task(self.load())
+        try:
+            self.loop.run_forever()
+        finally:
+            if self.dispatcher:
+                self.dispatcher.shutdown()
+            if self.postgres:
+                self.postgres.shutdown()
+            if self.main:
+                self.main.shutdown()
+            self.metrics.shutdown()
+
+    async def load(self):
+        """
+        Loads Main and its models in a separate thread, then creates the dispatcher. Messages are only handled
+        after this is finished. If loading fails, the service is marked failed and connections are closed.
+        With a process pool dispatcher, the models are only loaded by the worker processes.
+
+        """
+
+        role = "server" if self.config["DISPATCHER"]["EXECUTOR"] == "process" else "standalone"
+        try:
+            self.main = await self.loop.run_in_executor(
+                None, functools.partial(Main, base_img_path=Path(__file__).resolve().parents[1].joinpath("images"), startup=self.startup, role=role)
+            )
+        except Exception as error:
+            traceback.print_exc()
+            self.startup.set_failed(error)
+            self.failed = True
+            self.ready.set()
+            return
+
+        # Run the CPU-bound handlers off the event loop, so one arm's inference doesn't block the others
+        self.dispatcher = Dispatcher(
+            main=self.main,
+            executor_type=self.main.config["DISPATCHER"]["EXECUTOR"],
+            max_workers=self.main.config["DISPATCHER"]["MAX_WORKERS"]
+        )
+        self.postgres = AsyncPostgres(self.main.postgres)
+        self.metrics.add_timings(self.main.timings)
+        self.metrics.add_collector(self.collect_metrics)
+        self.ready.set()
+
+    async def process_request(self, path, request_headers):
+        """
+        Answers plain HTTP requests before the WebSocket handshake. Health checks are sent to `/health`, which
+        responds with 200 when the models are loaded and warmed up, otherwise with 503. The body contains the status
+        and the durations of the startup phases, see `Startup.status`, and the counters of the log shipper. When Main is loaded, `/timings` returns the
+        histograms of the stage durations and `/timeline/[ARM_ID]/[SESSION_ID]` the spans of a session as a Chrome
+        trace, or as a list of spans with the `format=timeline` query parameter. Since they expose the ids of the arms
+        and sessions, these two require an `Authorization: Bearer [ADMIN_TOKEN]` header, otherwise they respond with 403.
+
+        Parameters
+        ----------
+        path : str
+            Path of the request.
+        request_headers : Headers
+            Headers of the request.
+
+        Returns
+        -------
+        response : tuple
+            Status, headers and body of the response, or None to continue with the WebSocket handshake.
+
+        """
+
+        url = urlsplit(path)
+        parts = url.path.strip("/").split("/")
+        is_admin_path = url.path == "/timings" or (parts[0] == "timeline" and len(parts) == 3)
+
+        if is_admin_path and not self.is_admin(request_headers.get("Authorization", "")[len("Bearer "):]):
+            http_status, body = HTTPStatus.FORBIDDEN, {"error": "A valid admin token is required."}
+        elif url.path == "/health":
+            status = self.startup.status()
+            http_status = HTTPStatus.OK if status["status"] == "ready" and self.ready.is_set() and not self.failed else HTTPStatus.SERVICE_UNAVAILABLE
+            body = dict(status, log_shipper=log_shipper.stats() if log_shipper else None)
+        elif url.path == "/timings" and self.main:
+            http_status, body = HTTPStatus.OK, self.main.timings.summary()
+        elif parts[0] == "timeline" and len(parts) == 3 and self.main:
+            if parse_qs(url.query).get("format") == ["timeline"]:
+                body = self.main.timings.timeline(parts[1], parts[2])
+            else:
+                body = self.main.timings.chrome_trace(parts[1], parts[2])
+            http_status = HTTPStatus.OK
+        else:
+            return None
+
+        return http_status, [("Content-Type", "application/json")], json.dumps(body).encode()
 
     async def listen(self, websocket, path):
         """
         Function that listens to new WebSocket messages. It can handle bytes and JSON messages.
-        Supported message types: recv_img_proc, recv_img_after, get_commands_of_session, stitch_after_image.
+        Supported message types: recv_img_proc, recv_img_after, get_commands_of_session, stitch_after_image, get_stitch_status
+        and set_profiling. set_profiling enables or disables profiling for an `arm_id`, a `session_id` of an arm, or
+        everything, and is only accepted if its `token` matches the ADMIN_TOKEN environment variable.
+        The handlers are executed by the dispatcher, so messages of other arms can be processed in the meantime.
+        Images can also be uploaded in chunks, in which case the image is processed when its last chunk arrives and
+        only that chunk is answered, even if the upload is rejected. If a recv_img_proc message has a `request_id` header, the image is processed by the
+        connection's pipeline, so the Pi can send the next image without waiting. It's answered with
+        `{"request_id": ..., "success": ...}` when it's finished, which can be out of order.
 
         Parameters
         ----------
@@ -45,60 +169,274 @@ class WebSockets:
             Unused.
         """
 
-        async for message in websocket:
-            if isinstance(message, bytes):
-                # Split headers from the image
-                split_msg = message.split(b"___SPLIT___")
-                headers = json.loads(split_msg[0])
-                content = split_msg[1]
-                # Handle case when message contains bytes asspended to JSON headers
-                if headers["command"] == "recv_img_proc":
-                    # Detect objects on image and save bounding boxes to the database
-                    success = self.main.process_image(
-                        arm_id=headers["arm_id"],
-                        session_id=headers["session_id"],
-                        image_name=headers["image_name"],
-                        img_bytes=content
-                    )
-                    # Send back to Raspberry if processing was successful
-                    await websocket.send(json.dumps(success))
-                elif headers["command"] == "recv_img_after":
-                    img_disk_path = Path(self.main.base_img_path).joinpath(headers["session_id"], "after", headers["image_name"])
-                    img_s3_path = f'{headers["arm_id"]}/{headers["session_id"]}/after_{headers["image_name"]}'
-                    success = self.main.save_and_upload_image(img_disk_path, img_s3_path, content, {})
-                    # Send back to Raspberry if processing was successful
-                    await websocket.send(json.dumps(success))
+        # Connections are accepted during startup, but messages are handled only when the models are loaded, or closed if loading failed
+        await self.ready.wait()
+        if self.failed:
+            await websocket.send(json.dumps(False))
+            await websocket.close(code=1011, reason="Service failed to start.")
+            return
 
-            else:
-                # Handle case with only JSON data
-                message = json.loads(message)
+        # Buffers of the images uploaded in chunks on this connection
+        chunks = ChunkAssembler(
+            max_size=self.main.config["UPLOAD"]["MAX_IMAGE_MB"] * 2 ** 20,
+            max_pending=self.main.config["UPLOAD"]["MAX_PENDING"]
+        )
+        # Pipeline of the images sent with a request id, created when the first one arrives
+        pipeline = None
 
-                if message["command"] == "get_commands_of_session":
-                    # Process session images to get commands
-                    commands, _, stitching_process = self.main.vectorize_session_images(message["arm_constants"], message["session_id"])
+        try:
+            async for message in websocket:
+                if isinstance(message, bytes):
+                    # Separate headers from the image without copying it, legacy framing is still accepted
+                    headers = None
+                    try:
+                        headers, content = framing.decode(message)
+                        if chunks.is_chunk(headers):
+                            content = chunks.add(headers, content)
+                    except (ValueError, KeyError) as error:
+                        print("Binary message could not be parsed:", error)
+                        # Pipelined clients match the replies by request id, so the rejection has to carry it
+                        if isinstance(headers, dict) and "request_id" in headers:
+                            await websocket.send(json.dumps({"request_id": headers["request_id"], "success": False}))
+                        else:
+                            await websocket.send(json.dumps(False))
+                        continue
 
-                    # Send back to calculated commands
-                    await websocket.send(json.dumps(commands))
+                    # Wait for the rest of the image
+                    if content is None:
+                        continue
+                    self.count_command(headers["command"])
+
+                    # Handle case when message contains bytes asspended to JSON headers
+                    if headers["command"] == "recv_img_proc" and "request_id" in headers:
+                        # Accept the image and process it in the background, waits only if the pipeline is full
+                        if pipeline is None:
+                            pipeline = self.create_pipeline(websocket)
+                        await pipeline.submit(headers["request_id"], {"headers": headers, "content": content})
+                    elif headers["command"] == "recv_img_proc":
+                        # Create table for the session without occupying an inference worker, it's a no-op after the first image
+                        await self.postgres.create_table(schema_name=headers["arm_id"], table_name=headers["session_id"])
+
+                        # Detect objects on image and save bounding boxes to the database
+                        success = await self.dispatcher.run(
+                            headers["arm_id"],
+                            "process_image",
+                            arm_id=headers["arm_id"],
+                            session_id=headers["session_id"],
+                            image_name=headers["image_name"],
+                            img_bytes=content
+                        )
+                        # Send back to Raspberry if processing was successful
+                        await websocket.send(json.dumps(success))
+                    elif headers["command"] == "recv_img_after":
+                        img_disk_path = Path(self.main.base_img_path).joinpath(headers["session_id"], "after", headers["image_name"])
+                        img_s3_path = f'{headers["arm_id"]}/{headers["session_id"]}/after_{headers["image_name"]}'
+                        success = await self.dispatcher.run(
+                            headers["arm_id"],
+                            "save_and_upload_image",
+                            img_path=img_disk_path,
+                            s3_path=img_s3_path,
+                            img_bytes=content,
+                            log_args={}
+                        )
+                        # Send back to Raspberry if processing was successful
+                        await websocket.send(json.dumps(success))
 
-                    # Join to process used for stitching here to avoid unneccesary waiting
-                    # stitching_process.join()
-                elif message["command"] == "stitch_after_image":
-                    try:
-                        img_disk_path = Path(self.main.base_img_path).joinpath(message["session_id"], "after")
-                        after_images = []
-                        for path, subdirs, files in os.walk(img_disk_path):
-                            for name in files:
-                                if fnmatch(name, "*.jpg"):
-                                    after_images.append(name)
-
-                        # stitching_process = mp.Process(target=self.main.stitch_images, args=(message["arm_id"], message["session_id"], "after", after_images))
-                        # stitching_process.start()
-                        # stitching_process.join()
-                        self.main.stitch_images(message["arm_id"], message["session_id"], "after", after_images)
-                    except Exception as e:
-                        print("stitch_after_image", e)
                 else:
-                    print("A message arrived with a payload that was not JSON parsable and there was no handler for it.")
+                    # Handle case with only JSON data
+                    message = json.loads(message)
+                    self.count_command(message["command"])
+
+                    if message["command"] == "get_commands_of_session":
+                        # Images still in the pipeline have to be saved to the database before generating the commands
+                        if pipeline is not None:
+                            await pipeline.join()
+
+                        # Process session images to get commands
+                        generate_commands = self.dispatcher.run(
+                            message["arm_constants"]["arm_id"],
+                            "vectorize_session_images",
+                            arm_constants=message["arm_constants"],
+                            session_id=message["session_id"],
+                            should_stitch=self.main.role == "standalone"
+                        )
+                        if self.main.role == "standalone":
+                            commands, _, _ = await generate_commands
+                        else:
+                            # Worker processes have no stitching pool, the job is submitted here, so its status can be queried
+                            (commands, _, _), _ = await asyncio.gather(generate_commands, self.loop.run_in_executor(
+                                None, self.main.stitch_session, message["arm_constants"]["arm_id"], message["session_id"]
+                            ))
+
+                        # Send back to calculated commands, stitching continues in the background
+                        await websocket.send(json.dumps(commands))
+                    elif message["command"] == "stitch_after_image":
+                        try:
+                            img_disk_path = Path(self.main.base_img_path).joinpath(message["session_id"], "after")
+                            after_images = []
+                            for path, subdirs, files in os.walk(img_disk_path):
+                                for name in files:
+                                    if fnmatch(name, "*.jpg"):
+                                        after_images.append(name)
+
+                            # Submit stitching job to the stitching pool and reply immediately with its status
+                            stitching_job = self.main.stitch_images(message["arm_id"], message["session_id"], "after", after_images)
+                            await websocket.send(json.dumps(stitching_job))
+                        except Exception as e:
+                            print("stitch_after_image", e)
+                    elif message["command"] == "get_stitch_status":
+                        # Send back the status and duration of the stitching jobs of the session
+                        await websocket.send(json.dumps(self.main.stitcher.get_status(message["arm_id"], message["session_id"])))
+                    elif message["command"] == "set_profiling":
+                        # Admin command, the profiler of worker processes is not affected in case of a process pool dispatcher
+                        if self.is_admin(message.get("token", "")):
+                            self.main.profiler.set_enabled(message["enabled"], message.get("arm_id"), message.get("session_id"))
+                            await websocket.send(json.dumps(self.main.profiler.status()))
+                        else:
+                            await websocket.send(json.dumps(False))
+                    else:
+                        print("A message arrived with a payload that was not JSON parsable and there was no handler for it.")
+        finally:
+            # Images which were already received are processed even if the connection is closed
+            if pipeline is not None:
+                await pipeline.join()
+                await pipeline.close()
+
+    @staticmethod
+    def is_admin(token):
+        """
+        Checks a token of an admin request. Admin requests are rejected if the ADMIN_TOKEN environment variable is not set.
+
+        Parameters
+        ----------
+        token : str
+            The token sent with the request.
+
+        Returns
+        -------
+        is_admin : bool
+            True if the token matches ADMIN_TOKEN.
+
+        """
+
+        admin_token = os.getenv("ADMIN_TOKEN")
+        return bool(admin_token) and hmac.compare_digest(str(token).encode(), admin_token.encode())
+
+    def count_command(self, command):
+        """
+        Increments the request counter of a command.
+
+        Parameters
+        ----------
+        command : str
+            The command of the message, like `recv_img_proc`.
+
+        """
+
+        self.metrics.inc("requests_total", "Number of WebSocket messages per command.", command=command)
+
+    def collect_metrics(self):
+        """
+        Collects the saturation signals of the service when the metrics are scraped. With a process pool dispatcher,
+        the image cache of the worker processes is not included.
+
+        Returns
+        -------
+        metrics : list
+            List of (name, type, description, samples) tuples, see `Metrics.add_collector`.
+
+        """
+
+        dispatcher = self.dispatcher.stats()
+        uploader = self.main.uploader.stats()
+        pool = self.main.postgres.pool_stats()
+        image_cache = self.main.image_cache.stats()
+        frame_store = self.main.frame_store.stats()
+
+        metrics = [
+            ("executor_jobs", "gauge", "Number of jobs of the executors by state.", [
+                ({"executor": "dispatcher", "state": "waiting"}, dispatcher["waiting"]),
+                ({"executor": "dispatcher", "state": "in_flight"}, dispatcher["in_flight"]),
+                ({"executor": "dispatcher", "state": "queued"}, dispatcher["queued"]),
+                ({"executor": "uploader", "state": "queued"}, uploader["queued"]),
+                ({"executor": "stitcher", "state": "pending"}, self.main.stitcher.stats()["pending"])
+            ]),
+            ("executor_workers", "gauge", "Number of workers of the dispatcher.", [({"executor": "dispatcher"}, dispatcher["workers"])]),
+            ("postgres_connections", "gauge", "Utilization of the Postgres connection pool.", [
+                ({"state": "in_use"}, pool["in_use"]),
+                ({"state": "waiting"}, pool["waiting"]),
+                ({"state": "max"}, pool["max"])
+            ]),
+            ("image_cache_bytes", "gauge", "Size of the decoded images in the image cache.", [({}, image_cache["resident_bytes"])]),
+            ("image_cache_images", "gauge", "Number of decoded images in the image cache.", [({}, image_cache["images"])]),
+            ("frame_store_bytes", "gauge", "Size of the published frames on disk.", [({}, frame_store["bytes"])]),
+            ("uploads_total", "counter", "Number of uploads to s3 by result.", [
+                ({"result": result}, uploader[result]) for result in ("uploaded", "retried", "failed")
+            ])
+        ]
+
+        if log_shipper:
+            stats = log_shipper.stats()
+            metrics.append(("log_records_total", "counter", "Number of log records sent to the Control Panel by result.", [
+                ({"result": result}, stats[result]) for result in ("sent", "dropped", "sampled_out", "failed")
+            ]))
+
+        return metrics
+
+    def create_pipeline(self, websocket):
+        """
+        Creates the image pipeline of a connection. Images are decoded, then objects are detected on them, finally
+        the results are saved. Detection has multiple workers, so the detector can batch the images in flight.
+        In case of a process pool, images are processed by a single stage, since decoded images can't be passed
+        between worker processes.
+
+        Parameters
+        ----------
+        websocket : WebSocket
+            Connection to which the results are sent.
+
+        Returns
+        -------
+        pipeline : Pipeline
+            The pipeline, accepting items with `headers` and `content` keys.
+
+        """
+
+        def image_args(item):
+            headers = item["headers"]
+            return {"arm_id": headers["arm_id"], "session_id": headers["session_id"], "image_name": headers["image_name"]}
+
+        async def decode(item):
+            item["img"] = await self.dispatcher.execute(
+                "decode_image", img_bytes=item["content"], queue_wait=queue_wait.get(), **image_args(item)
+            )
+            return item
+
+        async def detect(item):
+            item["results"] = await self.dispatcher.execute(
+                "detect_objects", img=item["img"], queue_wait=queue_wait.get(), **image_args(item)
+            )
+            return item
+
+        async def persist(item):
+            return await self.dispatcher.execute(
+                "persist_results", img=item["img"], img_bytes=item["content"], results=item["results"], queue_wait=queue_wait.get(),
+                **image_args(item)
+            )
+
+        async def process(item):
+            return await self.dispatcher.execute("process_image", img_bytes=item["content"], queue_wait=queue_wait.get(), **image_args(item))
+
+        async def send_result(request_id, result):
+            await websocket.send(json.dumps({"request_id": request_id, "success": result is True}))
+
+        config = self.main.config["PIPELINE"]
+        if self.dispatcher.executor_type == "thread":
+            stages = [("decode", decode, 1), ("detect", detect, config["DETECT_WORKERS"]), ("persist", persist, 1)]
+        else:
+            stages = [("process", process, self.dispatcher.max_workers)]
+
+        return Pipeline(stages, on_done=send_result, queue_size=config["QUEUE_SIZE"])
 
 
 if __name__ == "__main__":
@@ -0,0 +1,363 @@
+"""
+Incremental stitching, which registers each image to its neighbors as soon as it arrives, so at the end of the session
+the panorama can be composed from the cached transforms without running the full OpenCV stitching pipeline.
+
+"""
+
+import cv2
+import time
+import threading
+import numpy as np
+from pathlib import Path
+from collections import OrderedDict
+
+from utils.frame_store import attach
+from stitcher.output import save_panorama
+
+
+class IncrementalStitcher:
+    """
+    Extracts ORB features of each image of a session when it arrives and estimates the affine transform between it and
+    its neighbors. Since the image names are the base angles of the arm, images only have to be matched with the closest
+    angles below and above, instead of matching all pairs. Features and transforms of the most recent sessions are cached.
+
+    Parameters
+    ----------
+    scale : float, optional
+        Images are downscaled with this factor before feature extraction.
+    n_features : int, optional
+        Maximum number of ORB features extracted from an image.
+    min_inliers : int, optional
+        Minimum number of RANSAC inliers for a transform to be accepted.
+    max_sessions : int, optional
+        Number of sessions kept in the cache, the least recently used sessions are evicted above this limit. Sessions are
+        released when their panorama is stitched, so it should be at least the number of arms sending images at the same time.
+    logger_instance : logger, optional
+        Logger used to warn when a session is evicted before its panorama was stitched.
+
+    """
+
+    def __init__(self, scale=0.5, n_features=2000, min_inliers=20, max_sessions=8, logger_instance=None):
+        self.scale = scale
+        self.logger = logger_instance
+        self.min_inliers = min_inliers
+        self.max_sessions = max_sessions
+        self.orb = cv2.ORB_create(nfeatures=n_features)
+        self.matcher = cv2.BFMatcher(cv2.NORM_HAMMING)
+
+        self.lock = threading.Lock()
+        # (arm_id, session_id) -> {"features": {angle: (points, descriptors)}, "transforms": {(lower_angle, upper_angle): matrix}}
+        self.sessions = OrderedDict()
+
+    def add_image(self, arm_id, session_id, image_name, img):
+        """
+        Extracts the features of a new image and registers it to the closest images already received on both sides.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        image_name : str
+            Name of the image, which is the base angle of the arm when the image was taken.
+        img : np.array
+            Decoded image in BGR format.
+
+        """
+
+        angle = int(Path(image_name).stem)
+
+        # Detect features on a downscaled grayscale image, then scale keypoints back to full resolution
+        gray = cv2.cvtColor(cv2.resize(img, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA), cv2.COLOR_BGR2GRAY)
+        keypoints, descriptors = self.orb.detectAndCompute(gray, None)
+        points = np.array([keypoint.pt for keypoint in keypoints], dtype=np.float32).reshape(-1, 2) / self.scale
+
+        with self.lock:
+            session = self.sessions.setdefault((arm_id, session_id), {"features": {}, "transforms": {}})
+            self.sessions.move_to_end((arm_id, session_id))
+            evicted = [self.sessions.popitem(last=False)[0] for _ in range(len(self.sessions) - self.max_sessions)]
+
+            session["features"][angle] = (points, descriptors)
+            lower = max((other for other in session["features"] if other < angle), default=None)
+            upper = min((other for other in session["features"] if other > angle), default=None)
+            neighbors = {other: session["features"][other] for other in (lower, upper) if other is not None}
+
+        # Sessions are released when they are stitched, so evicted sessions fall back to the full stitching pipeline
+        for evicted_arm_id, evicted_session_id in evicted:
+            message = (
+                f"Features of session '{evicted_session_id}' of arm '{evicted_arm_id}' were evicted before stitching, "
+                "consider increasing max_sessions."
+            )
+            if self.logger:
+                self.logger.warning(message)
+            else:
+                print(message)
+
+        # Register to neighbors outside of the lock, matching is the expensive part
+        for other, other_features in neighbors.items():
+            pair = (min(angle, other), max(angle, other))
+            if other < angle:
+                transform = self.register(other_features, (points, descriptors))
+            else:
+                transform = self.register((points, descriptors), other_features)
+
+            with self.lock:
+                session["transforms"][pair] = transform
+
+    def register(self, lower_features, upper_features):
+        """
+        Estimates the affine transform which maps points of the upper image to the lower image.
+
+        Parameters
+        ----------
+        lower_features : tuple
+            Points and descriptors of the image with the smaller angle.
+        upper_features : tuple
+            Points and descriptors of the image with the bigger angle.
+
+        Returns
+        -------
+        transform : np.array
+            Matrix of shape (3, 3), or None if the images could not be registered.
+
+        """
+
+        (lower_points, lower_descriptors), (upper_points, upper_descriptors) = lower_features, upper_features
+        if lower_descriptors is None or upper_descriptors is None or len(lower_descriptors) < 2 or len(upper_descriptors) < 2:
+            return None
+
+        # Keep matches passing Lowe's ratio test
+        matches = [
+            pair[0] for pair in self.matcher.knnMatch(upper_descriptors, lower_descriptors, k=2)
+            if len(pair) == 2 and pair[0].distance < 0.75 * pair[1].distance
+        ]
+        if len(matches) < self.min_inliers:
+            return None
+
+        source = upper_points[[match.queryIdx for match in matches]]
+        destination = lower_points[[match.trainIdx for match in matches]]
+        affine, inliers = cv2.estimateAffinePartial2D(source, destination, method=cv2.RANSAC, ransacReprojThreshold=3.0)
+        if affine is None or inliers.sum() < self.min_inliers:
+            return None
+
+        return np.vstack([affine, [0, 0, 1]])
+
+    def get_transforms(self, arm_id, session_id, image_names):
+        """
+        Composes the cached pairwise transforms into transforms to the middle image of the panorama.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        image_names : list
+            Names of the images to be stitched. Images taken at the same angles as the originals (like the `after` images)
+            can use the same transforms.
+
+        Returns
+        -------
+        transforms : dict
+            Dict mapping each image name to a matrix of shape (3, 3), which maps the image into the coordinate system of the
+            middle image. None if any of the neighboring pairs is missing or could not be registered.
+
+        """
+
+        names_by_angle = sorted(image_names, key=lambda image_name: int(Path(image_name).stem))
+        angles = [int(Path(image_name).stem) for image_name in names_by_angle]
+
+        with self.lock:
+            session = self.sessions.get((arm_id, session_id))
+            if session is None or len(angles) == 0:
+                return None
+            pairwise = [session["transforms"].get((lower, upper)) for lower, upper in zip(angles, angles[1:])]
+
+        if any(transform is None for transform in pairwise):
+            return None
+
+        # Chain transforms outwards from the middle image
+        middle = len(angles) // 2
+        chained = [None] * len(angles)
+        chained[middle] = np.eye(3)
+        for idx in range(middle + 1, len(angles)):
+            chained[idx] = chained[idx - 1] @ pairwise[idx - 1]
+        for idx in range(middle - 1, -1, -1):
+            chained[idx] = chained[idx + 1] @ np.linalg.inv(pairwise[idx])
+
+        return dict(zip(names_by_angle, chained))
+
+    def release(self, arm_id, session_id):
+        """
+        Removes the cached features and transforms of a session.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+
+        """
+
+        with self.lock:
+            self.sessions.pop((arm_id, session_id), None)
+
+
+def compose_panorama(
+    base_img_path, session_id, stitch_type, images_with_objects, transforms, max_canvas_ratio=8, max_output_side=None, jpeg_quality=95,
+    frames=None
+):
+    """
+    Composes a panorama from images using precomputed transforms, blending the overlapping areas with feathering.
+    Bounding boxes are drawn on the images in case of `original` stitch type, and the images are saved to the
+    `bboxes_[stitch_type]` folder. Module level function, so it can be executed in a worker process. Returns the same
+    result as `stitcher.stitch_images`.
+
+    Parameters
+    ----------
+    base_img_path : str
+        Location where the images are stored.
+    session_id : str
+        Unique identifier of the session.
+    stitch_type : str
+        Type of stitch which will be prepended to the file name. Possible values: original and after.
+    images_with_objects : list
+        Images to be stitched, see `stitcher.stitch_images`.
+    transforms : dict
+        Dict mapping each image name to its transform, as returned by `IncrementalStitcher.get_transforms`.
+    max_canvas_ratio : int, optional
+        Composing fails if the panorama's area would be larger than this many times the total area of the images,
+        which means the transforms are degenerate.
+    max_output_side : int, optional
+        Maximum length of the longer side of the saved panorama in pixels, see `output.save_panorama`.
+    jpeg_quality : int, optional
+        Quality of the saved panorama, between 0 and 100.
+    frames : dict, optional
+        Dict mapping names of original images to their published frames, see `stitcher.stitch_images`.
+
+    Returns
+    -------
+    result : dict
+        Dict containing `success`, the `stitched_path` if stitching was successful, the time spent on drawing the
+        bounding boxes (`drawing_duration`) and the total `duration` in seconds.
+
+    """
+
+    start = time.monotonic()
+    frames = frames or {}
+
+    # Open images, draw bounding boxes then save them to a new directory, like the full stitching pipeline does
+    images = []
+    for image in images_with_objects:
+        image_name = image["image_name"] if stitch_type == "original" else image
+        if stitch_type == "original" and image_name in frames:
+            # Frames are read-only, copy them only if bounding boxes have to be drawn
+            img = attach(frames[image_name])
+            if len(image["bboxes"]) > 0:
+                img = np.array(img)
+        else:
+            img = cv2.imread(Path(base_img_path).joinpath(session_id, stitch_type, image_name).as_posix())
+        if stitch_type == "original":
+            for x1, y1, x2, y2 in image["bboxes"].tolist():
+                cv2.rectangle(img, (x1, y1), (x2, y2), (255, 0, 0), 2)
+        cv2.imwrite(Path(base_img_path).joinpath(session_id, f"bboxes_{stitch_type}", image_name).as_posix(), img)
+        images.append((img, transforms[image_name]))
+
+    drawing_duration = time.monotonic() - start
+
+    # Find the bounds of the panorama by transforming the corners of the images
+    corners = []
+    for img, transform in images:
+        height, width = img.shape[:2]
+        img_corners = np.array([[0, 0, 1], [width, 0, 1], [0, height, 1], [width, height, 1]], dtype=np.float64)
+        corners.append((img_corners @ transform.T)[:, :2])
+    min_x, min_y = np.floor(np.concatenate(corners).min(axis=0)).astype(int)
+    max_x, max_y = np.ceil(np.concatenate(corners).max(axis=0)).astype(int)
+    canvas_width, canvas_height = max_x - min_x, max_y - min_y
+
+    total_area = sum(img.shape[0] * img.shape[1] for img, _ in images)
+    if canvas_width * canvas_height > max_canvas_ratio * total_area:
+        return {"success": False, "stitched_path": None, "drawing_duration": drawing_duration, "duration": time.monotonic() - start}
+
+    # Warp each image only to its own tile of the canvas, and blend it into the panorama with the weights of the images
+    # already blended there, weighting pixels by their distance from the edge of their image. The panorama is the only
+    # array as large as the canvas.
+    panorama = np.zeros((canvas_height, canvas_width, 3), dtype=np.uint8)
+    blended = []
+    for (img, transform), img_corners in zip(images, corners):
+        x1, y1 = np.maximum(np.floor(img_corners.min(axis=0)).astype(int) - (min_x, min_y), 0)
+        x2, y2 = np.minimum(np.ceil(img_corners.max(axis=0)).astype(int) - (min_x, min_y), (canvas_width, canvas_height))
+        tile = (x1, y1, x2, y2)
+        matrix = np.array([[1, 0, -min_x], [0, 1, -min_y], [0, 0, 1]], dtype=np.float64) @ transform
+        weight = feather_weight(img.shape[:2])
+
+        warped = warp_to_tile(img, matrix, tile)
+        warped_weight = warp_to_tile(weight, matrix, tile)
+
+        # Sum of the weights of the images already blended into the tile
+        previous_weight = np.zeros_like(warped_weight)
+        for other_tile, other_matrix, other_weight in blended:
+            if other_tile[0] < x2 and x1 < other_tile[2] and other_tile[1] < y2 and y1 < other_tile[3]:
+                previous_weight += warp_to_tile(other_weight, other_matrix, tile)
+
+        total_weight = previous_weight + warped_weight
+        alpha = np.divide(warped_weight, total_weight, out=np.zeros_like(total_weight), where=total_weight > 0)[:, :, None]
+        region = panorama[y1:y2, x1:x2]
+        region[:] = (region * (1 - alpha) + warped * alpha).round().astype(np.uint8)
+
+        blended.append((tile, matrix, weight))
+
+    stitched_path = Path(base_img_path).joinpath(session_id, f"bboxes_{stitch_type}", f"{stitch_type}_stitch.jpg").as_posix()
+    save_panorama(stitched_path, panorama, max_output_side, jpeg_quality)
+
+    return {"success": True, "stitched_path": stitched_path, "drawing_duration": drawing_duration, "duration": time.monotonic() - start}
+
+
+def feather_weight(shape):
+    """
+    Returns the blending weight of the pixels of an image, which is their distance from the edge of the image.
+
+    Parameters
+    ----------
+    shape : tuple
+        Height and width of the image.
+
+    Returns
+    -------
+    weight : np.array
+        Array of the given shape as float32.
+
+    """
+
+    mask = np.zeros(shape, dtype=np.uint8)
+    mask[1:-1, 1:-1] = 255
+
+    return cv2.distanceTransform(mask, cv2.DIST_L2, 3)
+
+
+def warp_to_tile(img, matrix, tile):
+    """
+    Warps an image to a tile of the panorama's canvas.
+
+    Parameters
+    ----------
+    img : np.array
+        Image or weight map to be warped.
+    matrix : np.array
+        Matrix of shape (3, 3), which maps the image to the canvas.
+    tile : tuple
+        The x1, y1, x2, y2 coordinates of the tile on the canvas.
+
+    Returns
+    -------
+    warped : np.array
+        The part of the warped image within the tile.
+
+    """
+
+    x1, y1, x2, y2 = tile
+    tile_matrix = (np.array([[1, 0, -x1], [0, 1, -y1], [0, 0, 1]], dtype=np.float64) @ matrix)[:2]
+
+    return cv2.warpAffine(img, tile_matrix, (int(x2 - x1), int(y2 - y1)), flags=cv2.INTER_LINEAR)
@@ -0,0 +1,39 @@
+"""
+Saving of stitched panoramas, shared by the full and the incremental stitching paths.
+
+"""
+
+import cv2
+
+
+def save_panorama(stitched_path, panorama, max_output_side=None, jpeg_quality=95):
+    """
+    Saves a panorama as JPEG, downscaling it first if its longer side exceeds the limit.
+
+    Parameters
+    ----------
+    stitched_path : str
+        Path where the panorama is saved.
+    panorama : np.array
+        Stitched image in BGR format.
+    max_output_side : int, optional
+        Maximum length of the longer side of the saved panorama in pixels. If None or 0, the panorama is saved
+        at the resolution it was composited.
+    jpeg_quality : int, optional
+        Quality of the saved JPEG, between 0 and 100.
+
+    Returns
+    -------
+    shape : tuple
+        Height and width of the saved panorama.
+
+    """
+
+    height, width = panorama.shape[:2]
+    if max_output_side and max(height, width) > max_output_side:
+        ratio = max_output_side / max(height, width)
+        panorama = cv2.resize(panorama, (max(1, round(width * ratio)), max(1, round(height * ratio))), interpolation=cv2.INTER_AREA)
+
+    cv2.imwrite(stitched_path, panorama, [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)])
+
+    return panorama.shape[:2]
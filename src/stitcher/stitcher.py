@@ -0,0 +1,402 @@
+"""
+Stitching module, which creates panorama images of a session on a pool of worker processes, so OpenCV's work
+doesn't contend with the GIL of the server process and the arm doesn't have to wait for it.
+
+"""
+
+import os
+import cv2
+import time
+import uuid
+import threading
+import traceback
+import numpy as np
+import multiprocessing as mp
+from pathlib import Path
+from imutils import paths
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.timing import Timings
+from utils.frame_store import attach
+from stitcher.output import save_panorama
+from stitcher.incremental import compose_panorama
+
+
+def init_worker(cv_threads):
+    """
+    Initializer of the stitching processes. Lowers their priority and limits the threads used by OpenCV,
+    so stitching never starves object detection running on the same host.
+
+    Parameters
+    ----------
+    cv_threads : int
+        Number of threads OpenCV may use in each stitching process.
+
+    """
+
+    os.nice(10)
+    cv2.setNumThreads(cv_threads)
+
+
+def stitch_images(
+    base_img_path, session_id, stitch_type, images_with_objects,
+    registration_resol=0.6, seam_resol=0.1, compositing_resol=-1, max_output_side=None, jpeg_quality=95, frames=None
+):
+    """
+    Stitches together overlapping images to provide an overview on the UI about the area of interest before and after the
+    arm's operation. Module level function, so it can be executed in a worker process. Features are matched and seams
+    are estimated on downscaled copies of the images, while the panorama is warped and blended at `compositing_resol`.
+
+    Parameters
+    ----------
+    base_img_path : str
+        Location where the images are stored.
+    session_id : str
+        Datetime based unique identifier of the current session. It is generated by the Raspberry Pi and passed
+        with the POST request.
+    stitch_type : str
+        Type of stitch which will be prepended to the file name. Possible values: original and after.
+    images_with_objects : list
+        In case of `original` stitch type, list of dicts, each dictionary containing 'image_name' and 'bboxes', which is
+        an array of shape (n_objects, 4) containing the x1, y1, x2, y2 coordinates of the bounding boxes. There is one
+        entry for each unique image in a session. In case of `after` stitch type, list of image names.
+    registration_resol : float, optional
+        Resolution in megapixels at which features are matched and the transforms are estimated.
+    seam_resol : float, optional
+        Resolution in megapixels at which the seams between the images are estimated.
+    compositing_resol : float, optional
+        Resolution in megapixels at which the images are warped and blended, -1 means the original resolution.
+    max_output_side : int, optional
+        Maximum length of the longer side of the saved panorama in pixels, see `output.save_panorama`.
+    jpeg_quality : int, optional
+        Quality of the saved panorama, between 0 and 100.
+    frames : dict, optional
+        Dict mapping names of original images to their published frames. These images are attached from the frame store
+        instead of being decoded from disk.
+
+    Returns
+    -------
+    result : dict
+        Dict containing `success`, the `stitched_path` if stitching was successful, the time spent on drawing the
+        bounding boxes (`drawing_duration`) and the total `duration` in seconds.
+
+    """
+
+    start = time.monotonic()
+    frames = frames or {}
+
+    # Open images, draw bounding boxes then save them to a new directory, keeping them in memory for stitching
+    drawn_images = {}
+    for image in images_with_objects:
+        # Open image for drawing
+        if stitch_type == "original":
+            image_name = image["image_name"]
+        else:
+            image_name = image
+        if stitch_type == "original" and image_name in frames:
+            # Copy the frame, since it's read-only and shared with other processes
+            img = np.array(attach(frames[image_name]))
+        else:
+            img = cv2.imread(Path(base_img_path).joinpath(session_id, stitch_type, image_name).as_posix())
+
+        if stitch_type == "original":
+            for x1, y1, x2, y2 in image["bboxes"].tolist():
+                # Draw bounding boxes on image
+                cv2.rectangle(img, (x1, y1), (x2, y2), (255, 0, 0), 2)
+
+        # Save image (with drawn bounding boxes in case of original stitch type)
+        cv2.imwrite(Path(base_img_path).joinpath(session_id, f"bboxes_{stitch_type}", image_name).as_posix(), img)
+        drawn_images[image_name] = img
+
+    drawing_duration = time.monotonic() - start
+
+    # Use the drawn images where available, attach or read the rest of the original images
+    images_with_bb = []
+    for orig_image in sorted(list(paths.list_images(Path(base_img_path).joinpath(session_id, "original")))):
+        image_name = Path(orig_image).name
+        if image_name in drawn_images:
+            images_with_bb.append(drawn_images[image_name])
+        elif image_name in frames:
+            images_with_bb.append(attach(frames[image_name]))
+        else:
+            images_with_bb.append(cv2.imread(orig_image))
+
+    # Stitch together images with bounding boxes
+    stitcher = cv2.Stitcher_create(mode=1)
+    stitcher.setRegistrationResol(registration_resol)
+    stitcher.setSeamEstimationResol(seam_resol)
+    stitcher.setCompositingResol(compositing_resol)
+
+    (stitch_status, stitched_img) = stitcher.stitch(images_with_bb)
+
+    stitched_path = None
+    if stitch_status == 0:
+        # Save stitched image to disk
+        stitched_path = Path(base_img_path).joinpath(session_id, f"bboxes_{stitch_type}", f"{stitch_type}_stitch.jpg").as_posix()
+        save_panorama(stitched_path, stitched_img, max_output_side, jpeg_quality)
+
+    return {
+        "success": stitch_status == 0,
+        "stitched_path": stitched_path,
+        "drawing_duration": drawing_duration,
+        "duration": time.monotonic() - start
+    }
+
+
+class StitchingPool:
+    """
+    Runs stitching jobs on a pool of worker processes and keeps track of their status. The number of processes and
+    the number of jobs waiting for a free process are both limited, jobs submitted above this limit are rejected.
+
+    Parameters
+    ----------
+    base_img_path : str
+        Location where the images are stored.
+    logger_instance : logger
+        Logger instance passed from main.
+    uploader : Uploader
+        Uploader used to upload the stitched images to s3.
+    workers : int, optional
+        Number of images stitched at the same time.
+    max_pending : int, optional
+        Maximum number of jobs waiting for a free worker.
+    cv_threads : int, optional
+        Number of threads OpenCV may use in each worker.
+    history_size : int, optional
+        Number of finished jobs kept for status reporting.
+    options : dict, optional
+        Keyword arguments passed to `stitch_images`, like the resolutions of the stitching steps and the output settings.
+        `max_output_side` and `jpeg_quality` are passed to `compose_panorama` as well.
+    frame_store : FrameStore, optional
+        Store of the published frames. References of the frames passed to `submit` are released when the job is finished.
+    timings : Timings, optional
+        Records the duration of each job and the time it waited for a free worker as a `stitch` span.
+
+    """
+
+    def __init__(
+        self, base_img_path, logger_instance, uploader, workers=1, max_pending=4, cv_threads=2, history_size=256, options=None, frame_store=None,
+        timings=None
+    ):
+        self.base_img_path = base_img_path
+        self.logger = logger_instance
+        self.uploader = uploader
+        self.frame_store = frame_store
+        self.timings = timings or Timings()
+        self.history_size = history_size
+        self.options = options or {}
+        self.output_options = {key: value for key, value in self.options.items() if key in ("max_output_side", "jpeg_quality")}
+
+        # Spawn workers to avoid forking a process which already started Torch's threads
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(cv_threads,)
+        )
+        self.slots = threading.BoundedSemaphore(workers + max_pending)
+
+        self.jobs_lock = threading.Lock()
+        self.jobs = OrderedDict()
+
+    def submit(self, arm_id, session_id, stitch_type, images_with_objects, transforms=None, frames=None):
+        """
+        Submits a stitching job and returns immediately. The stitched image is uploaded to s3 when the job is finished.
+        If the transforms of the images are provided, the panorama is composed from them, otherwise the full
+        OpenCV stitching pipeline is executed.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Datetime based unique identifier of the current session.
+        stitch_type : str
+            Type of stitch which will be prepended to the file name. Possible values: original and after.
+        images_with_objects : list
+            Images to be stitched, see `stitch_images`.
+        transforms : dict, optional
+            Transforms of the images, as returned by `IncrementalStitcher.get_transforms`.
+        frames : dict, optional
+            Published frames of the original images, as returned by `FrameStore.acquire`. The references are
+            released when the job is finished or rejected.
+
+        Returns
+        -------
+        job : dict
+            Status of the submitted job, see `get_status`.
+
+        """
+
+        log_args = {"arm_id": arm_id, "session_id": session_id, "log_type": "comm_gen"}
+        job = {
+            "job_id": uuid.uuid4().hex,
+            "arm_id": arm_id,
+            "session_id": session_id,
+            "stitch_type": stitch_type,
+            "status": "queued",
+            "mode": "full" if transforms is None else "incremental",
+            "duration": None,
+            "submitted": time.time()
+        }
+
+        with self.jobs_lock:
+            self.jobs[job["job_id"]] = job
+            while len(self.jobs) > self.history_size:
+                self.jobs.popitem(last=False)
+
+        frames = frames or {}
+        if not self.slots.acquire(blocking=False):
+            self.release_frames(arm_id, session_id, frames)
+            self.set_status(job, "rejected")
+            self.logger.warning("Too many stitching jobs are running, stitching skipped.", log_args)
+            return dict(job)
+
+        self.logger.info("Stitching images started.", dict(bm_id=11, **log_args))
+        submitted = time.monotonic()
+        try:
+            if transforms is None:
+                future = self.executor.submit(stitch_images, self.base_img_path, session_id, stitch_type, images_with_objects, frames=frames, **self.options)
+            else:
+                future = self.executor.submit(
+                    compose_panorama, self.base_img_path, session_id, stitch_type, images_with_objects, transforms, frames=frames, **self.output_options
+                )
+        except Exception:
+            # Eg. the pool is broken after a worker crashed or it's shut down, the slot and the frames are given back
+            traceback.print_exc()
+            self.slots.release()
+            self.release_frames(arm_id, session_id, frames)
+            self.set_status(job, "failed")
+            self.logger.error("Stitching job could not be submitted!", log_args)
+            return dict(job)
+        future.add_done_callback(lambda future: self.finish(job, future, log_args, frames, submitted))
+
+        # The job may be finished already, the callback changes it under the lock
+        with self.jobs_lock:
+            return dict(job)
+
+    def finish(self, job, future, log_args, frames, submitted):
+        """
+        Callback executed when a stitching job is finished. Logs the results and uploads the stitched image.
+
+        """
+
+        self.slots.release()
+        self.release_frames(job["arm_id"], job["session_id"], frames)
+        stitch_type = job["stitch_type"]
+
+        try:
+            result = future.result()
+        except Exception:
+            traceback.print_exc()
+            self.set_status(job, "failed")
+            self.logger.error("Image stitching failed!", log_args)
+            return
+
+        with self.jobs_lock:
+            job["duration"] = result["duration"]
+
+        # The job started after waiting for a free worker, its duration was measured by the worker process
+        start = time.monotonic() - result["duration"]
+        self.timings.record(
+            "stitch", job["arm_id"], job["session_id"], result["duration"], start, f"{stitch_type}_stitch.jpg", max(start - submitted, 0.)
+        )
+        self.logger.info(
+            "Bounding boxes drawn and new images saved." if stitch_type == "original" else "New images saved.",
+            dict(bm_id=12, **log_args)
+        )
+
+        if result["success"]:
+            self.set_status(job, "done")
+            self.logger.info(f"Image stitching successful in {result['duration']:.2f} seconds.", dict(bm_id=13, **log_args))
+            log_args["log_type"] = "before" if stitch_type == "original" else "after"
+            self.logger.info("Stitched image saved to disk.", dict(bm_id=14, **log_args))
+
+            # Upload stitched image to s3 in the background, without blocking the thread delivering the results of the pool
+            s3_path = f'{job["arm_id"]}/{job["session_id"]}/{stitch_type}_stitch.jpg'
+            upload = (result["stitched_path"], s3_path, dict(bm_id=15, **log_args))
+            if not self.uploader.submit(*upload, block=False):
+                threading.Thread(target=self.uploader.submit, args=upload, name="stitch-upload", daemon=True).start()
+        else:
+            self.set_status(job, "failed")
+            self.logger.error("Image stitching failed!", log_args)
+
+    def set_status(self, job, status):
+        """
+        Changes the status of a job. Jobs are read by `get_status` and `stats` from other threads, so it's done under the lock.
+
+        Parameters
+        ----------
+        job : dict
+            The job, as created by `submit`.
+        status : str
+            The new status: done, failed or rejected.
+
+        """
+
+        with self.jobs_lock:
+            job["status"] = status
+
+    def release_frames(self, arm_id, session_id, frames):
+        """
+        Releases the references of the frames used by a job.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        frames : dict
+            Frames of the job, as returned by `FrameStore.acquire`.
+
+        """
+
+        if self.frame_store and frames:
+            self.frame_store.release(arm_id, session_id, list(frames))
+
+    def get_status(self, arm_id, session_id):
+        """
+        Returns the status of the stitching jobs of a session.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Datetime based unique identifier of the session.
+
+        Returns
+        -------
+        jobs : list
+            List of dicts containing `job_id`, `arm_id`, `session_id`, `stitch_type`, `status` (queued, done, failed or rejected),
+            `mode` (full or incremental),
+            `duration` of the stitching in seconds and the time when the job was `submitted` as a Unix timestamp.
+
+        """
+
+        with self.jobs_lock:
+            return [dict(job) for job in self.jobs.values() if job["arm_id"] == arm_id and job["session_id"] == session_id]
+
+    def stats(self):
+        """
+        Returns the number of stitching jobs which are not finished yet.
+
+        Returns
+        -------
+        stats : dict
+            Dict containing the number of `pending` jobs, which are either running or waiting for a free worker.
+
+        """
+
+        with self.jobs_lock:
+            return {"pending": sum(job["status"] == "queued" for job in self.jobs.values())}
+
+    def shutdown(self):
+        """
+        Waits for the running and queued stitching jobs to finish, then stops the worker processes.
+
+        """
+
+        self.executor.shutdown(wait=True)
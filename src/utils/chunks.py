@@ -0,0 +1,149 @@
+"""
+Reassembly of images uploaded in multiple WebSocket messages, so images larger than the maximum message size
+can be received without raising the limit for every message.
+
+"""
+
+from collections import OrderedDict
+
+
+class ChunkAssembler:
+    """
+    Collects the chunks of the uploads of a single connection into pre-sized buffers. A chunk is a binary message whose
+    headers contain `total_size`, the size of the whole image in bytes, and `offset`, the position of the chunk within it.
+    Chunks of an upload have to arrive in order, which WebSockets guarantees within a connection. The memory used by a
+    connection is bounded by `max_size` times `max_pending`. When a chunk is invalid, the upload is discarded and its
+    remaining chunks are dropped, so the upload is rejected only once, when its last chunk arrives.
+
+    Parameters
+    ----------
+    max_size : int
+        Maximum size of an uploaded image in bytes.
+    max_pending : int, optional
+        Maximum number of uploads being received at the same time on the connection.
+    max_discarded : int, optional
+        Maximum number of discarded uploads whose remaining chunks are dropped, the oldest ones are forgotten first.
+
+    """
+
+    def __init__(self, max_size, max_pending=2, max_discarded=16):
+        self.max_size = max_size
+        self.max_pending = max_pending
+        self.max_discarded = max_discarded
+        # (command, session_id, image_name) -> [buffer, number of bytes received]
+        self.uploads = {}
+        # (command, session_id, image_name) -> reason of discarding the upload
+        self.discarded = OrderedDict()
+
+    @staticmethod
+    def is_chunk(headers):
+        """
+        Returns True if the message is a chunk of an upload.
+
+        Parameters
+        ----------
+        headers : dict
+            Headers of the message.
+
+        Returns
+        -------
+        is_chunk : bool
+            True if the headers contain `total_size`.
+
+        """
+
+        return "total_size" in headers
+
+    def add(self, headers, chunk):
+        """
+        Copies a chunk into the buffer of its upload.
+
+        Parameters
+        ----------
+        headers : dict
+            Headers of the message, containing `command`, `session_id`, `image_name`, `total_size` and `offset`.
+        chunk : bytes or memoryview
+            Payload of the message.
+
+        Returns
+        -------
+        content : memoryview
+            The whole image if this was its last chunk, otherwise None.
+
+        Raises
+        ------
+        ValueError
+            On the last chunk of an upload which was discarded, because it was too large, too many uploads were pending,
+            or one of its chunks didn't continue the upload.
+
+        """
+
+        key = (headers["command"], headers["session_id"], headers["image_name"])
+        total_size, offset = int(headers["total_size"]), int(headers["offset"])
+        is_last = offset + len(chunk) >= total_size
+
+        # A new upload of the same image starts at offset 0, anything else belongs to the discarded one
+        if key in self.discarded and offset != 0:
+            if is_last:
+                raise ValueError(self.discarded.pop(key))
+            return None
+        self.discarded.pop(key, None)
+
+        try:
+            if key not in self.uploads:
+                if offset != 0:
+                    raise ValueError(f"Upload of '{key[2]}' has to start at offset 0, not {offset}.")
+                if not 0 < total_size <= self.max_size:
+                    raise ValueError(f"Upload of '{key[2]}' is {total_size} bytes, the limit is {self.max_size} bytes.")
+                if len(self.uploads) >= self.max_pending:
+                    raise ValueError(f"Too many pending uploads, '{key[2]}' is rejected.")
+                self.uploads[key] = [bytearray(total_size), 0]
+
+            buffer, received = self.uploads[key]
+            if total_size != len(buffer) or offset != received or offset + len(chunk) > len(buffer):
+                raise ValueError(f"Chunk at offset {offset} of '{key[2]}' doesn't continue the upload at {received} bytes.")
+        except ValueError as error:
+            self.uploads.pop(key, None)
+            if is_last:
+                raise
+            self.discard(key, str(error))
+            return None
+
+        buffer[offset:offset + len(chunk)] = chunk
+        self.uploads[key][1] += len(chunk)
+
+        if self.uploads[key][1] < len(buffer):
+            return None
+
+        del self.uploads[key]
+        return memoryview(buffer)
+
+    def discard(self, key, reason):
+        """
+        Remembers a discarded upload, so its remaining chunks are dropped.
+
+        Parameters
+        ----------
+        key : tuple
+            The (command, session_id, image_name) key of the upload.
+        reason : str
+            Error message, raised when the last chunk arrives.
+
+        """
+
+        self.discarded[key] = reason
+        while len(self.discarded) > self.max_discarded:
+            self.discarded.popitem(last=False)
+
+    def pending_bytes(self):
+        """
+        Returns the number of bytes allocated for the pending uploads.
+
+        Returns
+        -------
+        pending_bytes : int
+            Total size of the buffers of the pending uploads.
+
+        """
+
+        return sum(len(buffer) for buffer, _ in self.uploads.values())
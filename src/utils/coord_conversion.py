@@ -8,6 +8,16 @@ import numpy as np
 from pathlib import Path
 
 
+# Compact representation of a batch of objects in absolute polar coordinates. `polar_coords` holds servo_0 and servo_1
+# positions, `bbox` holds the x1, y1, x2, y2 coordinates of the bounding box.
+POLAR_DTYPE = np.dtype([
+    ("img_base_angle", np.int64),
+    ("obj_id", np.int64),
+    ("polar_coords", np.float64, (2,)),
+    ("bbox", np.int64, (4,)),
+])
+
+
 def object_to_polar(arm_constants, image_name, obj):
     """
     Converts bounding box coordinates relative to the image frame to absolute polar coordinates, relative to the robotic arm.
@@ -69,64 +79,222 @@ def object_to_polar(arm_constants, image_name, obj):
     }
 
 
-def filter_duplicates(objects, threshold=150):
+def _apply_math(func, values):
+    """
+    Applies a function of the `math` module elementwise. Used for transcendental functions, since NumPy's SIMD
+    implementations may differ from the platform's libm in the last bit, which would make results differ from `object_to_polar`.
+
     """
-    Filters out the bounding boxes that belong to the same object, but showed up on a different image.
+
+    return np.fromiter(map(func, values.tolist()), dtype=np.float64, count=len(values))
+
+
+def objects_to_polar(arm_constants, img_base_angles, obj_ids, img_dims, bboxes):
+    """
+    Vectorized version of `object_to_polar`, which converts all bounding boxes of a session in one pass.
+    The results are identical to calling `object_to_polar` on each object.
 
     Parameters
     ----------
-    objects : list
-        List of dicts, containing the absolute coordinates of the objects.
+    arm_constants : dict
+        Dictionary containing the arm's constants that are saved in the arm's config file and sent with the request.
+    img_base_angles : np.array
+        Array of shape (n,) containing the rotation of the image of each object, expressed in pulse width.
+    obj_ids : np.array
+        Array of shape (n,) containing the object IDs.
+    img_dims : np.array
+        Array of shape (n, 2) containing the width and height of the image of each object.
+    bboxes : np.array
+        Array of shape (n, 4) containing the x1, y1, x2, y2 coordinates of the bounding boxes.
+
+    Returns
+    -------
+    polar : np.array
+        Structured array of `POLAR_DTYPE` with one record for each object.
+
+    """
+
+    img_base_angles = np.asarray(img_base_angles, dtype=np.int64).reshape(-1)
+    img_dims = np.asarray(img_dims, dtype=np.int64).reshape(-1, 2)
+    bboxes = np.asarray(bboxes, dtype=np.int64).reshape(-1, 4)
+
+    # Retrieve image dimensions
+    half_w, half_h = img_dims[:, 0] / 2, img_dims[:, 1] / 2
+
+    # Calculate bbox center points, truncated the same way as int() does
+    x = np.trunc((bboxes[:, 0] + bboxes[:, 2]) / 2)
+    y = np.trunc((bboxes[:, 1] + bboxes[:, 3]) / 2)
+
+    # Calculate intermediate values
+    a = np.abs(half_w - x)  # Location's x distance from middle of the image
+    b = half_h - y  # Location's y distance from middle of the image
+
+    # Calculate target values as polar coordinates (gamma is target's deviance from image base angle)
+    denominator = b + arm_constants["arm_radius"]
+    if np.any(denominator == 0):
+        raise ZeroDivisionError("float division by zero")
+    gamma_rad = _apply_math(math.atan, a / denominator)
+    gamma = np.degrees(gamma_rad)
+    sin_gamma = _apply_math(math.sin, gamma_rad)
+    # Where sin(gamma) is zero, fall back to the same value as object_to_polar
+    dist = np.divide(a, sin_gamma, out=np.array(denominator, dtype=np.float64), where=sin_gamma != 0)
+
+    # Convert rotation coordinate to pulse width
+    delta_rotation_as_pw = arm_constants["rotation_range_as_pw"] * gamma / arm_constants["rotation_range_as_deg"]
+    delta_rotation_as_pw = np.where(x > half_w, -delta_rotation_as_pw, delta_rotation_as_pw)
+    servo_0_pos = img_base_angles + delta_rotation_as_pw
+
+    # Convert distance target value to servo1 position
+    dist_range_as_pw = arm_constants["dist_max_as_pw"] - arm_constants["dist_min_as_pw"]
+    r_at_bottom = arm_constants["arm_radius"] - half_h
+    servo_1_pos = (dist_range_as_pw * (dist - r_at_bottom) / img_dims[:, 1]) + arm_constants["dist_min_as_pw"]
+
+    polar = np.empty(len(bboxes), dtype=POLAR_DTYPE)
+    polar["img_base_angle"] = img_base_angles
+    polar["obj_id"] = obj_ids
+    polar["polar_coords"] = np.stack([servo_0_pos, servo_1_pos], axis=1)
+    polar["bbox"] = bboxes
+
+    return polar
+
+
+def cluster_duplicates(coords, threshold=150):
+    """
+    Groups the locations that belong to the same object, but showed up on a different image. Locations are processed in order,
+    each unprocessed location starts a new cluster, which takes all other unprocessed locations with both coordinates within
+    `threshold` (exclusive). Locations identical to the one starting the cluster are not added to it. To avoid comparing every
+    pair of locations, they are bucketed into a grid with cells of size `threshold`, so only the 9 neighboring cells have to be checked.
+
+    Parameters
+    ----------
+    coords : np.array
+        Array of shape (n, 2) containing the polar coordinates of the objects.
     threshold: int
         Distance within that objects are considered the same.
 
     Returns
     -------
-    filtered_objs : list
-        List of the absolute coordinates of the unique objects.
+    clusters : list
+        List of index arrays, one for each unique object. The first index is the location which started the cluster,
+        the rest is in ascending order.
 
     """
 
-    def in_range(loc, loc_in, idx):
-        return (loc[idx] - threshold) < loc_in[idx] and loc_in[idx] < (loc[idx] + threshold)
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    cells = np.floor(coords / threshold).astype(np.int64)
 
-    filtered_objs = []
-    for obj in objects:
-        loc = obj["polar_coords"]
+    # Build spatial index of grid cells
+    grid = {}
+    for idx, cell in enumerate(map(tuple, cells)):
+        grid.setdefault(cell, []).append(idx)
 
+    processed = np.zeros(len(coords), dtype=bool)
+    clusters = []
+    for idx in range(len(coords)):
         # Skip iteration if current location was already processed
-        if loc is None:
+        if processed[idx]:
             continue
 
-        # Initialize current cluster with outer location
-        locs_in_range = [loc]
+        # Collect unprocessed locations from the cell of the current location and its neighbors
+        cell_x, cell_y = cells[idx]
+        candidates = np.array(sorted(
+            candidate for d_x in (-1, 0, 1) for d_y in (-1, 0, 1) for candidate in grid.get((cell_x + d_x, cell_y + d_y), ())
+        ), dtype=np.int64)
+        candidates = candidates[~processed[candidates]]
 
-        # Loop through on the location once for each element to check if they belong to the same object
-        for obj_in in objects:
-            loc_in = obj_in["polar_coords"]
+        # Keep candidates with both coordinates within range, but skip the ones identical to the current location
+        loc, locs_in = coords[idx], coords[candidates]
+        in_range = ((loc - threshold) < locs_in) & (locs_in < (loc + threshold))
+        members = candidates[in_range.all(axis=1) & (locs_in != loc).any(axis=1)]
 
-            # Skip iteration if current location was already processed or is the same as the outer one
-            if loc == loc_in or loc_in is None:
-                continue
+        processed[idx] = True
+        processed[members] = True
+        clusters.append(np.concatenate(([idx], members)))
 
-            # If both coordinates are within range
-            if in_range(loc, loc_in, 0) and in_range(loc, loc_in, 1):
-                # Add item to current cluster
-                locs_in_range.append(loc_in)
-                # Remove processed inner location from locations
-                obj_in_idx = objects.index(obj_in)
-                objects[obj_in_idx]["polar_coords"] = None
+    return clusters
 
-        # Remove processed outer location from locations
-        obj_idx = objects.index(obj)
-        objects[obj_idx]["polar_coords"] = None
 
-        # Append cluster to results
+def filter_duplicates(objects, threshold=150):
+    """
+    Filters out the bounding boxes that belong to the same object, but showed up on a different image.
+    The passed objects are not modified.
+
+    Parameters
+    ----------
+    objects : list
+        List of dicts, containing the absolute coordinates of the objects.
+    threshold: int
+        Distance within that objects are considered the same.
+
+    Returns
+    -------
+    filtered_objs : list
+        List of the absolute coordinates of the unique objects.
+
+    """
+
+    coords = np.array([obj["polar_coords"] for obj in objects], dtype=np.float64).reshape(-1, 2)
+
+    filtered_objs = []
+    for cluster in cluster_duplicates(coords, threshold):
+        obj = objects[cluster[0]]
         filtered_objs.append({
             "img_base_angle": obj["img_base_angle"],
             "obj_id": obj["obj_id"],
-            "avg_polar_coords": tuple(np.average(np.array(locs_in_range), axis=0)),
+            "avg_polar_coords": tuple(np.average(coords[cluster], axis=0)),
             "bbox_dims": obj["bbox_dims"],
         })
 
     return filtered_objs
+
+
+def filter_duplicates_array(polar, threshold=150):
+    """
+    Same as `filter_duplicates`, but works on a structured array returned by `objects_to_polar`.
+
+    Parameters
+    ----------
+    polar : np.array
+        Structured array of `POLAR_DTYPE`.
+    threshold: int
+        Distance within that objects are considered the same.
+
+    Returns
+    -------
+    filtered : np.array
+        Structured array of `POLAR_DTYPE`, one record for each unique object. `polar_coords` contains the
+        average coordinates of the cluster, the other fields are taken from the first object of the cluster.
+
+    """
+
+    clusters = cluster_duplicates(polar["polar_coords"], threshold)
+
+    filtered = polar[np.array([cluster[0] for cluster in clusters], dtype=np.int64)]
+    for idx, cluster in enumerate(clusters):
+        filtered["polar_coords"][idx] = np.average(polar["polar_coords"][cluster], axis=0)
+
+    return filtered
+
+
+def polar_to_dicts(polar):
+    """
+    Converts a structured array of `POLAR_DTYPE` to the list of dicts format returned by `filter_duplicates`.
+
+    Parameters
+    ----------
+    polar : np.array
+        Structured array of `POLAR_DTYPE`.
+
+    Returns
+    -------
+    objects : list
+        List of dicts containing `img_base_angle`, `obj_id`, `avg_polar_coords` and `bbox_dims` keys.
+
+    """
+
+    return [{
+        "img_base_angle": int(record["img_base_angle"]),
+        "obj_id": int(record["obj_id"]),
+        "avg_polar_coords": tuple(record["polar_coords"].tolist()),
+        "bbox_dims": dict(zip(("x1", "y1", "x2", "y2"), record["bbox"].tolist()))
+    } for record in polar]
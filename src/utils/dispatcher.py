@@ -0,0 +1,193 @@
+"""
+Dispatcher that runs the CPU-bound handlers of Main in a bounded executor, so the asyncio event loop
+of the WebSocket server stays responsive while images are being processed.
+
+"""
+
+import asyncio
+import functools
+import multiprocessing as mp
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+
+# Main instance of a worker process, created once by the process pool's initializer
+_worker_main = None
+
+
+def _init_worker(base_img_path):
+    """
+    Initializer of the process pool's workers. Each worker process loads its own instance of Main with the `worker`
+    role, since models and database connections cannot be pickled and sent over from the parent process. Stitching
+    jobs are submitted by the parent process, so workers don't start a stitching pool.
+
+    Parameters
+    ----------
+    base_img_path : str
+        Location where the downloaded images should be stored.
+
+    """
+
+    global _worker_main
+    from main import Main
+    _worker_main = Main(base_img_path=base_img_path, role="worker")
+
+
+def _call_worker(method_name, kwargs):
+    """
+    Calls a method of the worker process' Main instance. Module level function, so it can be pickled.
+
+    """
+
+    return getattr(_worker_main, method_name)(**kwargs)
+
+
+class Dispatcher:
+    """
+    Runs methods of Main in a thread or process pool. Jobs belonging to the same arm are executed
+    strictly in the order they were submitted, while jobs of different arms run concurrently, up to
+    the number of workers of the executor.
+
+    Parameters
+    ----------
+    main : Main
+        Instance of Main, used directly by the thread pool. In case of a process pool, only its `base_img_path`
+        is used to create a separate instance in each worker, the instance itself should have the `server` role.
+    executor_type : str, optional
+        Type of the executor, either `thread` or `process`.
+    max_workers : int, optional
+        Maximum number of handlers running at the same time.
+
+    """
+
+    def __init__(self, main, executor_type="thread", max_workers=4):
+        self.main = main
+        self.executor_type = executor_type
+        self.max_workers = max_workers
+
+        if executor_type == "thread":
+            self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="dispatcher")
+        elif executor_type == "process":
+            # Spawn workers to avoid forking a process which already started Torch's threads
+            self.executor = ProcessPoolExecutor(
+                max_workers=max_workers,
+                mp_context=mp.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(main.base_img_path,)
+            )
+        else:
+            raise ValueError(f"Unknown executor type: '{executor_type}'. Possible values: thread and process.")
+
+        # One lock per arm with jobs, used to preserve the order of the jobs submitted by the same arm
+        self.arm_locks = {}
+        # Number of jobs of each arm holding or waiting for its lock, the lock is removed when it drops to zero
+        self.arm_jobs = {}
+
+        # Number of jobs waiting for the previous jobs of their arm, and submitted to the executor but not finished yet
+        self.waiting = 0
+        self.in_flight = 0
+
+    async def run(self, arm_id, method_name, **kwargs):
+        """
+        Runs a method of Main in the executor without blocking the event loop. Waits until all previously
+        submitted jobs of the same arm are finished.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm which submitted the job.
+        method_name : str
+            Name of the method of Main to be executed.
+        **kwargs
+            Keyword arguments passed to the method.
+
+        Returns
+        -------
+        result : any
+            Return value of the executed method.
+
+        """
+
+        if arm_id not in self.arm_locks:
+            self.arm_locks[arm_id] = asyncio.Lock()
+        lock = self.arm_locks[arm_id]
+        self.arm_jobs[arm_id] = self.arm_jobs.get(arm_id, 0) + 1
+
+        try:
+            self.waiting += 1
+            try:
+                await lock.acquire()
+            finally:
+                self.waiting -= 1
+
+            try:
+                return await self.execute(method_name, **kwargs)
+            finally:
+                lock.release()
+        finally:
+            # Locks of arms without jobs are removed, so the dict doesn't grow with every arm ever seen
+            self.arm_jobs[arm_id] -= 1
+            if self.arm_jobs[arm_id] == 0:
+                del self.arm_jobs[arm_id]
+                del self.arm_locks[arm_id]
+
+    async def execute(self, method_name, **kwargs):
+        """
+        Runs a method of Main in the executor without waiting for the other jobs of the arm. Used by the stages
+        of the image pipeline, which keep their own order.
+
+        Parameters
+        ----------
+        method_name : str
+            Name of the method of Main to be executed.
+        **kwargs
+            Keyword arguments passed to the method.
+
+        Returns
+        -------
+        result : any
+            Return value of the executed method.
+
+        """
+
+        loop = asyncio.get_event_loop()
+
+        if self.executor_type == "thread":
+            job = functools.partial(getattr(self.main, method_name), **kwargs)
+        else:
+            # Memoryviews can't be pickled, so payloads are copied once when they are sent to a worker process
+            kwargs = {key: bytes(value) if isinstance(value, memoryview) else value for key, value in kwargs.items()}
+            job = functools.partial(_call_worker, method_name, kwargs)
+
+        self.in_flight += 1
+        try:
+            return await loop.run_in_executor(self.executor, job)
+        finally:
+            self.in_flight -= 1
+
+    def stats(self):
+        """
+        Returns the load of the dispatcher. The counters are only modified on the event loop, so they are not locked.
+
+        Returns
+        -------
+        stats : dict
+            Dict containing the number of jobs `waiting` for the previous jobs of their arm, the number of jobs
+            `in_flight` in the executor, the number of those which are `queued` because all workers are busy, and
+            the number of `workers`.
+
+        """
+
+        return {
+            "waiting": self.waiting,
+            "in_flight": self.in_flight,
+            "queued": max(self.in_flight - self.max_workers, 0),
+            "workers": self.max_workers
+        }
+
+    def shutdown(self):
+        """
+        Waits for the running jobs to finish, then releases the resources of the executor.
+
+        """
+
+        self.executor.shutdown(wait=True)
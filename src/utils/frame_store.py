@@ -0,0 +1,366 @@
+"""
+Zero-copy transport of decoded frames between processes. Frames are published once as memory-mapped `.npy` files
+under the session's folder, then any process can attach to them by name without decoding or unpickling the image.
+
+"""
+
+import os
+import time
+import atexit
+import threading
+import numpy as np
+from pathlib import Path
+
+
+def attach(frame):
+    """
+    Maps a published frame into the memory of the current process. Module level function, so it can be used
+    by worker processes, which don't have access to the FrameStore.
+
+    Parameters
+    ----------
+    frame : str or np.array
+        Path of a published frame, as returned by `FrameStore.get`. Arrays are returned unchanged,
+        so stages can accept both decoded images and frame names.
+
+    Returns
+    -------
+    img : np.array
+        Read-only, memory-mapped image.
+
+    """
+
+    if isinstance(frame, np.ndarray):
+        return frame
+
+    return np.load(frame, mmap_mode="r")
+
+
+class FrameStore:
+    """
+    Publishes decoded frames as memory-mapped files and removes them when they are not referenced anymore.
+    References are counted by the publishing process: each stage that uses a frame, including stages running
+    in other processes, acquires a reference before the frame is handed over and releases it when finished.
+    The session holds the first reference of its frames until `release_session` is called, or until the session
+    is idle for `idle_ttl` seconds, so the frames of sessions which never finish (or which are finished by another
+    worker process) are deleted as well. The file of a frame is deleted when its last reference is released,
+    the remaining files are deleted on exit.
+
+    Parameters
+    ----------
+    base_img_path : str
+        Location where the images are stored. Frames are written to the `frames` folder of each session, in a folder of the arm.
+    idle_ttl : float, optional
+        Seconds after the last publish or acquire of a session, when the session's references are released.
+        If None, frames are only released explicitly.
+    sweep_interval : float, optional
+        Seconds between two checks of the idle sessions, done by a background thread.
+
+    """
+
+    def __init__(self, base_img_path, idle_ttl=None, sweep_interval=60):
+        self.base_img_path = base_img_path
+        self.idle_ttl = idle_ttl
+
+        self.lock = threading.Lock()
+        # (arm_id, session_id, image_name) -> [path, reference count, True if the session still holds its reference]
+        self.frames = {}
+        # (arm_id, session_id) -> time of the last publish or acquire
+        self.last_used = {}
+
+        self.stopped = threading.Event()
+        if idle_ttl is not None:
+            threading.Thread(target=self.sweep_idle, args=(sweep_interval,), name="frame_store", daemon=True).start()
+
+        atexit.register(self.shutdown)
+
+    def publish(self, arm_id, session_id, image_name, img):
+        """
+        Writes a decoded image to a memory-mapped file. The session holds the first reference of the frame.
+        Publishing an image again replaces the previous frame of the same name, while the references acquired
+        for the previous frame are kept.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        image_name : str
+            Name of the image.
+        img : np.array
+            Decoded image.
+
+        Returns
+        -------
+        img : np.array
+            Read-only, memory-mapped copy of the image, which can be used instead of the decoded image
+            without holding a second copy in memory.
+
+        """
+
+        path = self.path(arm_id, session_id, image_name)
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+
+        # Write to a temporary file first, so other processes never attach to a partially written frame
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        mapped = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=img.dtype, shape=img.shape)
+        mapped[:] = img
+        mapped.flush()
+        del mapped
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            entry = self.frames.setdefault((arm_id, session_id, image_name), [path, 0, False])
+            if not entry[2]:
+                entry[1] += 1
+                entry[2] = True
+            self.last_used[(arm_id, session_id)] = time.monotonic()
+
+        return attach(path)
+
+    def path(self, arm_id, session_id, image_name):
+        """
+        Returns the path where the frame of an image is published.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        image_name : str
+            Name of the image.
+
+        Returns
+        -------
+        path : str
+            Path of the frame.
+
+        """
+
+        # Session ids are generated by the arms, so sessions of different arms can have the same id
+        return Path(self.base_img_path).joinpath(session_id, "frames", arm_id, f"{Path(image_name).stem}.npy").as_posix()
+
+    def get(self, arm_id, session_id, image_name):
+        """
+        Returns the name of a published frame without acquiring a reference. Frames published by other processes
+        are found as well, their references are counted by the publishing process.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        image_name : str
+            Name of the image.
+
+        Returns
+        -------
+        frame : str
+            Path of the frame, which can be passed to `attach`, or None if the frame is not published.
+
+        """
+
+        with self.lock:
+            entry = self.frames.get((arm_id, session_id, image_name))
+        if entry is not None:
+            return entry[0]
+
+        path = self.path(arm_id, session_id, image_name)
+        return path if os.path.exists(path) else None
+
+    def acquire(self, arm_id, session_id, image_names):
+        """
+        Acquires a reference of the published frames of the provided images. Images without a published frame
+        are skipped.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        image_names : list
+            Names of the images.
+
+        Returns
+        -------
+        frames : dict
+            Dict mapping image names to the frame paths, which have to be passed to `release` when not needed anymore.
+
+        """
+
+        frames = {}
+        with self.lock:
+            if (arm_id, session_id) in self.last_used:
+                self.last_used[(arm_id, session_id)] = time.monotonic()
+            for image_name in image_names:
+                entry = self.frames.get((arm_id, session_id, image_name))
+                if entry is not None:
+                    entry[1] += 1
+                    frames[image_name] = entry[0]
+
+        return frames
+
+    def release(self, arm_id, session_id, image_names):
+        """
+        Releases a reference of the frames of the provided images. Frames without references are deleted.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        image_names : list
+            Names of the images.
+
+        """
+
+        with self.lock:
+            unreferenced = [self.decrement((arm_id, session_id, image_name)) for image_name in image_names]
+
+        self.remove(unreferenced)
+
+    def release_session(self, arm_id, session_id):
+        """
+        Releases the reference the session holds of each of its frames. Frames acquired by others, like running
+        stitching jobs, are deleted when those release them as well.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+
+        """
+
+        with self.lock:
+            self.last_used.pop((arm_id, session_id), None)
+            unreferenced = [self.decrement(key, session_reference=True) for key in list(self.frames) if key[:2] == (arm_id, session_id)]
+
+        self.remove(unreferenced)
+
+    def sweep(self, max_idle):
+        """
+        Releases the references of the sessions which were not used for `max_idle` seconds.
+
+        Parameters
+        ----------
+        max_idle : float
+            Maximum idle time of a session in seconds.
+
+        Returns
+        -------
+        sessions : list
+            (arm_id, session_id) tuples of the sessions whose references were released.
+
+        """
+
+        deadline = time.monotonic() - max_idle
+        with self.lock:
+            sessions = [session for session, last_used in self.last_used.items() if last_used < deadline]
+
+        for arm_id, session_id in sessions:
+            self.release_session(arm_id, session_id)
+
+        return sessions
+
+    def sweep_idle(self, interval):
+        while not self.stopped.wait(interval):
+            for arm_id, session_id in self.sweep(self.idle_ttl):
+                print(f"Frames of idle session '{session_id}' of arm '{arm_id}' were released.")
+
+    def decrement(self, key, session_reference=False):
+        """
+        Decrements the reference count of a frame, the lock has to be held by the caller.
+
+        Parameters
+        ----------
+        key : tuple
+            (arm_id, session_id, image_name) of the frame.
+        session_reference : bool, optional
+            If True, the reference held by the session is released, if it still holds it.
+
+        Returns
+        -------
+        path : str
+            Path of the frame if it's not referenced anymore, otherwise None.
+
+        """
+
+        entry = self.frames.get(key)
+        if entry is None or (session_reference and not entry[2]):
+            return None
+        if session_reference:
+            entry[2] = False
+        entry[1] -= 1
+        if entry[1] <= 0:
+            return self.frames.pop(key)[0]
+
+        return None
+
+    @staticmethod
+    def remove(paths):
+        # Processes which still have the file mapped keep their mapping until they close it
+        for path in paths:
+            if path is None:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def image_names(self, arm_id, session_id):
+        """
+        Returns the names of the images of a session which have a published frame.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+
+        Returns
+        -------
+        image_names : list
+            Names of the images.
+
+        """
+
+        with self.lock:
+            return [image_name for frame_arm_id, frame_session_id, image_name in self.frames if (frame_arm_id, frame_session_id) == (arm_id, session_id)]
+
+    def stats(self):
+        """
+        Returns the number of published frames and the number of bytes they occupy on disk.
+
+        Returns
+        -------
+        stats : dict
+            Dict containing the number of `frames` and their total size in `bytes`.
+
+        """
+
+        with self.lock:
+            paths = [entry[0] for entry in self.frames.values()]
+
+        return {"frames": len(paths), "bytes": sum(os.path.getsize(path) for path in paths if os.path.exists(path))}
+
+    def shutdown(self):
+        """
+        Deletes all remaining frames regardless of their references. Safe to call multiple times.
+
+        """
+
+        self.stopped.set()
+        with self.lock:
+            paths = [entry[0] for entry in self.frames.values()]
+            self.frames.clear()
+            self.last_used.clear()
+
+        self.remove(paths)
@@ -0,0 +1,92 @@
+"""
+Framing of the binary WebSocket messages, which contain JSON headers and an image. Messages are framed with a versioned
+envelope: a fixed-size prefix containing a magic number, the version and the length of the headers, followed by the
+JSON headers and the payload. Messages in the legacy format (headers and payload separated by `___SPLIT___`) are
+still accepted, so Raspberry Pis running an older version keep working.
+
+"""
+
+import json
+import struct
+
+MAGIC = b"SBv"
+VERSION = 1
+# Magic number, version and length of the headers in bytes, in network byte order
+PREFIX = struct.Struct("!3sBI")
+LEGACY_SEPARATOR = b"___SPLIT___"
+
+
+def encode(headers, payload):
+    """
+    Frames headers and a payload into a single binary message.
+
+    Parameters
+    ----------
+    headers : dict
+        JSON serializable headers of the message.
+    payload : bytes
+        Payload of the message, like the bytes of an image.
+
+    Returns
+    -------
+    message : bytes
+        The framed message.
+
+    """
+
+    header_bytes = json.dumps(headers, separators=(",", ":")).encode("utf-8")
+
+    return b"".join((PREFIX.pack(MAGIC, VERSION, len(header_bytes)), header_bytes, payload))
+
+
+def decode(message, legacy_header_limit=65536):
+    """
+    Parses a binary message without copying its payload.
+
+    Parameters
+    ----------
+    message : bytes
+        The received message, either in the versioned or in the legacy format.
+    legacy_header_limit : int, optional
+        In case of the legacy format, the separator is only searched in this many bytes at the beginning of the message,
+        so the payload is never scanned.
+
+    Returns
+    -------
+    headers : dict
+        Parsed headers of the message.
+    payload : memoryview
+        View of the payload within the message, which can be passed to `np.frombuffer` without copying.
+
+    Raises
+    ------
+    ValueError
+        If the message is truncated, its version is not supported or its headers cannot be parsed.
+
+    """
+
+    view = memoryview(message)
+
+    if view[:len(MAGIC)] == MAGIC:
+        if len(view) < PREFIX.size:
+            raise ValueError("Message is shorter than its prefix.")
+        _, version, header_length = PREFIX.unpack_from(view)
+        if version != VERSION:
+            raise ValueError(f"Unsupported framing version: {version}.")
+        header_end = PREFIX.size + header_length
+        if len(view) < header_end:
+            raise ValueError("Message is shorter than its headers.")
+        header_bytes, payload = view[PREFIX.size:header_end], view[header_end:]
+    else:
+        # The first separator ends the headers, the payload may contain the separator as well
+        separator_idx = message.find(LEGACY_SEPARATOR, 0, legacy_header_limit)
+        if separator_idx == -1:
+            raise ValueError("Message is neither framed nor contains a separator.")
+        header_bytes, payload = view[:separator_idx], view[separator_idx + len(LEGACY_SEPARATOR):]
+
+    try:
+        headers = json.loads(bytes(header_bytes))
+    except ValueError as error:
+        raise ValueError(f"Headers are not valid JSON: {error}") from error
+
+    return headers, payload
@@ -0,0 +1,144 @@
+"""
+Session-scoped cache of decoded images, so the stages processing the same frame share one decoded array
+instead of decoding it from disk again.
+
+"""
+
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+class ImageCache:
+    """
+    Thread-safe LRU cache of decoded images, bounded by the total number of bytes of the stored arrays.
+    Images are grouped by the session of an arm, so they can be released together when the session is finished.
+    Stored arrays are made read-only, since they are shared by every stage, stages have to copy them before drawing.
+    Only arrays in memory are stored, memory-mapped frames are read into memory first, so the budget and the
+    `resident_bytes` counter measure the memory the cache actually holds.
+
+    Parameters
+    ----------
+    max_bytes : int
+        Maximum number of bytes the cached arrays may occupy. The least recently used images are evicted above this limit.
+
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+
+        self.lock = threading.Lock()
+        self.images = OrderedDict()
+        self.counters = {"hits": 0, "misses": 0, "evictions": 0, "resident_bytes": 0}
+
+    def put(self, arm_id, session_id, image_name, img):
+        """
+        Stores a decoded image. Images larger than the budget are not stored. Memory-mapped images are copied to memory.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        image_name : str
+            Name of the image.
+        img : np.array
+            Decoded image.
+
+        Returns
+        -------
+        img : np.array
+            The stored, read-only image.
+
+        """
+
+        if isinstance(img, np.memmap):
+            img = np.array(img)
+        img.setflags(write=False)
+        if img.nbytes > self.max_bytes:
+            return img
+
+        with self.lock:
+            previous = self.images.pop((arm_id, session_id, image_name), None)
+            if previous is not None:
+                self.counters["resident_bytes"] -= previous.nbytes
+
+            self.images[(arm_id, session_id, image_name)] = img
+            self.counters["resident_bytes"] += img.nbytes
+
+            while self.counters["resident_bytes"] > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.counters["resident_bytes"] -= evicted.nbytes
+                self.counters["evictions"] += 1
+
+        return img
+
+    def get(self, arm_id, session_id, image_name, loader=None):
+        """
+        Retrieves a decoded image. In case of a miss, the image is loaded with `loader` and stored.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        image_name : str
+            Name of the image.
+        loader : callable, optional
+            Function without arguments returning the decoded image, called in case of a miss.
+
+        Returns
+        -------
+        img : np.array
+            The read-only image, or None if it is not in the cache and no loader was provided or the loader returned None.
+
+        """
+
+        with self.lock:
+            img = self.images.get((arm_id, session_id, image_name))
+            if img is not None:
+                self.images.move_to_end((arm_id, session_id, image_name))
+                self.counters["hits"] += 1
+                return img
+            self.counters["misses"] += 1
+
+        # Load outside of the lock, so decoding doesn't block the other threads
+        if loader is None:
+            return None
+        img = loader()
+
+        return None if img is None else self.put(arm_id, session_id, image_name, img)
+
+    def release(self, arm_id, session_id):
+        """
+        Removes all images of a session from the cache.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+
+        """
+
+        with self.lock:
+            for key in [key for key in self.images if key[:2] == (arm_id, session_id)]:
+                self.counters["resident_bytes"] -= self.images.pop(key).nbytes
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+
+        Returns
+        -------
+        stats : dict
+            Dict containing the number of `hits`, `misses` and `evictions`, the number of bytes occupied by the cached
+            arrays (`resident_bytes`) and the number of cached `images`.
+
+        """
+
+        with self.lock:
+            return dict(self.counters, images=len(self.images))
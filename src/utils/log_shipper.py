@@ -0,0 +1,193 @@
+"""
+Logging handler which sends the logs to the Control Panel from a background thread, so logging never waits
+for the network.
+
+"""
+
+import time
+import queue
+import random
+import logging
+import threading
+import http.client
+from urllib.parse import urlencode
+
+
+class LogShipper(logging.Handler):
+    """
+    Drop-in replacement of `logging.handlers.HTTPHandler`, which posts each record as form data, like HTTPHandler does.
+    `emit` only serializes the record and puts it in a bounded queue. A background thread takes the records from
+    the queue in batches and sends them over a single persistent connection. When more than half of the queue's capacity
+    is waiting to be sent, only a sample of the debug records is kept, when the queue is full, every new record is
+    dropped and counted.
+
+    Parameters
+    ----------
+    host : str
+        Host (and port) of the Control Panel, like `localhost:8000`.
+    url : str, optional
+        Path of the endpoint receiving the logs.
+    secure : bool, optional
+        If True, the logs are sent over HTTPS.
+    queue_size : int, optional
+        Maximum number of records waiting to be sent.
+    batch_size : int, optional
+        Maximum number of records sent after each other before the queue is checked again.
+    debug_sample_rate : float, optional
+        Fraction of debug records kept when more than half of the queue's capacity is waiting to be sent.
+    timeout : float, optional
+        Timeout of the connection in seconds.
+    backoff : float, optional
+        Time in seconds to wait before reconnecting after the Control Panel could not be reached.
+
+    """
+
+    def __init__(self, host, url="/log/", secure=False, queue_size=1000, batch_size=50, debug_sample_rate=0.1, timeout=5, backoff=1):
+        super().__init__()
+        self.host = host
+        self.url = url
+        self.secure = secure
+        self.batch_size = batch_size
+        self.debug_sample_rate = debug_sample_rate
+        self.timeout = timeout
+        self.backoff = backoff
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.connection = None
+        self.stats_lock = threading.Lock()
+        self.counters = {"queued": 0, "sent": 0, "dropped": 0, "sampled_out": 0, "failed": 0, "batches": 0, "connections": 0}
+
+        self.thread = threading.Thread(target=self.ship, name="log-shipper", daemon=True)
+        self.thread.start()
+
+    def count(self, counter, value=1):
+        with self.stats_lock:
+            self.counters[counter] += value
+
+    def emit(self, record):
+        """
+        Serializes the record and queues it without blocking. The record is serialized right away, since its arguments
+        might be modified by the caller after logging.
+
+        Parameters
+        ----------
+        record : logging.LogRecord
+            The record to be sent.
+
+        """
+
+        # Sample debug records when the Control Panel can't keep up, counting the records of the batch being sent too
+        pending = self.queue.unfinished_tasks
+        if record.levelno <= logging.DEBUG and pending >= self.queue.maxsize / 2 and random.random() >= self.debug_sample_rate:
+            self.count("sampled_out")
+            return
+
+        try:
+            self.queue.put_nowait(urlencode(self.mapLogRecord(record)))
+            self.count("queued")
+        except queue.Full:
+            self.count("dropped")
+        except Exception:
+            self.handleError(record)
+
+    def mapLogRecord(self, record):
+        """
+        Returns the fields of the record to be sent, the same as `logging.handlers.HTTPHandler` sends.
+
+        """
+
+        return record.__dict__
+
+    def ship(self):
+        """
+        Loop running on the background thread, which sends the queued records until a None sentinel is received.
+
+        """
+
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            stop = None in batch
+            self.send([body for body in batch if body is not None])
+            for _ in batch:
+                self.queue.task_done()
+
+            if stop:
+                return
+
+    def send(self, batch):
+        """
+        Sends a batch of serialized records one after the other on the persistent connection. If sending fails, the
+        connection is opened again once, then the rest of the batch is counted as failed.
+
+        Parameters
+        ----------
+        batch : list
+            List of url encoded records.
+
+        """
+
+        if len(batch) == 0:
+            return
+
+        headers = {"Content-type": "application/x-www-form-urlencoded"}
+        for idx, body in enumerate(batch):
+            for attempt in range(2):
+                try:
+                    if self.connection is None:
+                        connection_class = http.client.HTTPSConnection if self.secure else http.client.HTTPConnection
+                        self.connection = connection_class(self.host, timeout=self.timeout)
+                        self.count("connections")
+                    self.connection.request("POST", self.url, body, headers)
+                    self.connection.getresponse().read()
+                    self.count("sent")
+                    break
+                except Exception:
+                    self.close_connection()
+                    if attempt == 1:
+                        self.count("failed", len(batch) - idx)
+                        time.sleep(self.backoff)
+                        return
+
+        self.count("batches")
+
+    def close_connection(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def stats(self):
+        """
+        Returns the counters of the shipper.
+
+        Returns
+        -------
+        stats : dict
+            Dict containing the number of records `queued`, `sent`, `dropped` because the queue was full, `sampled_out`
+            debug records, records `failed` to be sent, sent `batches`, opened `connections` and the current size of
+            the queue and the batch being sent (`pending`).
+
+        """
+
+        with self.stats_lock:
+            return dict(self.counters, pending=self.queue.unfinished_tasks)
+
+    def close(self):
+        """
+        Sends the queued records and stops the background thread. Called by `logging.shutdown` when the interpreter exits.
+
+        """
+
+        if self.thread.is_alive():
+            try:
+                self.queue.put(None, timeout=self.timeout)
+            except queue.Full:
+                pass
+            self.thread.join(timeout=self.timeout)
+        self.close_connection()
+        super().close()
@@ -1,12 +1,14 @@
 """
-A Python logger to format the logs and send them to the Control Panel using an HTTPHandler.
+A Python logger to format the logs and send them to the Control Panel. Logs are sent by a LogShipper from a background
+thread, so logging doesn't block image processing.
 
 """
 
 
 import os
 import logging
-import logging.handlers
+
+from utils.log_shipper import LogShipper
 
 
 logger = logging.getLogger('SORTERBOT_CLOUD')
@@ -17,10 +19,10 @@ handler = logging.StreamHandler()
 handler.setFormatter(formatter)
 logger.addHandler(handler)
 
+log_shipper = None
 if os.getenv("CONTROL_PANEL_HOST"):
-    http_handler = logging.handlers.HTTPHandler(os.getenv("CONTROL_PANEL_HOST"), '/log/', method='POST')
-    handler.setFormatter(formatter)
-    logger.addHandler(http_handler)
+    log_shipper = LogShipper(os.getenv("CONTROL_PANEL_HOST"), '/log/')
+    logger.addHandler(log_shipper)
 
 logger.setLevel(logging.DEBUG)
 logger.setLevel(level=logging.DEBUG)
@@ -0,0 +1,209 @@
+"""
+Metrics of the service in the Prometheus text format, served over HTTP on a separate port, so they can be scraped
+(and used for autoscaling) independently from the WebSocket traffic.
+
+"""
+
+import os
+import resource
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.timing import BUCKETS
+
+
+def process_rss():
+    """
+    Returns the resident set size of the current process.
+
+    Returns
+    -------
+    rss : int
+        Resident memory in bytes. If `/proc` is not available (not on Linux), the peak resident memory is returned.
+
+    """
+
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+def format_value(value):
+    return "+Inf" if value == float("inf") else repr(float(value))
+
+
+class Metrics:
+    """
+    Registry of the service's metrics. Counters are incremented by the service, other values are collected when the
+    metrics are scraped, by calling the registered collectors.
+
+    Parameters
+    ----------
+    namespace : str, optional
+        Prefix of the metric names.
+
+    """
+
+    def __init__(self, namespace="sorterbot"):
+        self.namespace = namespace
+        self.lock = threading.Lock()
+        self.counters = defaultdict(dict)
+        self.descriptions = {}
+        self.collectors = []
+        self.timings = None
+        self.server = None
+
+    def inc(self, name, description, value=1, **labels):
+        """
+        Increments a counter.
+
+        Parameters
+        ----------
+        name : str
+            Name of the counter without the namespace, should end with `_total`.
+        description : str
+            Description of the counter.
+        value : float, optional
+            Value added to the counter.
+        **labels
+            Labels of the counter, like the command.
+
+        """
+
+        key = tuple(labels.items())
+        with self.lock:
+            self.descriptions[name] = description
+            self.counters[name][key] = self.counters[name].get(key, 0) + value
+
+    def add_collector(self, collector):
+        """
+        Registers a function which is called when the metrics are scraped.
+
+        Parameters
+        ----------
+        collector : callable
+            Function returning a list of (name, type, description, samples) tuples, where type is `gauge` or `counter`
+            and samples is a list of (labels dict, value) tuples.
+
+        """
+
+        self.collectors.append(collector)
+
+    def add_timings(self, timings):
+        """
+        Exports the stage durations of a Timings instance as a histogram.
+
+        Parameters
+        ----------
+        timings : Timings
+            Spans of the stages.
+
+        """
+
+        self.timings = timings
+
+    def render(self):
+        """
+        Renders the metrics in the Prometheus text exposition format.
+
+        Returns
+        -------
+        text : str
+            The metrics.
+
+        """
+
+        lines = []
+
+        with self.lock:
+            counters = {name: dict(samples) for name, samples in self.counters.items()}
+        for name, samples in sorted(counters.items()):
+            lines += [f"# HELP {self.namespace}_{name} {self.descriptions[name]}", f"# TYPE {self.namespace}_{name} counter"]
+            lines += [f"{self.namespace}_{name}{format_labels(dict(key))} {format_value(value)}" for key, value in samples.items()]
+
+        if self.timings is not None:
+            name = f"{self.namespace}_stage_duration_seconds"
+            lines += [f"# HELP {name} Duration of the processing stages.", f"# TYPE {name} histogram"]
+            for stage, histogram in self.timings.cumulative().items():
+                cumulative = 0
+                for bound, count in zip(BUCKETS, histogram["buckets"]):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{format_labels({'stage': stage, 'le': format_value(bound)})} {cumulative}")
+                lines.append(f"{name}_sum{format_labels({'stage': stage})} {format_value(histogram['sum'])}")
+                lines.append(f"{name}_count{format_labels({'stage': stage})} {histogram['count']}")
+
+        collected = [("process_resident_memory_bytes", "gauge", "Resident memory size of the server process in bytes.", [({}, process_rss())])]
+        for collector in self.collectors:
+            try:
+                collected += collector()
+            except Exception as error:
+                lines.append(f"# Collector failed: {error!r}")
+        for name, metric_type, description, samples in collected:
+            lines += [f"# HELP {self.namespace}_{name} {description}", f"# TYPE {self.namespace}_{name} {metric_type}"]
+            lines += [f"{self.namespace}_{name}{format_labels(labels)} {format_value(value)}" for labels, value in samples]
+
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port, host="0.0.0.0"):
+        """
+        Starts serving the metrics on `/metrics` from a background thread.
+
+        Parameters
+        ----------
+        port : int
+            Port of the metrics endpoint. Use 0 to pick a free port.
+        host : str, optional
+            Address to bind to.
+
+        Returns
+        -------
+        port : int
+            The port the metrics are served on.
+
+        """
+
+        metrics = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="metrics", daemon=True).start()
+
+        return self.server.server_address[1]
+
+    def shutdown(self):
+        """
+        Stops the metrics server.
+
+        """
+
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server = None
@@ -0,0 +1,122 @@
+"""
+Staged asyncio pipeline, which lets a connection have multiple images in flight, while each stage processes
+a different image at the same time.
+
+"""
+
+import time
+import asyncio
+import traceback
+import contextvars
+
+
+# Time in seconds the item processed by the current stage worker waited in the stage's queue
+queue_wait = contextvars.ContextVar("queue_wait", default=0.)
+
+
+class Pipeline:
+    """
+    Runs items through a sequence of stages. Each stage has its own workers, stages are connected with bounded queues,
+    so a slow stage applies backpressure to the previous ones and eventually to `submit`. Items are completed in the
+    order they finish, which can differ from the order they were submitted if a stage has multiple workers or an
+    item fails early. While a stage processes an item, the time the item waited in the stage's queue is available
+    from the `queue_wait` context variable.
+
+    Parameters
+    ----------
+    stages : list
+        List of (name, coroutine function, number of workers) tuples. The coroutine function of a stage is awaited
+        with the item returned by the previous stage and returns the item passed to the next one.
+    on_done : coroutine function
+        Awaited with the request id and the result of the last stage, or the exception raised by any stage.
+    queue_size : int, optional
+        Maximum number of items waiting in front of each stage.
+
+    """
+
+    def __init__(self, stages, on_done, queue_size=4):
+        self.on_done = on_done
+        self.queues = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+        self.in_flight = 0
+        self.idle = asyncio.Event()
+        self.idle.set()
+
+        self.tasks = []
+        for idx, (name, func, workers) in enumerate(stages):
+            next_queue = self.queues[idx + 1] if idx + 1 < len(stages) else None
+            for _ in range(workers):
+                self.tasks.append(asyncio.ensure_future(self.run_stage(name, func, self.queues[idx], next_queue)))
+
+    async def submit(self, request_id, item):
+        """
+        Adds an item to the pipeline. Waits if the queue of the first stage is full.
+
+        Parameters
+        ----------
+        request_id : any
+            Identifier of the item, passed to `on_done`.
+        item : any
+            Input of the first stage.
+
+        """
+
+        self.in_flight += 1
+        self.idle.clear()
+        await self.queues[0].put((request_id, item, time.monotonic()))
+
+    async def run_stage(self, name, func, queue, next_queue):
+        """
+        Loop of a stage's worker, which processes items from the stage's queue until it's cancelled.
+
+        """
+
+        while True:
+            request_id, item, enqueued = await queue.get()
+            queue_wait.set(time.monotonic() - enqueued)
+            try:
+                result = await func(item)
+            except Exception as error:
+                print(f"Pipeline stage '{name}' failed:")
+                traceback.print_exc()
+                await self.complete(request_id, error)
+                continue
+            finally:
+                queue.task_done()
+
+            if next_queue is None:
+                await self.complete(request_id, result)
+            else:
+                await next_queue.put((request_id, result, time.monotonic()))
+
+    async def complete(self, request_id, result):
+        """
+        Reports a finished item.
+
+        """
+
+        try:
+            await self.on_done(request_id, result)
+        except Exception:
+            traceback.print_exc()
+        finally:
+            self.in_flight -= 1
+            if self.in_flight == 0:
+                self.idle.set()
+
+    async def join(self):
+        """
+        Waits until all submitted items are completed.
+
+        """
+
+        await self.idle.wait()
+
+    async def close(self):
+        """
+        Cancels the workers of all stages. Items in flight are not completed.
+
+        """
+
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
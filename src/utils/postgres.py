@@ -5,32 +5,106 @@ Utility class to provide methods to interact with the PostgreSQL database.
 
 import os
 import boto3
+import asyncio
 import psycopg2
+import threading
 import traceback
 import functools
-from psycopg2 import pool
+import itertools
+import numpy as np
+from psycopg2 import pool, sql
 from psycopg2.extras import execute_values
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Columns returned by `get_session_objects`, in order
+SESSION_OBJECT_COLUMNS = ("id", "class", "image_width", "image_height", "x1", "y1", "x2", "y2")
+
+# Templates of the statements used by Postgres. Schema and table names are filled in as identifiers,
+# values are always passed as query parameters.
+STATEMENTS = {
+    "create_schema": "CREATE SCHEMA IF NOT EXISTS {schema};",
+    "table_exists": "SELECT EXISTS(SELECT * FROM information_schema.tables WHERE table_name=%s AND table_schema=%s);",
+    "create_table": """
+        CREATE TABLE {schema}.{table} (
+            id SERIAL PRIMARY KEY,
+            image_name TEXT,
+            image_width SMALLINT,
+            image_height SMALLINT,
+            class SMALLINT,
+            x1 SMALLINT,
+            y1 SMALLINT,
+            x2 SMALLINT,
+            y2 SMALLINT
+        );
+    """,
+    "insert_results": """
+        INSERT INTO {schema}.{table} (image_name, image_width, image_height, class, x1, y1, x2, y2) VALUES %s RETURNING id;
+    """,
+    "get_unique_images": "SELECT DISTINCT image_name FROM {schema}.{table};",
+    "get_objects_of_image": f"SELECT {', '.join(SESSION_OBJECT_COLUMNS)} FROM {{schema}}.{{table}} WHERE image_name=%s;",
+    "get_session_objects": f"SELECT image_name, {', '.join(SESSION_OBJECT_COLUMNS)} FROM {{schema}}.{{table}} ORDER BY image_name, id;",
+}
+
+
+@functools.lru_cache(maxsize=1024)
+def get_statement(name, schema_name, table_name=None):
+    """
+    Composes a statement from `STATEMENTS` for a given schema and table. Composed statements are cached, so the
+    identifiers are quoted only once per session table.
+
+    Parameters
+    ----------
+    name : str
+        Key of the statement in `STATEMENTS`.
+    schema_name : str
+        Name of the schema. Corresponds to arm_id.
+    table_name : str, optional
+        Name of the table. Corresponds to session_id.
+
+    Returns
+    -------
+    statement : psycopg2.sql.Composed
+        Statement, which can be executed by passing the values as parameters.
+
+    """
+
+    return sql.SQL(STATEMENTS[name]).format(
+        schema=sql.Identifier(schema_name),
+        table=sql.Identifier(table_name) if table_name is not None else sql.SQL("")
+    )
 
 
 def add_connection(func):
     """
     Decorator function to retrieve a connection from the connection pool, pass it to the decorated function,
-    then put it back to the pool.
+    then put it back to the pool. The connection is returned even if the decorated function raises an exception.
+    If all connections are in use, it waits until one is returned instead of failing.
 
     """
 
     @functools.wraps(func)
     def add_conn_wrapper(self, *args, **kwargs):
-        # Get connection from pool
-        connection = self.postgres_pool.getconn()
-        connection.autocommit = True
-        kwargs["cursor"] = connection.cursor()
-        # Call wrapper function and pass cursor
-        value = func(self, *args, **kwargs)
-        # Put back connection
-        kwargs["cursor"].close()
-        self.postgres_pool.putconn(connection)
-        return value
+        with self.usage_lock:
+            self.usage["waiting"] += 1
+        with self.connection_slots:
+            with self.usage_lock:
+                self.usage["waiting"] -= 1
+                self.usage["in_use"] += 1
+            try:
+                # Get connection from pool
+                connection = self.postgres_pool.getconn()
+                try:
+                    connection.autocommit = True
+                    # Call wrapper function and pass cursor, which is closed when leaving the block
+                    with connection.cursor() as cursor:
+                        return func(self, *args, cursor=cursor, **kwargs)
+                finally:
+                    # Put back connection, discard it if it was closed because of an error
+                    self.postgres_pool.putconn(connection, close=bool(connection.closed))
+            finally:
+                with self.usage_lock:
+                    self.usage["in_use"] -= 1
     return add_conn_wrapper
 
 
@@ -39,10 +113,18 @@ class Postgres:
     Class to provide method to interact with PostgreSQL database. Uses connection pooling to avoid opening and closing
     connections every time a request comes in. It uses a single database which is created when starting the service if
     it does not exist already. Each arm's data is saved to a separate schema while each session gets its own table.
+    The connection pool is thread-safe, since the methods are called from the dispatcher's worker threads.
+
+    Parameters
+    ----------
+    min_connections : int, optional
+        Number of connections opened when the pool is created.
+    max_connections : int, optional
+        Maximum number of connections in the pool.
 
     """
 
-    def __init__(self):
+    def __init__(self, min_connections=1, max_connections=100):
         try:
             # Create connection pool
             session = boto3.Session(region_name=os.getenv("DEPLOY_REGION"))
@@ -50,17 +132,87 @@ class Postgres:
                 Names=["PG_CONN"],
                 WithDecryption=True
             )["Parameters"][0]["Value"]
-            self.postgres_pool = pool.SimpleConnectionPool(1, 100, PG_CONN)
+            self.postgres_pool = pool.ThreadedConnectionPool(min_connections, max_connections, PG_CONN)
+            self.connection_slots = threading.BoundedSemaphore(max_connections)
+            self.max_connections = max_connections
+            self.usage_lock = threading.Lock()
+            self.usage = {"in_use": 0, "waiting": 0}
 
         except psycopg2.Error as error:
             traceback.print_exc()
             raise Exception(f"Error while connecting to PostgreSQL: {error}") from error
 
-    @add_connection
-    def create_table(self, cursor, schema_name, table_name):
+        # Schemas and tables known to exist, so they don't have to be checked for every image
+        self.memo_lock = threading.Lock()
+        self.known_schemas = set()
+        self.known_tables = set()
+
+    def pool_stats(self):
+        """
+        Returns the utilization of the connection pool.
+
+        Returns
+        -------
+        stats : dict
+            Dict containing the number of connections `in_use`, the number of calls `waiting` for a free connection
+            and the maximum number of connections (`max`).
+
+        """
+
+        with self.usage_lock:
+            return dict(self.usage, max=self.max_connections)
+
+    def is_known_table(self, schema_name, table_name):
+        """
+        Checks if a table is already known to exist, without accessing the database.
+
+        Parameters
+        ----------
+        schema_name : str
+            Name of the schema. Corresponds to arm_id.
+        table_name : str
+            Name of the table. Corresponds to session_id.
+
+        Returns
+        -------
+        known : bool
+            True if the table was created or found by `create_table` before.
+
+        """
+
+        with self.memo_lock:
+            return (schema_name.lower(), str(table_name).lower()) in self.known_tables
+
+    def create_table(self, schema_name, table_name):
         """
         This method creates a new table with a given name in the database if it does not exist yet. A separate
-        table should be created for each session.
+        table should be created for each session. Once a table is known to exist, calling this method again
+        doesn't access the database.
+
+        Parameters
+        ----------
+        schema_name : str
+            Name of the schema to be created. Corresponds to arm_id.
+        table_name : str
+            Name of the table to be created. Corresponds to session_id.
+
+        Returns
+        -------
+        table_created : bool
+            True if table was created, false if it already existed.
+
+        """
+
+        if self.is_known_table(schema_name, table_name):
+            return False
+
+        return self.create_table_in_db(schema_name=schema_name, table_name=table_name)
+
+    @add_connection
+    def create_table_in_db(self, cursor, schema_name, table_name):
+        """
+        Creates the schema and the table in the database if they don't exist yet and adds them to the memo.
+        Use `create_table` instead, which skips this if the table is already known to exist.
 
         Parameters
         ----------
@@ -84,30 +236,21 @@ class Postgres:
             table_name = str(table_name).lower()
 
             # Create schema if doesn't exist
-            cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {schema_name};")
+            if schema_name not in self.known_schemas:
+                cursor.execute(get_statement("create_schema", schema_name))
+                with self.memo_lock:
+                    self.known_schemas.add(schema_name)
 
             # Create table if doesn't exist
-            check_table_query = f"SELECT EXISTS(SELECT * FROM information_schema.tables WHERE table_name='{table_name}' AND table_schema='{schema_name}');"
-            cursor.execute(check_table_query)
+            cursor.execute(STATEMENTS["table_exists"], (table_name, schema_name))
             table_exists = cursor.fetchone()[0]
-            if table_exists:
-                return False
-
-            create_table_query = f"""
-                CREATE TABLE {schema_name}.{table_name} (
-                    id SERIAL PRIMARY KEY,
-                    image_name TEXT,
-                    image_width SMALLINT,
-                    image_height SMALLINT,
-                    class SMALLINT,
-                    x1 SMALLINT,
-                    y1 SMALLINT,
-                    x2 SMALLINT,
-                    y2 SMALLINT
-                );
-            """
-
-            cursor.execute(create_table_query)
+            if not table_exists:
+                cursor.execute(get_statement("create_table", schema_name, table_name))
+
+            with self.memo_lock:
+                self.known_tables.add((schema_name, table_name))
+
+            return not table_exists
 
         except psycopg2.Error as error:
             traceback.print_exc()
@@ -129,14 +272,21 @@ class Postgres:
         results : list
             List of dict's containing the following keys: `image_name`, `image_width`, `image_height`, `class`, `x1`, `y1`, `x2`, `y2`.
 
+        Returns
+        -------
+        ids : list
+            List of ids assigned to the inserted rows, in the same order as `results`.
+
         """
 
+        if len(results) == 0:
+            return []
+
         try:
             # Since postgres converts table names to lowercase, this is needed to avoid unexpected behavior
             schema_name = schema_name.lower()
             table_name = table_name.lower()
 
-            insert_query = f"INSERT INTO {schema_name}.{table_name} (image_name, image_width, image_height, class, x1, y1, x2, y2) VALUES %s;"
             results_as_tuple = [(
                 res["image_name"],
                 int(res["image_width"]),
@@ -147,13 +297,15 @@ class Postgres:
                 int(res["x2"]),
                 int(res["y2"])
             ) for res in results]
-            execute_values(cursor, insert_query, results_as_tuple)
+            ids = execute_values(cursor, get_statement("insert_results", schema_name, table_name), results_as_tuple, fetch=True)
 
         except psycopg2.Error as error:
             exc = Exception(f"Error while inserting data to PostgreSQL: {error}")
             traceback.print_exc()
             raise exc from error
 
+        return [row[0] for row in ids]
+
     @add_connection
     def get_unique_images(self, cursor, schema_name, table_name):
         """
@@ -180,8 +332,7 @@ class Postgres:
             schema_name = schema_name.lower()
             table_name = table_name.lower()
 
-            get_unique_images_query = f"SELECT DISTINCT image_name FROM {schema_name}.{table_name};"
-            cursor.execute(get_unique_images_query)
+            cursor.execute(get_statement("get_unique_images", schema_name, table_name))
             unique_images = cursor.fetchall()
             unique_images = [image[0] for image in unique_images]
 
@@ -220,25 +371,22 @@ class Postgres:
             schema_name = schema_name.lower()
             table_name = table_name.lower()
 
-            get_objects_query = f"SELECT * FROM {schema_name}.{table_name} WHERE image_name='{image_name}'"
-            cursor.execute(get_objects_query)
+            cursor.execute(get_statement("get_objects_of_image", schema_name, table_name), (image_name,))
             rows = cursor.fetchall()
 
-            # Get column names and later retrieve values by name so we don't depend on magic indices
-            col_names = [col.name for col in cursor.description]
-
+            # Columns are selected explicitly, in the order of SESSION_OBJECT_COLUMNS
             objects_of_image = [
                 {
-                    "id": row[col_names.index("id")],
-                    "class": row[col_names.index("class")],
-                    "img_dims": (row[col_names.index("image_width")], row[col_names.index("image_height")]),
+                    "id": obj_id,
+                    "class": obj_class,
+                    "img_dims": (image_width, image_height),
                     "bbox_dims": {
-                        "x1": row[col_names.index("x1")],
-                        "y1": row[col_names.index("y1")],
-                        "x2": row[col_names.index("x2")],
-                        "y2": row[col_names.index("y2")]
+                        "x1": x1,
+                        "y1": y1,
+                        "x2": x2,
+                        "y2": y2
                     }
-                } for row in rows
+                } for obj_id, obj_class, image_width, image_height, x1, y1, x2, y2 in rows
             ]
 
         except psycopg2.Error as error:
@@ -246,3 +394,103 @@ class Postgres:
             raise Exception(f"Error while getting objects of image from PostgreSQL: {error}") from error
 
         return objects_of_image
+
+    @add_connection
+    def get_session_objects(self, cursor, schema_name, table_name):
+        """
+        This method retrieves all recognized objects of a session with a single query, grouped by image.
+
+        Parameters
+        ----------
+        cursor : psycopg2.cursor
+            Cursor to be used for SQL execution. Provided by `add_connection` decorator.
+        schema_name : str
+            Name of the schema to be used. Corresponds to arm_id.
+        table_name : str
+            Name of the table to be used. Corresponds to session_id.
+
+        Returns
+        -------
+        session_objects : dict
+            Dict where the keys are the image names and the values are integer arrays of shape (n_objects, 8). The columns
+            are in the order of `SESSION_OBJECT_COLUMNS`, the rows are ordered by id.
+
+        """
+
+        try:
+            # Since postgres converts table names to lowercase, this is needed to avoid unexpected behavior
+            schema_name = schema_name.lower()
+            table_name = table_name.lower()
+
+            cursor.execute(get_statement("get_session_objects", schema_name, table_name))
+            rows = cursor.fetchall()
+
+            session_objects = {
+                image_name: np.array([row[1:] for row in rows_of_image], dtype=np.int64)
+                for image_name, rows_of_image in itertools.groupby(rows, key=lambda row: row[0])
+            }
+
+        except psycopg2.Error as error:
+            traceback.print_exc()
+            raise Exception(f"Error while getting objects of session from PostgreSQL: {error}") from error
+
+        return session_objects
+
+
+class AsyncPostgres:
+    """
+    Asyncio interface of Postgres for the WebSocket server. Since psycopg2 is blocking, the queries are executed on a small
+    dedicated thread pool, so they never block the event loop and never occupy the dispatcher's inference workers.
+
+    Parameters
+    ----------
+    postgres : Postgres
+        Instance of Postgres, which provides the connection pool and the memo of existing tables.
+    max_workers : int, optional
+        Maximum number of queries running at the same time.
+
+    """
+
+    def __init__(self, postgres, max_workers=4):
+        self.postgres = postgres
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="postgres")
+
+    async def run(self, method_name, **kwargs):
+        """
+        Executes a method of Postgres on the thread pool.
+
+        Parameters
+        ----------
+        method_name : str
+            Name of the method of Postgres to be executed.
+        **kwargs
+            Keyword arguments passed to the method.
+
+        Returns
+        -------
+        result : any
+            Return value of the executed method.
+
+        """
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, functools.partial(getattr(self.postgres, method_name), **kwargs))
+
+    async def create_table(self, schema_name, table_name):
+        """
+        Same as `Postgres.create_table`, but returns without leaving the event loop if the table is already known to exist.
+
+        """
+
+        if self.postgres.is_known_table(schema_name, table_name):
+            return False
+
+        return await self.run("create_table", schema_name=schema_name, table_name=table_name)
+
+    def shutdown(self):
+        """
+        Waits for the running queries to finish, then releases the threads.
+
+        """
+
+        self.executor.shutdown(wait=True)
@@ -0,0 +1,250 @@
+"""
+Opt-in profiling of the handlers of Main, which can be enabled for specific arms or sessions. Profiles are written
+next to the session's images, so a slow session can be analysed after it happened.
+
+"""
+
+import os
+import io
+import pstats
+import inspect
+import cProfile
+import functools
+import threading
+import tracemalloc
+from pathlib import Path
+from contextlib import contextmanager
+
+
+def parse_targets(value):
+    """
+    Parses the profiling targets from a comma separated string, like the `PROFILE` environment variable.
+
+    Parameters
+    ----------
+    value : str
+        Comma separated list of arm ids, `arm_id/session_id` pairs, or `*` to profile everything.
+
+    Returns
+    -------
+    targets : tuple
+        Set of arm ids, set of (arm_id, session_id) tuples and a bool indicating if everything should be profiled.
+
+    """
+
+    arms, sessions, everything = set(), set(), False
+    for target in (value or "").split(","):
+        target = target.strip()
+        if target == "*":
+            everything = True
+        elif "/" in target:
+            sessions.add(tuple(target.split("/", 1)))
+        elif target:
+            arms.add(target)
+
+    return arms, sessions, everything
+
+
+def profiled(method):
+    """
+    Decorator of the handlers of Main, which profiles the handler with Main's profiler if it's enabled for the session.
+    The handler needs `arm_id` (or `arm_constants`) and `session_id` arguments. If it has an `image_name` argument,
+    the name of the image is appended to the name of the profile.
+
+    """
+
+    signature = inspect.signature(method)
+
+    @functools.wraps(method)
+    def profiled_wrapper(self, *args, **kwargs):
+        if not self.profiler.has_targets():
+            return method(self, *args, **kwargs)
+
+        arguments = signature.bind(self, *args, **kwargs).arguments
+        arm_id = arguments["arm_id"] if "arm_id" in arguments else arguments["arm_constants"]["arm_id"]
+        name = method.__name__ + (f"_{Path(arguments['image_name']).stem}" if "image_name" in arguments else "")
+
+        with self.profiler.profile(arm_id, arguments["session_id"], name):
+            return method(self, *args, **kwargs)
+
+    return profiled_wrapper
+
+
+class Profiler:
+    """
+    Profiles the handlers of Main with cProfile, and optionally the memory allocations with tracemalloc, if profiling
+    is enabled for the arm or the session. When nothing is enabled, `profiled` handlers only check two empty sets.
+    For each profiled call, a binary profile (`.prof`, can be opened with `pstats` or snakeviz) and a text summary
+    (`.txt`) is written to the `profiles` folder of the session. Nested calls in the same thread are included in the
+    outermost profile.
+
+    Parameters
+    ----------
+    base_img_path : str
+        Location where the images are stored.
+    arms : iterable, optional
+        Arm ids whose sessions are profiled.
+    sessions : iterable, optional
+        (arm_id, session_id) tuples of profiled sessions.
+    everything : bool, optional
+        If True, every session is profiled.
+    memory : bool, optional
+        If True, memory allocations are traced as well, which slows down the profiled calls considerably.
+    top : int, optional
+        Number of functions and allocation sites listed in the text summaries.
+
+    """
+
+    def __init__(self, base_img_path, arms=(), sessions=(), everything=False, memory=False, top=30):
+        self.base_img_path = base_img_path
+        self.memory = memory
+        self.top = top
+
+        self.lock = threading.Lock()
+        self.arms = set(arms)
+        self.sessions = set(tuple(session) for session in sessions)
+        self.everything = everything
+        self.active = threading.local()
+
+    def set_enabled(self, enabled, arm_id=None, session_id=None):
+        """
+        Enables or disables profiling for an arm, a session of an arm, or everything if neither is provided.
+
+        Parameters
+        ----------
+        enabled : bool
+            True to enable, False to disable profiling.
+        arm_id : str, optional
+            Unique identifier of the robot arm.
+        session_id : str, optional
+            Unique identifier of the session, only used together with `arm_id`.
+
+        """
+
+        with self.lock:
+            if arm_id is None:
+                self.everything = enabled
+                if not enabled:
+                    self.arms, self.sessions = set(), set()
+                return
+
+            targets, target = (self.sessions, (arm_id, session_id)) if session_id else (self.arms, arm_id)
+            if enabled:
+                targets.add(target)
+            else:
+                targets.discard(target)
+
+    def status(self):
+        """
+        Returns the profiling targets.
+
+        Returns
+        -------
+        status : dict
+            Dict containing the profiled `arms`, `sessions` (as `arm_id/session_id`) and whether `everything` is profiled.
+
+        """
+
+        with self.lock:
+            return {
+                "arms": sorted(self.arms),
+                "sessions": sorted(f"{arm_id}/{session_id}" for arm_id, session_id in self.sessions),
+                "everything": self.everything
+            }
+
+    def has_targets(self):
+        """
+        Checks if profiling is enabled for anything, which is all the overhead of the disabled profiler.
+
+        """
+
+        return bool(self.everything or self.arms or self.sessions)
+
+    def is_enabled(self, arm_id, session_id):
+        """
+        Checks if profiling is enabled for a session.
+
+        """
+
+        return self.everything or arm_id in self.arms or (arm_id, session_id) in self.sessions
+
+    @contextmanager
+    def profile(self, arm_id, session_id, name):
+        """
+        Context manager which profiles the enclosed code if profiling is enabled for the session.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        name : str
+            Name of the profile files, like `process_image_1200`.
+
+        """
+
+        if not self.is_enabled(arm_id, session_id) or getattr(self.active, "profiling", False):
+            yield
+            return
+
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is active (eg. a debugger), the call is not profiled
+            yield
+            return
+
+        start_tracing = self.memory and not tracemalloc.is_tracing()
+        if start_tracing:
+            tracemalloc.start()
+
+        self.active.profiling = True
+        try:
+            yield
+        finally:
+            profiler.disable()
+            self.active.profiling = False
+            snapshot = tracemalloc.take_snapshot() if start_tracing else None
+            peak = tracemalloc.get_traced_memory()[1] if start_tracing else None
+            if start_tracing:
+                tracemalloc.stop()
+
+            try:
+                self.write(session_id, name, profiler, snapshot, peak)
+            except Exception as error:
+                print(f"Profile '{name}' of session '{session_id}' could not be written: {error!r}")
+
+    def write(self, session_id, name, profiler, snapshot=None, peak=None):
+        """
+        Writes the profile files of a call to the `profiles` folder of the session.
+
+        Parameters
+        ----------
+        session_id : str
+            Unique identifier of the session.
+        name : str
+            Name of the profile files.
+        profiler : cProfile.Profile
+            The finished profiler.
+        snapshot : tracemalloc.Snapshot, optional
+            Memory allocations, written to `[name].memory.txt`.
+        peak : int, optional
+            Peak of the traced memory in bytes.
+
+        """
+
+        profiles_path = Path(self.base_img_path).joinpath(session_id, "profiles")
+        profiles_path.mkdir(parents=True, exist_ok=True)
+
+        profiler.dump_stats(profiles_path.joinpath(f"{name}.prof").as_posix())
+
+        summary = io.StringIO()
+        pstats.Stats(profiler, stream=summary).sort_stats("cumulative").print_stats(self.top)
+        profiles_path.joinpath(f"{name}.txt").write_text(summary.getvalue())
+
+        if snapshot is not None:
+            lines = [f"Peak traced memory: {peak / 2 ** 20:.1f} MB", ""]
+            lines += [str(statistic) for statistic in snapshot.statistics("lineno")[:self.top]]
+            profiles_path.joinpath(f"{name}.memory.txt").write_text(os.linesep.join(lines) + os.linesep)
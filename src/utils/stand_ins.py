@@ -0,0 +1,184 @@
+"""
+In-memory stand-ins of Postgres and S3, used by Main when the `MODE` environment variable is `loadtest`. They implement
+the methods the service calls, so the server can be load tested without a database, AWS credentials or network.
+
+"""
+
+import time
+import itertools
+import threading
+from pathlib import Path
+
+import numpy as np
+
+
+class MemoryPostgres:
+    """
+    Stand-in of Postgres, which keeps the tables in memory. Schema and table names are lowercased like in PostgreSQL.
+    Tables exist only in the process which created them, so it doesn't work with a process pool dispatcher.
+
+    Parameters
+    ----------
+    latency : float, optional
+        Time in seconds every query takes, to simulate the round trip to the database.
+
+    """
+
+    def __init__(self, latency=0.):
+        self.latency = latency
+        self.lock = threading.Lock()
+        # (schema_name, table_name) -> list of (id, image_name, class, image_width, image_height, x1, y1, x2, y2)
+        self.tables = {}
+        self.ids = itertools.count(1)
+        self.usage = {"in_use": 0, "waiting": 0}
+
+    def query(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def pool_stats(self):
+        """
+        Same as `Postgres.pool_stats`, there is no pool, so nothing is ever in use.
+
+        """
+
+        return dict(self.usage, max=0)
+
+    def is_known_table(self, schema_name, table_name):
+        """
+        Same as `Postgres.is_known_table`.
+
+        """
+
+        with self.lock:
+            return (schema_name.lower(), str(table_name).lower()) in self.tables
+
+    def create_table(self, schema_name, table_name):
+        """
+        Same as `Postgres.create_table`.
+
+        """
+
+        if self.is_known_table(schema_name, table_name):
+            return False
+
+        self.query()
+        key = (schema_name.lower(), str(table_name).lower())
+        with self.lock:
+            if key in self.tables:
+                return False
+            self.tables[key] = []
+            return True
+
+    def insert_results(self, schema_name, table_name, results):
+        """
+        Same as `Postgres.insert_results`.
+
+        Raises
+        ------
+        Exception
+            If the table doesn't exist.
+
+        """
+
+        if len(results) == 0:
+            return []
+
+        self.query()
+        with self.lock:
+            table = self.get_table(schema_name, table_name)
+            rows = [(
+                next(self.ids),
+                res["image_name"],
+                int(res["class"]),
+                int(res["image_width"]),
+                int(res["image_height"]),
+                int(res["x1"]),
+                int(res["y1"]),
+                int(res["x2"]),
+                int(res["y2"])
+            ) for res in results]
+            table.extend(rows)
+
+        return [row[0] for row in rows]
+
+    def get_unique_images(self, schema_name, table_name):
+        """
+        Same as `Postgres.get_unique_images`.
+
+        """
+
+        self.query()
+        with self.lock:
+            return list(dict.fromkeys(row[1] for row in self.get_table(schema_name, table_name)))
+
+    def get_objects_of_image(self, schema_name, table_name, image_name):
+        """
+        Same as `Postgres.get_objects_of_image`.
+
+        """
+
+        self.query()
+        with self.lock:
+            rows = [row for row in self.get_table(schema_name, table_name) if row[1] == image_name]
+
+        return [
+            {
+                "id": obj_id,
+                "class": obj_class,
+                "img_dims": (image_width, image_height),
+                "bbox_dims": {"x1": x1, "y1": y1, "x2": x2, "y2": y2}
+            } for obj_id, _, obj_class, image_width, image_height, x1, y1, x2, y2 in rows
+        ]
+
+    def get_session_objects(self, schema_name, table_name):
+        """
+        Same as `Postgres.get_session_objects`.
+
+        """
+
+        self.query()
+        with self.lock:
+            rows = sorted(self.get_table(schema_name, table_name), key=lambda row: (row[1], row[0]))
+
+        return {
+            image_name: np.array([(row[0], ) + row[2:] for row in rows_of_image], dtype=np.int64)
+            for image_name, rows_of_image in itertools.groupby(rows, key=lambda row: row[1])
+        }
+
+    def get_table(self, schema_name, table_name):
+        try:
+            return self.tables[(schema_name.lower(), str(table_name).lower())]
+        except KeyError:
+            raise Exception(f'Table "{schema_name.lower()}.{str(table_name).lower()}" does not exist.')
+
+
+class MemoryS3:
+    """
+    Stand-in of S3, which only records the size of the uploaded files.
+
+    Parameters
+    ----------
+    latency : float, optional
+        Time in seconds every upload takes, to simulate the transfer to s3.
+
+    """
+
+    def __init__(self, latency=0.):
+        self.latency = latency
+        self.lock = threading.Lock()
+        # bucket_name/s3_path -> size of the file in bytes
+        self.uploads = {}
+
+    def upload_file(self, bucket_name, file_path, s3_path):
+        """
+        Same as `S3.upload_file`.
+
+        """
+
+        size = Path(file_path).stat().st_size
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            self.uploads[f"{bucket_name}/{s3_path}"] = size
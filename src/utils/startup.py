@@ -0,0 +1,92 @@
+"""
+Bookkeeping of the service's startup, which measures the duration of each phase and tells the health check
+when the service is ready to accept requests.
+
+"""
+
+import time
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+
+class Startup:
+    """
+    Records the durations of the startup phases and whether the models are loaded and warmed up.
+
+    Parameters
+    ----------
+    logger_instance : logger
+        Logger instance used to report the duration of each phase.
+
+    """
+
+    def __init__(self, logger_instance):
+        self.logger = logger_instance
+        self.started = time.monotonic()
+        self.timings = OrderedDict()
+        self.total = None
+        self.error = None
+        self.ready = threading.Event()
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager which measures the duration of a startup phase.
+
+        Parameters
+        ----------
+        name : str
+            Name of the phase, like `detectron` or `warm_up`.
+
+        """
+
+        start = time.monotonic()
+        yield
+        self.timings[name] = round(time.monotonic() - start, 3)
+        self.logger.info(f"Startup phase '{name}' finished in {self.timings[name]:.2f} seconds.")
+
+    def set_ready(self):
+        """
+        Marks the service as ready and reports the total duration of the startup.
+
+        """
+
+        self.total = round(time.monotonic() - self.started, 3)
+        self.ready.set()
+        self.logger.info(f"Startup finished in {self.total:.2f} seconds, ready to accept requests.")
+
+    def set_failed(self, error):
+        """
+        Records the error which stopped the startup. The service never becomes ready in this case.
+
+        Parameters
+        ----------
+        error : Exception
+            The raised error.
+
+        """
+
+        self.error = repr(error)
+        self.logger.error(f"Startup failed: {self.error}")
+
+    def status(self):
+        """
+        Returns the state of the startup, reported by the health check.
+
+        Returns
+        -------
+        status : dict
+            Dict containing `status` (starting, ready or failed), the durations of the finished phases in seconds
+            (`timings`), the `total` duration of the startup and the `error` if it failed.
+
+        """
+
+        if self.ready.is_set():
+            status = "ready"
+        elif self.error is not None:
+            status = "failed"
+        else:
+            status = "starting"
+
+        return {"status": status, "timings": dict(self.timings), "total": self.total, "error": self.error}
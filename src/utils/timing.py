@@ -0,0 +1,314 @@
+"""
+Stage timing instrumentation. Spans measure the stages of processing images and sessions (like decoding, detection,
+vectorization or stitching) with a monotonic clock, keyed by arm, session and image. Spans are aggregated into rolling
+histograms per stage and can be exported as a Chrome trace or a JSON timeline of a session.
+
+"""
+
+import json
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict, deque, defaultdict
+
+import numpy as np
+
+
+# Upper bounds of the histogram buckets in seconds
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, float("inf"))
+
+
+class RollingHistogram:
+    """
+    Distribution of the most recent durations of a stage.
+
+    Parameters
+    ----------
+    window : int
+        Number of most recent spans kept.
+
+    """
+
+    def __init__(self, window):
+        self.durations = deque(maxlen=window)
+        self.queue_waits = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.
+        # Number of all spans in each bucket, not only the ones in the window
+        self.bucket_counts = [0] * len(BUCKETS)
+
+    def add(self, duration, queue_wait):
+        """
+        Adds the duration and queue wait of a span.
+
+        """
+
+        self.durations.append(duration)
+        self.queue_waits.append(queue_wait)
+        self.count += 1
+        self.total += duration
+        self.bucket_counts[bisect.bisect_left(BUCKETS, duration)] += 1
+
+    def summary(self):
+        """
+        Summarizes the spans in the window.
+
+        Returns
+        -------
+        summary : dict
+            Dict containing the number of all spans (`count`) and their total duration (`total`), percentiles of the
+            durations and queue waits in the window in seconds and the number of durations in each bucket of `BUCKETS`.
+
+        """
+
+        durations = np.array(self.durations)
+        queue_waits = np.array(self.queue_waits)
+        p50, p90, p99 = np.percentile(durations, [50, 90, 99])
+        counts, _ = np.histogram(durations, bins=(0,) + BUCKETS)
+
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": float(durations.mean()),
+            "p50": float(p50),
+            "p90": float(p90),
+            "p99": float(p99),
+            "max": float(durations.max()),
+            "queue_wait_p50": float(np.percentile(queue_waits, 50)),
+            "queue_wait_p99": float(np.percentile(queue_waits, 99)),
+            "buckets": dict(zip([str(bound) for bound in BUCKETS], counts.tolist()))
+        }
+
+
+class Timings:
+    """
+    Thread-safe collection of stage spans. Spans of the most recent sessions are kept for exporting, older sessions
+    are dropped. In case of a process pool dispatcher, each worker process records the spans of its own handlers.
+
+    Parameters
+    ----------
+    window : int, optional
+        Number of most recent spans per stage used by the histograms.
+    max_sessions : int, optional
+        Number of sessions whose spans are kept for exporting.
+    max_spans : int, optional
+        Maximum number of spans kept per session.
+
+    """
+
+    def __init__(self, window=1000, max_sessions=20, max_spans=10000):
+        self.window = window
+        self.max_sessions = max_sessions
+        self.max_spans = max_spans
+        self.origin = time.monotonic()
+
+        self.lock = threading.Lock()
+        self.histograms = defaultdict(lambda: RollingHistogram(self.window))
+        self.sessions = OrderedDict()
+
+    @contextmanager
+    def span(self, stage, arm_id, session_id, image_name=None, queue_wait=0., payload_bytes=None):
+        """
+        Context manager which measures the duration of a stage. The span is recorded even if the stage fails.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage, like `decode` or `detect`.
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        image_name : str, optional
+            Name of the processed image, if the stage belongs to a single image.
+        queue_wait : float, optional
+            Time in seconds the work waited in a queue before the stage started.
+        payload_bytes : int, optional
+            Size of the stage's input in bytes.
+
+        """
+
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(stage, arm_id, session_id, time.monotonic() - start, start, image_name, queue_wait, payload_bytes)
+
+    def record(self, stage, arm_id, session_id, duration, start=None, image_name=None, queue_wait=0., payload_bytes=None):
+        """
+        Records a span which was measured elsewhere, like in a stitching worker process.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage.
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        duration : float
+            Duration of the stage in seconds.
+        start : float, optional
+            Start of the stage as `time.monotonic()`. If None, the stage is assumed to have just finished.
+        image_name : str, optional
+            Name of the processed image.
+        queue_wait : float, optional
+            Time in seconds the work waited in a queue before the stage started.
+        payload_bytes : int, optional
+            Size of the stage's input in bytes.
+
+        """
+
+        if start is None:
+            start = time.monotonic() - duration
+
+        span = {
+            "stage": stage,
+            "image_name": image_name,
+            "start": start - self.origin,
+            "duration": duration,
+            "queue_wait": queue_wait or 0.,
+            "payload_bytes": payload_bytes,
+            "thread": threading.current_thread().name
+        }
+
+        with self.lock:
+            self.histograms[stage].add(duration, span["queue_wait"])
+
+            # Work which doesn't belong to a session, like saving after images, only counts in the histograms
+            if session_id is None:
+                return
+
+            key = (arm_id, session_id)
+            if key not in self.sessions:
+                self.sessions[key] = deque(maxlen=self.max_spans)
+                while len(self.sessions) > self.max_sessions:
+                    self.sessions.popitem(last=False)
+            self.sessions[key].append(span)
+
+    def summary(self):
+        """
+        Summarizes the rolling histograms of every stage.
+
+        Returns
+        -------
+        summary : dict
+            Dict containing the summary of each stage, see `RollingHistogram.summary`.
+
+        """
+
+        with self.lock:
+            return {stage: histogram.summary() for stage, histogram in sorted(self.histograms.items())}
+
+    def cumulative(self):
+        """
+        Returns the bucket counts of every span since the start of the service, as required by Prometheus histograms.
+
+        Returns
+        -------
+        histograms : dict
+            Dict containing the `buckets` (list of counts, one for each bound of `BUCKETS`), the `count` and the total
+            duration (`sum`) of each stage.
+
+        """
+
+        with self.lock:
+            return {
+                stage: {"buckets": list(histogram.bucket_counts), "count": histogram.count, "sum": histogram.total}
+                for stage, histogram in sorted(self.histograms.items())
+            }
+
+    def timeline(self, arm_id, session_id):
+        """
+        Returns the spans of a session, ordered by their start.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+
+        Returns
+        -------
+        spans : list
+            List of dicts containing the `stage`, `image_name`, `start` (seconds since the first span of the session),
+            `duration`, `queue_wait`, `payload_bytes` and `thread` of each span.
+
+        """
+
+        with self.lock:
+            spans = sorted(self.sessions.get((arm_id, session_id), []), key=lambda span: span["start"])
+
+        if len(spans) == 0:
+            return []
+
+        first = spans[0]["start"]
+        return [dict(span, start=span["start"] - first) for span in spans]
+
+    def chrome_trace(self, arm_id, session_id):
+        """
+        Converts the spans of a session to the Trace Event Format, which can be opened by `chrome://tracing` or
+        Perfetto. Each thread which executed a stage is shown as a separate track.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+
+        Returns
+        -------
+        trace : dict
+            Dict containing the `traceEvents`.
+
+        """
+
+        threads = {}
+        events = [{"name": "process_name", "ph": "M", "pid": 1, "tid": 0, "args": {"name": f"{arm_id} / {session_id}"}}]
+        for span in self.timeline(arm_id, session_id):
+            if span["thread"] not in threads:
+                threads[span["thread"]] = len(threads) + 1
+                events.append({"name": "thread_name", "ph": "M", "pid": 1, "tid": threads[span["thread"]], "args": {"name": span["thread"]}})
+
+            events.append({
+                "name": span["stage"],
+                "cat": "stage",
+                "ph": "X",
+                "pid": 1,
+                "tid": threads[span["thread"]],
+                "ts": round(span["start"] * 1e6),
+                "dur": round(span["duration"] * 1e6),
+                "args": {"image_name": span["image_name"], "queue_wait_ms": span["queue_wait"] * 1e3, "payload_bytes": span["payload_bytes"]}
+            })
+
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def export(self, arm_id, session_id, path, trace_format="chrome"):
+        """
+        Writes the spans of a session to a JSON file.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        path : str
+            Path of the created file.
+        trace_format : str, optional
+            Either `chrome` for the Trace Event Format or `timeline` for the list of spans.
+
+        """
+
+        if trace_format == "chrome":
+            content = self.chrome_trace(arm_id, session_id)
+        elif trace_format == "timeline":
+            content = self.timeline(arm_id, session_id)
+        else:
+            raise ValueError(f"Unknown trace format: '{trace_format}'. Possible values: chrome and timeline.")
+
+        with open(path, "w") as output_file:
+            json.dump(content, output_file)
@@ -0,0 +1,185 @@
+"""
+Background uploader, which sends files to s3 from a bounded queue on a fixed number of threads.
+
+"""
+
+import os
+import time
+import queue
+import atexit
+import random
+import threading
+from pathlib import Path
+
+from utils.timing import Timings
+
+
+class Uploader:
+    """
+    Long-lived upload subsystem. Files are put in a bounded queue and uploaded by a fixed number of worker threads.
+    When the queue is full, `submit` blocks until there is space, which applies backpressure to the producers instead
+    of letting uploads pile up in memory. Failed uploads are retried with exponential backoff and full jitter.
+
+    Parameters
+    ----------
+    s3 : S3
+        Instance of S3 used to upload the files. If None (in local mode), jobs are only logged.
+    bucket_name : str
+        Name of the bucket to upload.
+    logger_instance : logger
+        Logger instance passed from main.
+    workers : int, optional
+        Number of threads uploading files at the same time.
+    queue_size : int, optional
+        Maximum number of files waiting to be uploaded.
+    max_retries : int, optional
+        Number of times a failed upload is retried before giving up.
+    backoff : float, optional
+        Base of the exponential backoff in seconds.
+    timings : Timings, optional
+        Records the duration and queue wait of each upload of a session as an `upload` span.
+
+    """
+
+    def __init__(self, s3, bucket_name, logger_instance, workers=2, queue_size=64, max_retries=3, backoff=0.5, timings=None):
+        self.s3 = s3
+        self.bucket_name = bucket_name
+        self.logger = logger_instance
+        self.timings = timings or Timings()
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stats_lock = threading.Lock()
+        self.counters = {"submitted": 0, "uploaded": 0, "retried": 0, "failed": 0, "blocked_seconds": 0.}
+
+        self.threads = [threading.Thread(target=self.process_uploads, name=f"uploader-{idx}", daemon=True) for idx in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+        # Upload remaining files when the interpreter exits normally
+        atexit.register(self.shutdown)
+
+    def submit(self, file_path, s3_path, log_args=None, block=True):
+        """
+        Adds a file to the upload queue. Blocks if the queue is full, unless `block` is False.
+
+        Parameters
+        ----------
+        file_path : str
+            Path of the file to be uploaded.
+        s3_path : str
+            Path (including filename) where the file should be saved in s3.
+        log_args : dict, optional
+            Arguments to correctly place log entry on the control panel.
+        block : bool, optional
+            If False, the file is not added when the queue is full.
+
+        Returns
+        -------
+        submitted : bool
+            True if the file was added to the queue.
+
+        """
+
+        start = time.monotonic()
+        try:
+            self.queue.put((str(file_path), s3_path, log_args or {}, start), block=block)
+        except queue.Full:
+            return False
+
+        with self.stats_lock:
+            self.counters["submitted"] += 1
+            self.counters["blocked_seconds"] += time.monotonic() - start
+
+        return True
+
+    def process_uploads(self):
+        """
+        Loop running on each worker thread, which uploads files from the queue until a None sentinel is received.
+
+        """
+
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                file_path, s3_path, log_args, enqueued = job
+                payload_bytes = os.path.getsize(file_path) if os.path.exists(file_path) else None
+                with self.timings.span(
+                    "upload", log_args.get("arm_id"), log_args.get("session_id"), Path(file_path).name, time.monotonic() - enqueued, payload_bytes
+                ):
+                    self.upload(file_path, s3_path, log_args)
+            finally:
+                self.queue.task_done()
+
+    def upload(self, file_path, s3_path, log_args):
+        """
+        Uploads a single file, retrying with exponential backoff and full jitter if it fails.
+
+        Parameters
+        ----------
+        file_path : str
+            Path of the file to be uploaded.
+        s3_path : str
+            Path (including filename) where the file should be saved in s3.
+        log_args : dict
+            Arguments to correctly place log entry on the control panel.
+
+        Returns
+        -------
+        success : bool
+            Boolean representing if the upload was successful.
+
+        """
+
+        if self.s3 is None:
+            return True
+
+        for attempt in range(self.max_retries + 1):
+            try:
+                self.s3.upload_file(self.bucket_name, file_path, s3_path)
+                with self.stats_lock:
+                    self.counters["uploaded"] += 1
+                self.logger.info(f"File '{s3_path}' uploaded to s3.", log_args)
+                return True
+            except Exception as error:
+                if attempt == self.max_retries:
+                    with self.stats_lock:
+                        self.counters["failed"] += 1
+                    self.logger.error(f"Uploading '{s3_path}' to s3 failed after {attempt + 1} attempts: {error}", log_args)
+                    return False
+
+                with self.stats_lock:
+                    self.counters["retried"] += 1
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def stats(self):
+        """
+        Returns the counters of the uploader, which can be used to detect backpressure.
+
+        Returns
+        -------
+        stats : dict
+            Dict containing the number of `submitted`, `uploaded`, `retried` and `failed` uploads, the total time in seconds
+            producers were blocked by a full queue (`blocked_seconds`) and the current number of queued files (`queued`).
+
+        """
+
+        with self.stats_lock:
+            return dict(self.counters, queued=self.queue.qsize())
+
+    def shutdown(self):
+        """
+        Waits until the queued files are uploaded, then stops the worker threads. Safe to call multiple times.
+
+        """
+
+        if not any(thread.is_alive() for thread in self.threads):
+            return
+
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
@@ -0,0 +1,124 @@
+"""
+Optimized feature extractor, which runs the vectorizer's backbone without the layers after the output layer and without
+a forward hook. The truncated network can be traced with TorchScript, dynamically quantized and converted to
+channels-last memory format.
+
+"""
+
+import torch
+
+
+# Inference mode is only available in newer versions of PyTorch, fall back to disabling the gradients
+inference_context = getattr(torch, "inference_mode", torch.no_grad)
+
+
+def truncate(model, output_layer):
+    """
+    Creates a network containing the top-level layers of a model up to and including the output layer, followed by
+    flattening. Only correct for models whose forward method calls the top-level layers one after the other (like
+    ResNets or VGGs), which is checked by `validate`.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        The full model.
+    output_layer : str
+        Name of the last top-level layer to be kept.
+
+    Returns
+    -------
+    extractor : torch.nn.Sequential
+        The truncated network.
+
+    """
+
+    names = [name for name, _ in model.named_children()]
+    if output_layer not in names:
+        raise ValueError(f"Model has no top-level layer named '{output_layer}'. Available layers: {', '.join(names)}.")
+
+    layers = []
+    for name, layer in model.named_children():
+        layers.append(layer)
+        if name == output_layer:
+            break
+
+    return torch.nn.Sequential(*layers, torch.nn.Flatten(1))
+
+
+def build_feature_extractor(model, output_layer, input_dimensions, engine="traced", quantize=False, channels_last=False):
+    """
+    Builds an optimized feature extractor from a model.
+
+    Parameters
+    ----------
+    model : torch.nn.Module
+        The full model in evaluation mode.
+    output_layer : str
+        Name of the layer whose outputs are the feature vectors.
+    input_dimensions : tuple
+        Height and width of the inputs, used to trace the network.
+    engine : str, optional
+        Either `sequential` to run the truncated network in eager mode, or `traced` to trace it with TorchScript.
+    quantize : bool, optional
+        If True, the linear layers of the truncated network are quantized to int8 dynamically. Convolutions are not
+        affected by dynamic quantization, so the output layer has to be after a linear layer.
+    channels_last : bool, optional
+        If True, the weights are converted to channels-last memory format, if the installed PyTorch supports it.
+
+    Returns
+    -------
+    extractor : torch.nn.Module
+        Network returning feature vectors of shape (n_images, output_length).
+    memory_format : torch.memory_format
+        Memory format the inputs should be converted to, or None if they can be used as they are.
+
+    Raises
+    ------
+    ValueError
+        If `quantize` is True, but the truncated network has no linear layer.
+
+    """
+
+    extractor = truncate(model, output_layer).eval()
+
+    if quantize:
+        if not any(isinstance(module, torch.nn.Linear) for module in extractor.modules()):
+            raise ValueError(f"The network truncated at '{output_layer}' has no linear layer, dynamic quantization would have no effect.")
+        extractor = torch.quantization.quantize_dynamic(extractor, {torch.nn.Linear}, dtype=torch.qint8)
+
+    memory_format = None
+    if channels_last and hasattr(torch, "channels_last"):
+        memory_format = torch.channels_last
+        extractor = extractor.to(memory_format=memory_format)
+
+    if engine == "traced":
+        example = torch.zeros((1, 3, *input_dimensions))
+        if memory_format is not None:
+            example = example.contiguous(memory_format=memory_format)
+        with torch.no_grad():
+            extractor = torch.jit.trace(extractor, example)
+    elif engine != "sequential":
+        raise ValueError(f"Unknown engine: '{engine}'. Possible values: eager, sequential and traced.")
+
+    return extractor, memory_format
+
+
+def cosine_similarities(expected, actual):
+    """
+    Computes the cosine similarity of each pair of corresponding vectors.
+
+    Parameters
+    ----------
+    expected : torch.Tensor
+        Tensor of shape (n, length).
+    actual : torch.Tensor
+        Tensor of shape (n, length).
+
+    Returns
+    -------
+    similarities : torch.Tensor
+        Tensor of shape (n,).
+
+    """
+
+    return torch.nn.functional.cosine_similarity(expected.float(), actual.float(), dim=1, eps=1e-8)
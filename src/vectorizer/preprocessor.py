@@ -6,9 +6,13 @@ the recognized objects from the original images.
 
 
 import os
+import cv2
+import numpy as np
 from PIL import Image, ImageFile
 from pathlib import Path
 
+from utils.frame_store import attach
+
 # To prevent tests from failing
 ImageFile.LOAD_TRUNCATED_IMAGES = True
 
@@ -22,13 +26,50 @@ class PreProcessor:
     base_img_path : str
         Absolute path where the downloaded images are stored. Inside this folder, appropriate
         subfolder will be automatically created for the cropped images (named "cropped").
+    image_cache : ImageCache, optional
+        Cache of decoded images shared with the other stages. If None, images are not cached.
+    frame_store : FrameStore, optional
+        Store of published frames. Images missing from the cache are attached from here before falling back to disk.
 
     """
 
-    def __init__(self, base_img_path):
+    def __init__(self, base_img_path, image_cache=None, frame_store=None):
         self.base_img_path = base_img_path
+        self.image_cache = image_cache
+        self.frame_store = frame_store
+
+    def load_image(self, arm_id, session_id, image_name):
+        """
+        Returns a decoded original image, from the image cache or the frame store if possible.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the current session.
+        image_name : str
+            Name of the image on disk to be loaded.
+
+        Returns
+        -------
+        img : np.array
+            Decoded image in BGR format. Read-only if it is shared through the image cache or the frame store.
 
-    def run(self, session_id, images):
+        """
+
+        def loader():
+            frame = self.frame_store.get(arm_id, session_id, image_name) if self.frame_store else None
+            if frame is not None:
+                return attach(frame)
+            return cv2.imread(os.path.join(self.base_img_path, session_id, "original", image_name))
+
+        if self.image_cache is None:
+            return loader()
+
+        return self.image_cache.get(arm_id, session_id, image_name, loader=loader)
+
+    def run(self, session_id, images, arm_id=None):
         """
         This method coordinates the preprocessing. It loops though the provided list of images and
         crops all recognized objects from the image.
@@ -41,14 +82,16 @@ class PreProcessor:
         images : list
             List of dicts containing `image_name` and `objects` keys. The `objects` value contains the bounding boxes
             to be cropped.
+        arm_id : str, optional
+            Unique identifier of the robot arm, used to find the decoded images of the session.
 
         """
 
         for image in images:
             # Crop all items
-            self.crop_all_objects(session_id=session_id, image_name=image["image_name"], objects=image["objects"])
+            self.crop_all_objects(session_id=session_id, image_name=image["image_name"], objects=image["objects"], arm_id=arm_id)
 
-    def crop_all_objects(self, session_id, image_name, objects):
+    def crop_all_objects(self, session_id, image_name, objects, arm_id=None):
         """
         This function crops all recognized items from an original image. It has been separated from
         `crop_object` for performance reasons (`Image.open()` is executed only once per image not once per object).
@@ -62,16 +105,20 @@ class PreProcessor:
             Name of the image on disk to be loaded.
         objects : list
             List of dicts containing information about the recognized items. `bbox_dims` will be used here for cropping.
+        arm_id : str, optional
+            Unique identifier of the robot arm, used to find the decoded image of the session.
 
         """
 
-        # Construct absolute path for current image
-        img_path = os.path.join(self.base_img_path, session_id, "original", image_name)
-
         # Create folder with image name if it doesn't exist
         img_folder = os.path.join(self.base_img_path, session_id, "cropped", Path(image_name).stem)
         Path(img_folder).mkdir(parents=True, exist_ok=True)
-        img = Image.open(img_path)
+
+        # Use the decoded image if it's cached or published, otherwise open it from disk
+        if self.image_cache is None and self.frame_store is None:
+            img = Image.open(os.path.join(self.base_img_path, session_id, "original", image_name))
+        else:
+            img = Image.fromarray(cv2.cvtColor(self.load_image(arm_id, session_id, image_name), cv2.COLOR_BGR2RGB))
 
         for obj in objects:
             self.crop_object(img_folder, img, obj["obj_id"], obj["bbox_dims"])
@@ -109,3 +156,96 @@ class PreProcessor:
         cropped_name = f"item_{id}.jpg"
 
         cropped_img.save(os.path.join(img_folder, cropped_name))
+
+    def crop_to_batch(self, arm_id, session_id, images, input_dimensions, stats, save_crops=False):
+        """
+        Crops all objects from the decoded original images and writes them, resized and normalized, directly into
+        a single pre-allocated input batch. Unlike `run`, no cropped image is encoded, written and read back from disk.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the current session.
+        images : list
+            List of dicts containing `image_name` and `objects` keys. The `objects` value contains the bounding boxes
+            to be cropped.
+        input_dimensions : tuple
+            Height and width of the network's input, the crops are resized to these dimensions.
+        stats : dict
+            Dict with `mean` and `std` keys, used to normalize the channels of the crops.
+        save_crops : bool, optional
+            If True, the crops are also saved to the `cropped` folder, the same way as `run` does.
+
+        Returns
+        -------
+        keys : list
+            List of (img_base_angle, obj_id) tuples identifying the crop at the same index of the batch.
+        batch : np.array
+            Array of shape (n_objects, 3, height, width) containing the normalized crops as float32 in RGB order.
+
+        """
+
+        n_objects = sum(len(image["objects"]) for image in images)
+        batch = np.empty((n_objects, 3, *input_dimensions), dtype=np.float32)
+
+        keys = []
+        for image in images:
+            # Load each original image only once
+            img = self.load_image(arm_id, session_id, image["image_name"])
+            img_base_angle = int(Path(image["image_name"]).stem)
+            bboxes = [obj["bbox_dims"] for obj in image["objects"]]
+
+            crops = self.fill_batch(batch, len(keys), img, bboxes, stats)
+            keys += [(img_base_angle, obj["obj_id"]) for obj in image["objects"]]
+
+            if save_crops:
+                img_folder = os.path.join(self.base_img_path, session_id, "cropped", Path(image["image_name"]).stem)
+                Path(img_folder).mkdir(parents=True, exist_ok=True)
+                for obj, crop in zip(image["objects"], crops):
+                    cv2.imwrite(os.path.join(img_folder, f"item_{obj['obj_id']}.jpg"), crop)
+
+        return keys, batch
+
+    def fill_batch(self, batch, start, img, bboxes, stats):
+        """
+        Crops the provided bounding boxes from a decoded image, then resizes and normalizes them into consecutive
+        slots of an input batch. Crops are resized with PIL's bilinear filter, like torchvision's `Resize` does when the
+        crops are loaded from disk, so the vectors of both paths can be clustered together.
+
+        Parameters
+        ----------
+        batch : np.array
+            Array of shape (n, 3, height, width) to be filled, starting at index `start`.
+        start : int
+            Index of the batch where the first crop should be written.
+        img : np.array
+            Decoded image in BGR format, as returned by OpenCV.
+        bboxes : list
+            List of dicts containing `x1`, `y1`, `x2` and `y2` keys as absolute pixel values.
+        stats : dict
+            Dict with `mean` and `std` keys, used to normalize the channels of the crops.
+
+        Returns
+        -------
+        crops : list
+            List of the cropped regions in BGR format. These are views into `img`, not copies.
+
+        """
+
+        height, width = batch.shape[2:]
+        mean = np.array(stats["mean"], dtype=np.float32) * 255
+        std = np.array(stats["std"], dtype=np.float32) * 255
+
+        crops = []
+        for idx, bbox in enumerate(bboxes, start):
+            # Crop is a view into the decoded image, make sure it's at least 1 pixel in both directions
+            crop = img[bbox["y1"]:max(bbox["y2"], bbox["y1"] + 1), bbox["x1"]:max(bbox["x2"], bbox["x1"] + 1)]
+
+            resized = np.asarray(Image.fromarray(cv2.cvtColor(crop, cv2.COLOR_BGR2RGB)).resize((width, height), Image.BILINEAR))
+
+            batch[idx] = ((resized - mean) / std).transpose(2, 0, 1)
+            crops.append(crop)
+
+        return crops
@@ -0,0 +1,97 @@
+"""
+Session-scoped cache of feature vectors, which makes it possible to vectorize the objects while the images of a session
+are arriving, instead of vectorizing all of them at the end of the session.
+
+"""
+
+import threading
+import numpy as np
+from collections import OrderedDict
+
+
+class VectorCache:
+    """
+    Thread-safe store of feature vectors. Vectors are grouped by session, so they can be released together
+    when the session is finished. Within a session, a vector is identified by the image name and the object's id.
+    Vectors of sessions which are never finished are evicted when more than `max_sessions` sessions are cached,
+    in which case `Vectorizer.run` computes them again.
+
+    Parameters
+    ----------
+    max_sessions : int, optional
+        Number of sessions kept in the cache, the least recently used sessions are evicted above this limit.
+
+    """
+
+    def __init__(self, max_sessions=32):
+        self.max_sessions = max_sessions
+        self.lock = threading.Lock()
+        self.sessions = OrderedDict()
+
+    def add(self, arm_id, session_id, image_name, obj_ids, vectors):
+        """
+        Stores the feature vectors of the objects of an image.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        image_name : str
+            Name of the image on which the objects were recognized.
+        obj_ids : list
+            List of object ids, as saved to the database.
+        vectors : list
+            List of feature vectors, in the same order as `obj_ids`.
+
+        """
+
+        with self.lock:
+            session = self.sessions.setdefault((arm_id, session_id), {})
+            self.sessions.move_to_end((arm_id, session_id))
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+            for obj_id, vector in zip(obj_ids, vectors):
+                session[(image_name, obj_id)] = np.asarray(vector, dtype=np.float32)
+
+    def get(self, arm_id, session_id, image_name, obj_id):
+        """
+        Retrieves the feature vector of an object.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        image_name : str
+            Name of the image on which the object was recognized.
+        obj_id : int
+            Id of the object, as saved to the database.
+
+        Returns
+        -------
+        vector : np.array
+            The feature vector or None if it is not in the cache.
+
+        """
+
+        with self.lock:
+            return self.sessions.get((arm_id, session_id), {}).get((image_name, obj_id))
+
+    def release(self, arm_id, session_id):
+        """
+        Removes all vectors of a session from the cache.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+
+        """
+
+        with self.lock:
+            self.sessions.pop((arm_id, session_id), None)
@@ -7,17 +7,22 @@ Any model from torchvision.models can be used for vectorization.
 
 import os
 import ssl
-import time
+import threading
+import traceback
 from pathlib import Path
 from fnmatch import fnmatch
 
 import torch
+import numpy as np
 import torchvision.models as vision_models
 import torchvision.transforms as transforms
 import torchvision.datasets as datasets
 from sklearn.cluster import KMeans
 
 from vectorizer.preprocessor import PreProcessor
+from vectorizer.vector_cache import VectorCache
+from vectorizer.feature_extractor import build_feature_extractor, cosine_similarities, inference_context
+from utils.timing import Timings
 
 
 # To avoid SSL certificate error when downloading PyTorch model
@@ -82,6 +87,34 @@ class Vectorizer:
         User by PyTorch's DataLoader to determine how many subprocesses to use for data
         loading. Use 0 to load everything on the main process, use a higher number for
         parallel loading.
+    streaming : bool, optional
+        If True, objects are cropped from the decoded original images straight into an input batch in memory.
+        If False, cropped images are written to disk and loaded back with a DataLoader.
+    save_crops : bool, optional
+        Only used in streaming mode. If True, the cropped images are also saved to disk as a side output.
+    image_cache : ImageCache, optional
+        Cache of decoded images, used by the preprocessor to avoid decoding the original images again.
+    frame_store : FrameStore, optional
+        Store of published frames, used by the preprocessor if an image is not in the cache.
+    weights_path : str, optional
+        Path of the model's state dict. If the file exists, weights are loaded from it instead of being downloaded,
+        otherwise the downloaded pretrained weights are saved there for the next start.
+    engine : str, optional
+        Inference engine used to compute the vectors. `eager` runs the full model and copies the output layer's results
+        with a forward hook. `sequential` runs the network truncated at the output layer, `traced` runs the truncated
+        network traced with TorchScript. See `feature_extractor.build_feature_extractor`.
+    quantize : bool, optional
+        Only used with the truncated engines. If True, linear layers are quantized to int8 dynamically. Raises ValueError
+        if the network truncated at the output layer has no linear layer.
+    channels_last : bool, optional
+        Only used with the truncated engines. If True, the network runs in channels-last memory format.
+    min_similarity : float, optional
+        The vectors of the truncated engines are compared with the eager engine's vectors when the Vectorizer is created.
+        If the cosine similarity of any vector is lower than this, the eager engine is used.
+    timings : Timings, optional
+        Records the durations of cropping, vectorization and clustering as `crop`, `vectorize` and `cluster` spans.
+    cache_sessions : int, optional
+        Maximum number of sessions whose precomputed vectors are kept, see `VectorCache`.
 
     """
 
@@ -94,7 +127,18 @@ class Vectorizer:
             output_length=512,
             stats=None,
             batch_size=1024,
-            num_workers=4):
+            num_workers=4,
+            streaming=True,
+            save_crops=False,
+            image_cache=None,
+            frame_store=None,
+            weights_path=None,
+            engine="eager",
+            quantize=False,
+            channels_last=False,
+            min_similarity=0.99,
+            timings=None,
+            cache_sessions=32):
 
         # Assign mutable default value here to avoid unexpected behavior
         if stats is None:
@@ -105,15 +149,32 @@ class Vectorizer:
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.output_length = output_length
+        self.input_dimensions = input_dimensions
+        self.stats = stats
+        self.streaming = streaming
+        self.save_crops = save_crops
+        self.timings = timings or Timings()
+
+        # Dataset, dataloader and the forward hook are shared state, so only one batch can be vectorized at a time
+        self.lock = threading.RLock()
+
+        # Feature vectors computed while the images of a session are arriving
+        self.vector_cache = VectorCache(max_sessions=cache_sessions)
 
         # Init PreProcessor
-        self.preprocessor = PreProcessor(base_img_path=base_img_path)
+        self.preprocessor = PreProcessor(base_img_path=base_img_path, image_cache=image_cache, frame_store=frame_store)
 
         # Retrieve selected model
         model_factory = getattr(vision_models, model_name)
 
-        # Load the pretrained model
-        self.model = model_factory(pretrained=True)
+        # Load the pretrained model, from disk if possible to avoid downloading it on every start
+        if weights_path is not None and Path(weights_path).exists():
+            self.model = model_factory(pretrained=False)
+            self.model.load_state_dict(torch.load(weights_path, map_location="cpu"))
+        else:
+            self.model = model_factory(pretrained=True)
+            if weights_path is not None:
+                self.save_weights(weights_path)
 
         # Select the output layer
         self.layer = self.model._modules.get(output_layer)
@@ -121,6 +182,21 @@ class Vectorizer:
         # Set model to evaluation mode
         self.model.eval()
 
+        # Build the optimized feature extractor and make sure it returns the same vectors as the full model
+        self.engine = "eager"
+        self.extractor = None
+        self.memory_format = None
+        self.similarity = None
+        if engine != "eager":
+            extractor, memory_format = build_feature_extractor(
+                self.model, output_layer, input_dimensions, engine=engine, quantize=quantize, channels_last=channels_last
+            )
+            self.similarity = self.validate_extractor(extractor, memory_format)
+            if self.similarity >= min_similarity:
+                self.engine, self.extractor, self.memory_format = engine, extractor, memory_format
+            else:
+                print(f"Cosine similarity of the '{engine}' engine's vectors is {self.similarity:.4f}, falling back to the eager engine.")
+
         # Set up transforms based on the selected model
         self.data_transforms = transforms.Compose(
             [
@@ -130,17 +206,21 @@ class Vectorizer:
             ]
         )
 
-    def run(self, session_id, unique_images, objects, n_containers):
+    def run(self, arm_id, session_id, unique_images, objects, n_containers):
         """
-        This method coordinates the process of vectorization. First, it run's the preprocessor
-        to crop the bounding boxes from the original images, then runs the vectorizer on the cropped
-        images and finally clusters the resulting vectors.
+        This method coordinates the process of vectorization. First, it looks up the feature vectors already computed
+        while the images were arriving. For the remaining objects, it runs the preprocessor to crop the bounding boxes
+        from the original images and runs the vectorizer on the cropped images. Finally it clusters the resulting vectors.
 
         Parameters
         ----------
+        arm_id : str
+            Unique identifier of the robot arm, used to look up cached vectors.
         session_id : str
             Datetime based unique identifier of the current session. It is generated by the Raspberry Pi and passed
             with the POST request.
+        unique_images : list
+            List of the names of the images in the current session.
         objects : list
             List of dicts containing information describing the recognized objects. `image_name` and `bbox_dims` are
             needed here for cropping the items.
@@ -155,39 +235,79 @@ class Vectorizer:
 
         """
 
+        image_names = {int(Path(unique_image).stem): unique_image for unique_image in unique_images}
+
+        # Use vectors computed when the images arrived, and collect the objects which still need to be vectorized
+        keys = []
+        vectors = []
+        missing_objects = []
+        for obj in objects:
+            vector = self.vector_cache.get(arm_id, session_id, image_names[obj["img_base_angle"]], obj["obj_id"])
+            if vector is None:
+                missing_objects.append(obj)
+            else:
+                keys.append((obj["img_base_angle"], obj["obj_id"]))
+                vectors.append(vector.tolist())
+
         # Transform list of objects to a nested list of images to avoid opening and closing the same image multiple times.
         images = []
         for unique_image in unique_images:
             img_base_angle = int(Path(unique_image).stem)
-            objects_of_img = list(filter(lambda obj: obj["img_base_angle"] == img_base_angle, objects))
+            objects_of_img = list(filter(lambda obj: obj["img_base_angle"] == img_base_angle, missing_objects))
             if len(objects_of_img) > 0:
                 images.append({
                     "image_name": unique_image,
                     "objects": objects_of_img
                 })
 
-        # Download and crop images around bounding boxes
-        self.preprocessor.run(session_id, images)
-
-        # Create dataset for vectorization
-        images_found = self.load_data(Path(self.base_img_path).joinpath(session_id, "cropped"))
-
-        if not images_found:
+        if len(images) > 0:
+            with self.lock:
+                if self.streaming:
+                    # Crop objects straight into an input batch, without writing and reading back cropped images
+                    with self.timings.span("crop", arm_id, session_id):
+                        computed_keys, batch = self.preprocessor.crop_to_batch(
+                            arm_id, session_id, images, self.input_dimensions, self.stats, self.save_crops
+                        )
+                    with self.timings.span("vectorize", arm_id, session_id, payload_bytes=batch.nbytes):
+                        computed_vectors = self.compute_vectors_of_batch(torch.from_numpy(batch))
+                else:
+                    # Download and crop images around bounding boxes
+                    with self.timings.span("crop", arm_id, session_id):
+                        self.preprocessor.run(session_id, images, arm_id=arm_id)
+
+                        # Create dataset for vectorization
+                        images_found = self.load_data(Path(self.base_img_path).joinpath(session_id, "cropped"))
+
+                    computed_keys, computed_vectors = [], []
+                    if images_found:
+                        # Run vectorizer
+                        with self.timings.span("vectorize", arm_id, session_id):
+                            filenames, computed_vectors = self.compute_vectors()
+                        computed_keys = [
+                            (int(str(Path(filename).parent)), int(str(Path(filename).stem).split("_")[1])) for filename in filenames
+                        ]
+
+            # Skip crops left on disk from earlier runs which were already found in the cache
+            cached_keys = set(keys)
+            for key, vector in zip(computed_keys, computed_vectors):
+                if key not in cached_keys:
+                    keys.append(key)
+                    vectors.append(vector)
+
+        if len(keys) == 0:
             return []
 
-        # Run vectorizer
-        filenames, vectors = self.compute_vectors()
-
         # Compute clusters
-        clusters = KMeans(n_clusters=n_containers).fit_predict(vectors)
+        with self.timings.span("cluster", arm_id, session_id):
+            clusters = KMeans(n_clusters=n_containers).fit_predict(vectors)
 
         # Convert numpy int32 to int so they are JSON serializable
         clusters = [int(cluster) for cluster in clusters]
         pairings = [{
-            "image_id": int(str(Path(result[0]).parent)),
-            "obj_id": int(str(Path(result[0]).stem).split("_")[1]),
-            "cluster": result[1]
-        } for result in zip(filenames, clusters)]
+            "image_id": image_id,
+            "obj_id": obj_id,
+            "cluster": cluster
+        } for (image_id, obj_id), cluster in zip(keys, clusters)]
 
         return pairings
 
@@ -250,28 +370,207 @@ class Vectorizer:
             # Get filenames and object names from paths
             batch_filenames = [f"{self.dataset.classes[label]}/{os.path.basename(path)}" for label, path in zip(labels, paths)]
 
-            # Start timer
-            start_time = time.time()
+            # Run inference on the batch
+            batch_vectors = self.vectorize_batch(inputs)
+
+            # Append batch filenames to global filenames list
+            filenames += batch_filenames
+
+            # Append batch vectors to global vector list and convert tensors to lists
+            vectors += [batch_vector.numpy().tolist() for batch_vector in batch_vectors]
+
+        return filenames, vectors
+
+    def compute_vectors_of_batch(self, inputs):
+        """
+        This function runs the inference on an input batch already in memory, splitting it into chunks of `batch_size`.
+
+        Parameters
+        ----------
+        inputs : torch.Tensor
+            Tensor of shape (n_images, 3, height, width) containing the normalized images.
+
+        Returns
+        -------
+        vectors : list
+            List of resulting vectors, in the same order as the inputs.
+
+        """
+
+        vectors = []
+        for start in range(0, inputs.shape[0], self.batch_size):
+            batch_vectors = self.vectorize_batch(inputs[start:start + self.batch_size])
+            vectors += [batch_vector.numpy().tolist() for batch_vector in batch_vectors]
+
+        return vectors
+
+    def vectorize_batch(self, inputs):
+        """
+        Computes the feature vectors of a single batch with the selected engine.
+
+        Parameters
+        ----------
+        inputs : torch.Tensor
+            Tensor of shape (n_images, 3, height, width) containing the normalized images.
+
+        Returns
+        -------
+        batch_vectors : torch.Tensor
+            Tensor of shape (n_images, output_length) containing the feature vectors.
+
+        """
+
+        if self.extractor is None:
+            return self.vectorize_batch_eager(inputs)
+
+        return self.extract_batch(self.extractor, self.memory_format, inputs)
+
+    def extract_batch(self, extractor, memory_format, inputs):
+        """
+        Runs a truncated feature extractor on a single batch. The extractor has no shared state,
+        so batches can be processed concurrently.
+
+        Parameters
+        ----------
+        extractor : torch.nn.Module
+            Feature extractor, as returned by `build_feature_extractor`.
+        memory_format : torch.memory_format
+            Memory format of the extractor's inputs, None if the inputs can be used as they are.
+        inputs : torch.Tensor
+            Tensor of shape (n_images, 3, height, width) containing the normalized images.
+
+        Returns
+        -------
+        batch_vectors : torch.Tensor
+            Tensor of shape (n_images, output_length) containing the feature vectors.
+
+        """
 
-            # Create zero-filled vectors to store results
-            batch_vectors = torch.zeros((inputs.shape[0], self.output_length))
+        if memory_format is not None:
+            inputs = inputs.contiguous(memory_format=memory_format)
 
-            # Define function to copy outputs of a layer
-            def copy_data(model, input, output):
-                batch_vectors.copy_(output.data.squeeze())
+        with inference_context():
+            return extractor(inputs).reshape(inputs.shape[0], -1)
 
+    def validate_extractor(self, extractor, memory_format, n_images=8):
+        """
+        Compares the vectors of a feature extractor with the vectors of the eager engine on random inputs.
+
+        Parameters
+        ----------
+        extractor : torch.nn.Module
+            Feature extractor, as returned by `build_feature_extractor`.
+        memory_format : torch.memory_format
+            Memory format of the extractor's inputs.
+        n_images : int, optional
+            Number of random images used for the comparison.
+
+        Returns
+        -------
+        similarity : float
+            The lowest cosine similarity between the vectors of the same image.
+
+        """
+
+        generator = torch.Generator().manual_seed(0)
+        inputs = torch.randn((n_images, 3, *self.input_dimensions), generator=generator)
+
+        expected = self.vectorize_batch_eager(inputs)
+        actual = self.extract_batch(extractor, memory_format, inputs)
+
+        return float(cosine_similarities(expected, actual).min())
+
+    def vectorize_batch_eager(self, inputs):
+        """
+        Runs the full model on a single batch and copies the outputs of the selected layer.
+
+        Parameters
+        ----------
+        inputs : torch.Tensor
+            Tensor of shape (n_images, 3, height, width) containing the normalized images.
+
+        Returns
+        -------
+        batch_vectors : torch.Tensor
+            Tensor of shape (n_images, output_length) containing the feature vectors.
+
+        """
+
+        # Create zero-filled vectors to store results
+        batch_vectors = torch.zeros((inputs.shape[0], self.output_length))
+
+        # Define function to copy outputs of a layer
+        def copy_data(model, input, output):
+            batch_vectors.copy_(output.data.reshape(inputs.shape[0], -1))
+
+        with self.lock:
             # Register copy function to the specified layer
             hook = self.layer.register_forward_hook(copy_data)
 
             # Run inference
-            self.model(inputs)
+            with torch.no_grad():
+                self.model(inputs)
 
             hook.remove()
 
-            # Append batch filenames to global filenames list
-            filenames += batch_filenames
+        return batch_vectors
 
-            # Append batch vectors to global vector list and convert tensors to lists
-            vectors += [batch_vector.numpy().tolist() for batch_vector in batch_vectors]
+    def save_weights(self, weights_path):
+        """
+        Saves the state dict of the model, so it can be loaded without downloading it. Failing to save is not fatal,
+        the weights are downloaded again at the next start in that case.
 
-        return filenames, vectors
+        Parameters
+        ----------
+        weights_path : str
+            Path where the state dict is saved.
+
+        """
+
+        try:
+            # Write to a temporary file first, so other processes never load partially written weights
+            Path(weights_path).parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = f"{weights_path}.{os.getpid()}.tmp"
+            torch.save(self.model.state_dict(), tmp_path)
+            os.replace(tmp_path, weights_path)
+        except OSError:
+            traceback.print_exc()
+
+    def warm_up(self):
+        """
+        Runs the model on a blank batch, so the lazy initialization of Torch happens before the first request.
+
+        """
+
+        self.vectorize_batch(torch.zeros((1, 3, *self.input_dimensions)))
+
+    def cache_object_vectors(self, arm_id, session_id, image_name, img, objects):
+        """
+        Computes the feature vectors of the objects of a single image, which is already decoded in memory,
+        and stores them in the vector cache, so `run` doesn't have to compute them at the end of the session.
+
+        Parameters
+        ----------
+        arm_id : str
+            Unique identifier of the robot arm.
+        session_id : str
+            Unique identifier of the session.
+        image_name : str
+            Name of the image on which the objects were recognized.
+        img : np.array
+            Decoded image in BGR format.
+        objects : list
+            List of dicts containing `id` and `bbox_dims` keys.
+
+        """
+
+        if len(objects) == 0:
+            return
+
+        batch = np.empty((len(objects), 3, *self.input_dimensions), dtype=np.float32)
+        with self.timings.span("crop", arm_id, session_id, image_name):
+            self.preprocessor.fill_batch(batch, 0, img, [obj["bbox_dims"] for obj in objects], self.stats)
+        with self.timings.span("vectorize", arm_id, session_id, image_name, payload_bytes=batch.nbytes):
+            vectors = self.compute_vectors_of_batch(torch.from_numpy(batch))
+
+        self.vector_cache.add(arm_id, session_id, image_name, [obj["id"] for obj in objects], vectors)
@@ -0,0 +1,70 @@
+"""
+Original, pairwise implementation of `utils.coord_conversion.filter_duplicates`. It is kept as a reference
+for testing the equivalence of the grid based implementation and for benchmarking.
+
+"""
+
+import numpy as np
+
+
+def filter_duplicates(objects, threshold=150):
+    """
+    Filters out the bounding boxes that belong to the same object, but showed up on a different image.
+
+    Parameters
+    ----------
+    objects : list
+        List of dicts, containing the absolute coordinates of the objects.
+    threshold: int
+        Distance within that objects are considered the same.
+
+    Returns
+    -------
+    filtered_objs : list
+        List of the absolute coordinates of the unique objects.
+
+    """
+
+    def in_range(loc, loc_in, idx):
+        return (loc[idx] - threshold) < loc_in[idx] and loc_in[idx] < (loc[idx] + threshold)
+
+    filtered_objs = []
+    for obj in objects:
+        loc = obj["polar_coords"]
+
+        # Skip iteration if current location was already processed
+        if loc is None:
+            continue
+
+        # Initialize current cluster with outer location
+        locs_in_range = [loc]
+
+        # Loop through on the location once for each element to check if they belong to the same object
+        for obj_in in objects:
+            loc_in = obj_in["polar_coords"]
+
+            # Skip iteration if current location was already processed or is the same as the outer one
+            if loc == loc_in or loc_in is None:
+                continue
+
+            # If both coordinates are within range
+            if in_range(loc, loc_in, 0) and in_range(loc, loc_in, 1):
+                # Add item to current cluster
+                locs_in_range.append(loc_in)
+                # Remove processed inner location from locations
+                obj_in_idx = objects.index(obj_in)
+                objects[obj_in_idx]["polar_coords"] = None
+
+        # Remove processed outer location from locations
+        obj_idx = objects.index(obj)
+        objects[obj_idx]["polar_coords"] = None
+
+        # Append cluster to results
+        filtered_objs.append({
+            "img_base_angle": obj["img_base_angle"],
+            "obj_id": obj["obj_id"],
+            "avg_polar_coords": tuple(np.average(np.array(locs_in_range), axis=0)),
+            "bbox_dims": obj["bbox_dims"],
+        })
+
+    return filtered_objs
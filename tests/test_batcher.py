@@ -0,0 +1,70 @@
+import threading
+
+import pytest
+
+from locator.batcher import MicroBatcher
+
+
+def submit_concurrently(batcher, items):
+    results = {}
+
+    def submit(item):
+        try:
+            results[item] = batcher.submit(item)
+        except Exception as error:
+            results[item] = error
+
+    threads = [threading.Thread(target=submit, args=(item,)) for item in items]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=5)
+
+    return results
+
+
+def test_results_are_returned_to_submitters():
+    batcher = MicroBatcher(lambda items: [item * 2 for item in items], max_batch_size=4, max_wait_ms=50)
+    try:
+        assert submit_concurrently(batcher, range(6)) == {item: item * 2 for item in range(6)}
+    finally:
+        batcher.close()
+
+
+def test_missing_results_fail_the_batch():
+    batcher = MicroBatcher(lambda items: items[1:], max_batch_size=4, max_wait_ms=50)
+    try:
+        results = submit_concurrently(batcher, range(3))
+        assert len(results) == 3
+        assert all(isinstance(result, ValueError) for result in results.values())
+
+        # The batcher keeps running after a failed batch
+        batcher.run_batch = lambda items: items
+        assert batcher.submit(7) == 7
+    finally:
+        batcher.close()
+
+
+def test_error_after_partial_results_keeps_batcher_alive():
+    def results(items):
+        yield items[0]
+        raise RuntimeError("Failed after the first result.")
+
+    batcher = MicroBatcher(results, max_batch_size=1, max_wait_ms=0)
+    try:
+        with pytest.raises(RuntimeError):
+            batcher.submit(1)
+        assert batcher.thread.is_alive()
+    finally:
+        batcher.close()
+
+
+def test_close_stops_the_thread():
+    batcher = MicroBatcher(lambda items: items, max_batch_size=4, max_wait_ms=50)
+    assert batcher.submit(1) == 1
+
+    batcher.close()
+    batcher.close()
+    assert not batcher.thread.is_alive()
+    with pytest.raises(RuntimeError):
+        batcher.submit(2)
@@ -0,0 +1,116 @@
+import pytest
+
+from utils.chunks import ChunkAssembler
+
+
+def chunk_headers(image_name, total_size, offset, command="recv_img_proc"):
+    return {"command": command, "session_id": "test_session", "image_name": image_name, "total_size": total_size, "offset": offset}
+
+
+def send(assembler, image_name, content, chunk_size):
+    result = None
+    for offset in range(0, len(content), chunk_size):
+        assert result is None
+        result = assembler.add(chunk_headers(image_name, len(content), offset), memoryview(content)[offset:offset + chunk_size])
+
+    return result
+
+
+def test_is_chunk():
+    assert ChunkAssembler.is_chunk(chunk_headers("1000.jpg", 10, 0))
+    assert not ChunkAssembler.is_chunk({"command": "recv_img_proc"})
+
+
+@pytest.mark.parametrize("chunk_size", [1, 7, 100, 1000])
+def test_reassembles_image(chunk_size):
+    content = bytes(range(256)) * 4
+    assembler = ChunkAssembler(max_size=2000)
+
+    assert send(assembler, "1000.jpg", content, chunk_size) == content
+    assert assembler.pending_bytes() == 0
+
+
+def test_interleaved_uploads():
+    assembler = ChunkAssembler(max_size=100)
+
+    assert assembler.add(chunk_headers("1000.jpg", 4, 0), b"ab") is None
+    assert assembler.add(chunk_headers("1000.jpg", 4, 0, command="recv_img_after"), b"wx") is None
+    assert assembler.pending_bytes() == 8
+    assert assembler.add(chunk_headers("1000.jpg", 4, 2), b"cd") == b"abcd"
+    assert assembler.add(chunk_headers("1000.jpg", 4, 2, command="recv_img_after"), b"yz") == b"wxyz"
+
+
+def test_rejects_too_large_upload():
+    assembler = ChunkAssembler(max_size=10)
+
+    assert assembler.add(chunk_headers("1000.jpg", 11, 0), b"a") is None
+    with pytest.raises(ValueError):
+        assembler.add(chunk_headers("1000.jpg", 11, 1), b"a" * 10)
+
+
+def test_rejects_too_many_pending_uploads():
+    assembler = ChunkAssembler(max_size=10, max_pending=1)
+    assembler.add(chunk_headers("1000.jpg", 4, 0), b"ab")
+
+    assert assembler.add(chunk_headers("1100.jpg", 4, 0), b"ab") is None
+    with pytest.raises(ValueError):
+        assembler.add(chunk_headers("1100.jpg", 4, 2), b"cd")
+
+
+@pytest.mark.parametrize("offset, chunk", [(3, b"cd"), (1, b"cd"), (2, b"cde")])
+def test_discards_upload_on_invalid_chunk(offset, chunk):
+    assembler = ChunkAssembler(max_size=10)
+    assembler.add(chunk_headers("1000.jpg", 4, 0), b"ab")
+
+    # Only the last chunk of the upload is rejected
+    if offset + len(chunk) < 4:
+        assert assembler.add(chunk_headers("1000.jpg", 4, offset), chunk) is None
+        offset, chunk = 3, b"d"
+    with pytest.raises(ValueError):
+        assembler.add(chunk_headers("1000.jpg", 4, offset), chunk)
+    assert assembler.pending_bytes() == 0
+
+
+def test_upload_has_to_start_at_zero():
+    assembler = ChunkAssembler(max_size=10)
+
+    with pytest.raises(ValueError):
+        assembler.add(chunk_headers("1000.jpg", 4, 2), b"cd")
+
+
+def test_broken_upload_is_rejected_once():
+    assembler = ChunkAssembler(max_size=100)
+    replies = []
+    # The third chunk is lost, so the rest don't continue the upload
+    for offset in (0, 10, 30, 40):
+        try:
+            replies.append(assembler.add(chunk_headers("1000.jpg", 50, offset), b"a" * 10))
+        except ValueError:
+            replies.append(False)
+
+    assert replies == [None, None, None, False]
+    assert assembler.pending_bytes() == 0
+    assert not assembler.discarded
+
+    # The image can be uploaded again
+    assert send(assembler, "1000.jpg", b"a" * 50, 10) == b"a" * 50
+
+
+def test_too_large_upload_is_rejected_once():
+    assembler = ChunkAssembler(max_size=10)
+    replies = []
+    for offset in range(0, 40, 10):
+        try:
+            replies.append(assembler.add(chunk_headers("1000.jpg", 40, offset), b"a" * 10))
+        except ValueError:
+            replies.append(False)
+
+    assert replies == [None, None, None, False]
+
+
+def test_discarded_uploads_are_bounded():
+    assembler = ChunkAssembler(max_size=10, max_discarded=2)
+    for image_name in ("1000.jpg", "1100.jpg", "1200.jpg"):
+        assert assembler.add(chunk_headers(image_name, 20, 0), b"a" * 10) is None
+
+    assert list(assembler.discarded) == [("recv_img_proc", "test_session", "1100.jpg"), ("recv_img_proc", "test_session", "1200.jpg")]
@@ -0,0 +1,134 @@
+import copy
+import pytest
+import numpy as np
+
+import legacy_coord_conversion
+from utils.coord_conversion import object_to_polar, objects_to_polar, filter_duplicates, filter_duplicates_array, polar_to_dicts
+
+
+arm_constants = {"arm_radius": 1600, "rotation_range_as_pw": 1000, "rotation_range_as_deg": 90, "dist_min_as_pw": 1300, "dist_max_as_pw": 2000}
+
+
+def generate_objects(n_objects, n_duplicates, spread, seed):
+    """
+    Generates objects scattered around random centers, like the same object showing up on multiple images.
+
+    """
+
+    rng = np.random.RandomState(seed)
+    centers = rng.uniform(0, 3000, size=(n_objects, 2))
+    objects = []
+    for obj_id, center in enumerate(np.repeat(centers, n_duplicates, axis=0)):
+        loc = center + rng.uniform(-spread, spread, size=2)
+        objects.append({
+            "img_base_angle": int(rng.randint(1000, 2000)),
+            "obj_id": obj_id,
+            "polar_coords": (float(loc[0]), float(loc[1]),),
+            "bbox_dims": {"x1": 0, "y1": 0, "x2": 10, "y2": 10}
+        })
+    rng.shuffle(objects)
+
+    return objects
+
+
+def make_objects(locs):
+    return [
+        {"img_base_angle": 1000, "obj_id": obj_id, "polar_coords": loc, "bbox_dims": {"x1": 0, "y1": 0, "x2": 10, "y2": 10}}
+        for obj_id, loc in enumerate(locs)
+    ]
+
+
+class TestFilterDuplicates:
+    @pytest.mark.parametrize("n_objects, n_duplicates, spread, seed", [
+        (0, 1, 0, 0),
+        (1, 1, 0, 0),
+        (20, 3, 60, 1),
+        (50, 4, 120, 2),
+        (200, 2, 300, 3),
+        (500, 5, 80, 4),
+    ])
+    def test_equivalent_to_legacy(self, n_objects, n_duplicates, spread, seed):
+        objects = generate_objects(n_objects, n_duplicates, spread, seed)
+
+        expected = legacy_coord_conversion.filter_duplicates(copy.deepcopy(objects))
+        results = filter_duplicates(objects)
+
+        assert results == expected
+
+    @pytest.mark.parametrize("threshold", [50, 150, 400])
+    def test_threshold(self, threshold):
+        objects = generate_objects(100, 3, 150, 5)
+
+        expected = legacy_coord_conversion.filter_duplicates(copy.deepcopy(objects), threshold=threshold)
+        results = filter_duplicates(objects, threshold=threshold)
+
+        assert results == expected
+
+    def test_edge_cases(self):
+        # Locations exactly at threshold distance, identical locations, negative and grid boundary coordinates
+        objects = make_objects([
+            (0., 0.), (150., 0.), (149.99, 149.99), (0., 0.), (-149., 10.), (300., 300.), (449.5, 151.), (-0.5, -300.),
+        ])
+
+        expected = legacy_coord_conversion.filter_duplicates(copy.deepcopy(objects))
+        results = filter_duplicates(objects)
+
+        assert results == expected
+
+    def test_does_not_modify_input(self):
+        objects = generate_objects(30, 3, 60, 6)
+        objects_copy = copy.deepcopy(objects)
+
+        filter_duplicates(objects)
+
+        assert objects == objects_copy
+
+
+def generate_boxes(n_boxes, seed):
+    rng = np.random.RandomState(seed)
+    x1 = rng.randint(0, 1500, size=n_boxes)
+    y1 = rng.randint(0, 1100, size=n_boxes)
+    bboxes = np.stack([x1, y1, x1 + rng.randint(1, 140, size=n_boxes), y1 + rng.randint(1, 130, size=n_boxes)], axis=1)
+    # Boxes centered horizontally, where the sine of the angle is zero
+    bboxes[:5] = [[800, 100, 840, 200], [810, 0, 830, 40], [0, 50, 1640, 60], [819, 500, 821, 600], [700, 10, 940, 20]]
+    img_base_angles = rng.choice([1200, 1500, 1700], size=n_boxes)
+
+    return img_base_angles, np.arange(n_boxes), np.tile([1640, 1232], (n_boxes, 1)), bboxes
+
+
+def to_objects(img_base_angles, obj_ids, img_dims, bboxes):
+    return [(f"{angle}.jpg", {
+        "id": int(obj_id),
+        "img_dims": tuple(dims.tolist()),
+        "bbox_dims": dict(zip(("x1", "y1", "x2", "y2"), bbox.tolist()))
+    }) for angle, obj_id, dims, bbox in zip(img_base_angles, obj_ids, img_dims, bboxes)]
+
+
+class TestObjectsToPolar:
+    @pytest.mark.parametrize("n_boxes, seed", [(5, 0), (100, 1), (1000, 2)])
+    def test_identical_to_scalar(self, n_boxes, seed):
+        arrays = generate_boxes(n_boxes, seed)
+
+        polar = objects_to_polar(arm_constants, *arrays)
+
+        for record, (image_name, obj) in zip(polar, to_objects(*arrays)):
+            expected = object_to_polar(arm_constants, image_name, obj)
+            assert record["img_base_angle"] == expected["img_base_angle"]
+            assert record["obj_id"] == expected["obj_id"]
+            assert tuple(record["polar_coords"].tolist()) == expected["polar_coords"]
+
+    def test_zero_division(self):
+        # Box center at the distance of arm_radius below the image center
+        arrays = ([1200], [0], [[1640, 1232]], [[10, 2200, 20, 2232]])
+
+        with pytest.raises(ZeroDivisionError):
+            object_to_polar(arm_constants, *to_objects(*(np.asarray(array) for array in arrays))[0])
+        with pytest.raises(ZeroDivisionError):
+            objects_to_polar(arm_constants, *arrays)
+
+    def test_filter_duplicates_array(self):
+        arrays = generate_boxes(300, 3)
+        polar = objects_to_polar(arm_constants, *arrays)
+        objects = [object_to_polar(arm_constants, image_name, obj) for image_name, obj in to_objects(*arrays)]
+
+        assert polar_to_dicts(filter_duplicates_array(polar)) == filter_duplicates(objects)
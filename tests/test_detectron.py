@@ -30,6 +30,14 @@ class TestDetectron:
             threshold=0.5
         )
 
+        cls.traced_detectron = Detectron(
+            base_img_path=cls.base_img_path.as_posix(),
+            model_config="COCO-Detection/faster_rcnn_R_50_FPN_3x.yaml",
+            threshold=0.5,
+            engine="traced",
+            image_dims=(1232, 1640)
+        )
+
     @pytest.mark.parametrize('image_name, expected_results', exp_val_detectron)
     def test_predict(self, image_name, expected_results):
 
@@ -40,6 +48,18 @@ class TestDetectron:
             # print(results)
             assert results == expected_results
 
+    @pytest.mark.parametrize('image_name, expected_results', exp_val_detectron)
+    def test_traced_engine_matches_eager(self, image_name, expected_results):
+        assert self.traced_detectron.engine == "traced"
+
+        img = cv2.imread(self.tmp_path.joinpath("original", image_name).as_posix())
+        results = self.traced_detectron.predict("test_session", image_name, img)
+
+        assert len(results) == len(expected_results)
+        for result, expected in zip(results, expected_results):
+            assert result["class"] == expected["class"]
+            assert all(abs(result[key] - expected[key]) <= 1 for key in ("x1", "y1", "x2", "y2"))
+
     @classmethod
     def teardown_class(cls):
         shutil.rmtree(cls.tmp_path)
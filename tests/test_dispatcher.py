@@ -0,0 +1,37 @@
+import time
+import asyncio
+
+from utils.dispatcher import Dispatcher
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+class Handlers:
+    base_img_path = "images"
+
+    def __init__(self):
+        self.calls = []
+
+    def handle(self, arm, idx):
+        time.sleep(0.01)
+        self.calls.append((arm, idx))
+        return idx
+
+
+def test_jobs_of_an_arm_keep_their_order_and_locks_are_removed():
+    handlers = Handlers()
+    dispatcher = Dispatcher(handlers, max_workers=4)
+
+    async def run_jobs():
+        return await asyncio.gather(*[dispatcher.run(f"arm_{idx % 2}", "handle", arm=f"arm_{idx % 2}", idx=idx) for idx in range(8)])
+
+    try:
+        assert run(run_jobs()) == list(range(8))
+    finally:
+        dispatcher.shutdown()
+
+    assert [idx for arm, idx in handlers.calls if arm == "arm_0"] == [0, 2, 4, 6]
+    assert dispatcher.arm_locks == {}
+    assert dispatcher.arm_jobs == {}
@@ -0,0 +1,137 @@
+import os
+import pytest
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+from utils.frame_store import FrameStore, attach
+
+
+def checksum(frame):
+    return int(attach(frame).sum())
+
+
+@pytest.fixture
+def frame_store(tmp_path):
+    store = FrameStore(base_img_path=tmp_path.as_posix())
+    yield store
+    store.shutdown()
+
+
+def make_image(value):
+    img = np.zeros((20, 30, 3), dtype=np.uint8)
+    img[:, :, 0] = value
+    return img
+
+
+def test_publish_returns_read_only_copy(frame_store):
+    img = frame_store.publish("arm", "session", "1000.jpg", make_image(7))
+
+    assert img.shape == (20, 30, 3)
+    assert img.dtype == np.uint8
+    assert (img[:, :, 0] == 7).all()
+    with pytest.raises(ValueError):
+        img[0, 0, 0] = 1
+
+
+def test_attach_by_name(frame_store):
+    frame_store.publish("arm", "session", "1000.jpg", make_image(7))
+    frame = frame_store.get("arm", "session", "1000.jpg")
+
+    assert np.array_equal(attach(frame), make_image(7))
+    assert frame_store.get("arm", "session", "1100.jpg") is None
+
+
+def test_attach_returns_arrays_unchanged():
+    img = make_image(3)
+
+    assert attach(img) is img
+
+
+def test_frame_is_deleted_after_last_reference(frame_store):
+    frame_store.publish("arm", "session", "1000.jpg", make_image(7))
+    frames = frame_store.acquire("arm", "session", ["1000.jpg", "1100.jpg"])
+    path = frames["1000.jpg"]
+
+    assert list(frames) == ["1000.jpg"]
+
+    # Session's reference
+    frame_store.release_session("arm", "session")
+    assert os.path.exists(path)
+
+    # Job's reference
+    frame_store.release("arm", "session", ["1000.jpg"])
+    assert not os.path.exists(path)
+    assert frame_store.get("arm", "session", "1000.jpg") is None
+
+
+def test_image_names_of_session(frame_store):
+    frame_store.publish("arm", "session_1", "1000.jpg", make_image(1))
+    frame_store.publish("arm", "session_1", "1100.jpg", make_image(2))
+    frame_store.publish("arm", "session_2", "1000.jpg", make_image(3))
+
+    assert sorted(frame_store.image_names("arm", "session_1")) == ["1000.jpg", "1100.jpg"]
+    assert frame_store.stats()["frames"] == 3
+
+
+def test_shutdown_removes_all_frames(frame_store):
+    frame_store.publish("arm", "session", "1000.jpg", make_image(1))
+    path = frame_store.get("arm", "session", "1000.jpg")
+    frame_store.shutdown()
+
+    assert not os.path.exists(path)
+    assert frame_store.stats() == {"frames": 0, "bytes": 0}
+
+
+def test_attach_from_other_process(frame_store):
+    frame_store.publish("arm", "session", "1000.jpg", make_image(5))
+    frame = frame_store.get("arm", "session", "1000.jpg")
+
+    with ProcessPoolExecutor(max_workers=1) as executor:
+        assert executor.submit(checksum, frame).result() == 5 * 20 * 30
+
+
+def test_republish_keeps_acquired_references(frame_store):
+    frame_store.publish("arm", "session", "1000.jpg", make_image(1))
+    path = frame_store.acquire("arm", "session", ["1000.jpg"])["1000.jpg"]
+    frame_store.publish("arm", "session", "1000.jpg", make_image(2))
+
+    # Releasing the session twice only drops its own reference, the job's reference keeps the frame
+    frame_store.release_session("arm", "session")
+    frame_store.release_session("arm", "session")
+    assert checksum(path) == 2 * 20 * 30
+
+    frame_store.release("arm", "session", ["1000.jpg"])
+    assert not os.path.exists(path)
+
+
+def test_idle_sessions_are_swept(frame_store):
+    frame_store.publish("arm", "session_1", "1000.jpg", make_image(1))
+    path = frame_store.get("arm", "session_1", "1000.jpg")
+
+    assert frame_store.sweep(max_idle=60) == []
+    assert frame_store.sweep(max_idle=0) == [("arm", "session_1")]
+    assert not os.path.exists(path)
+    assert frame_store.stats()["frames"] == 0
+
+
+def test_sessions_of_different_arms_are_separate(frame_store):
+    frame_store.publish("arm_1", "session", "1000.jpg", make_image(1))
+    frame_store.publish("arm_2", "session", "1000.jpg", make_image(2))
+
+    assert frame_store.get("arm_1", "session", "1000.jpg") != frame_store.get("arm_2", "session", "1000.jpg")
+
+    frame_store.release_session("arm_2", "session")
+    assert frame_store.image_names("arm_2", "session") == []
+    assert checksum(frame_store.get("arm_1", "session", "1000.jpg")) == 20 * 30
+
+
+def test_get_finds_frames_published_by_other_processes(frame_store, tmp_path):
+    other_store = FrameStore(base_img_path=tmp_path.as_posix())
+    try:
+        assert other_store.get("arm", "session", "1000.jpg") is None
+        frame_store.publish("arm", "session", "1000.jpg", make_image(4))
+
+        assert checksum(other_store.get("arm", "session", "1000.jpg")) == 4 * 20 * 30
+        assert other_store.stats()["frames"] == 0
+    finally:
+        other_store.shutdown()
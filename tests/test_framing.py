@@ -0,0 +1,68 @@
+import json
+import pytest
+import numpy as np
+
+from utils import framing
+
+
+headers = {"command": "recv_img_proc", "arm_id": "TEST_ARM", "session_id": "test_session", "image_name": "1500.jpg"}
+
+
+def test_roundtrip():
+    payload = bytes(range(256)) * 100
+    decoded_headers, decoded_payload = framing.decode(framing.encode(headers, payload))
+
+    assert decoded_headers == headers
+    assert isinstance(decoded_payload, memoryview)
+    assert decoded_payload == payload
+
+
+def test_payload_is_not_copied():
+    message = framing.encode(headers, b"\x01\x02\x03\x04")
+    _, payload = framing.decode(message)
+
+    assert payload.obj is message
+    assert np.frombuffer(payload, np.uint8).tolist() == [1, 2, 3, 4]
+
+
+def test_payload_containing_separator():
+    payload = b"\xff\xd8" + framing.LEGACY_SEPARATOR + b"\xff\xd9"
+
+    assert framing.decode(framing.encode(headers, payload))[1] == payload
+
+
+def test_legacy_framing():
+    payload = b"\xff\xd8image\xff\xd9"
+    decoded_headers, decoded_payload = framing.decode(json.dumps(headers).encode() + framing.LEGACY_SEPARATOR + payload)
+
+    assert decoded_headers == headers
+    assert decoded_payload == payload
+
+
+def test_legacy_framing_keeps_separator_in_payload():
+    payload = b"\xff\xd8" + framing.LEGACY_SEPARATOR + b"\xff\xd9"
+
+    assert framing.decode(json.dumps(headers).encode() + framing.LEGACY_SEPARATOR + payload)[1] == payload
+
+
+def test_legacy_separator_is_searched_in_prefix_only():
+    message = json.dumps(headers).encode() + b" " * 100 + framing.LEGACY_SEPARATOR + b"payload"
+
+    with pytest.raises(ValueError):
+        framing.decode(message, legacy_header_limit=50)
+
+
+def test_empty_payload():
+    assert framing.decode(framing.encode(headers, b""))[1] == b""
+
+
+@pytest.mark.parametrize("message", [
+    framing.MAGIC + b"\x01",
+    framing.PREFIX.pack(framing.MAGIC, framing.VERSION, 100) + b"{}",
+    framing.PREFIX.pack(framing.MAGIC, framing.VERSION + 1, 2) + b"{}",
+    framing.PREFIX.pack(framing.MAGIC, framing.VERSION, 3) + b"{x}",
+    b"no separator",
+])
+def test_invalid_messages(message):
+    with pytest.raises(ValueError):
+        framing.decode(message)
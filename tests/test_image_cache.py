@@ -0,0 +1,114 @@
+import pytest
+import numpy as np
+
+from utils.image_cache import ImageCache
+
+
+def make_image(value, side=10):
+    return np.full((side, side, 3), value, dtype=np.uint8)
+
+
+def test_hit_and_miss():
+    cache = ImageCache(max_bytes=10 ** 6)
+    cache.put("arm", "session", "1000.jpg", make_image(1))
+
+    assert cache.get("arm", "session", "1000.jpg")[0, 0, 0] == 1
+    assert cache.get("arm", "session", "1100.jpg") is None
+    assert cache.get("arm", "other_session", "1000.jpg") is None
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 2
+    assert stats["resident_bytes"] == 300
+    assert stats["images"] == 1
+
+
+def test_loader_is_called_once():
+    cache = ImageCache(max_bytes=10 ** 6)
+    calls = []
+
+    def loader():
+        calls.append(1)
+        return make_image(2)
+
+    first = cache.get("arm", "session", "1000.jpg", loader=loader)
+    second = cache.get("arm", "session", "1000.jpg", loader=loader)
+
+    assert first is second
+    assert len(calls) == 1
+
+
+def test_evicts_least_recently_used_by_bytes():
+    cache = ImageCache(max_bytes=700)
+    cache.put("arm", "session", "1000.jpg", make_image(1))
+    cache.put("arm", "session", "1100.jpg", make_image(2))
+    cache.get("arm", "session", "1000.jpg")
+    cache.put("arm", "session", "1200.jpg", make_image(3))
+
+    assert cache.get("arm", "session", "1100.jpg") is None
+    assert cache.get("arm", "session", "1000.jpg") is not None
+    assert cache.get("arm", "session", "1200.jpg") is not None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["resident_bytes"] == 600
+
+
+def test_images_larger_than_budget_are_not_stored():
+    cache = ImageCache(max_bytes=100)
+    img = cache.put("arm", "session", "1000.jpg", make_image(1))
+
+    assert img.shape == (10, 10, 3)
+    assert cache.stats()["images"] == 0
+
+
+def test_replacing_an_image_updates_resident_bytes():
+    cache = ImageCache(max_bytes=10 ** 6)
+    cache.put("arm", "session", "1000.jpg", make_image(1))
+    cache.put("arm", "session", "1000.jpg", make_image(2, side=20))
+
+    assert cache.get("arm", "session", "1000.jpg")[0, 0, 0] == 2
+    assert cache.stats()["resident_bytes"] == 1200
+
+
+def test_release_removes_only_the_session():
+    cache = ImageCache(max_bytes=10 ** 6)
+    cache.put("arm", "session_1", "1000.jpg", make_image(1))
+    cache.put("arm", "session_1", "1100.jpg", make_image(1))
+    cache.put("arm", "session_2", "1000.jpg", make_image(2))
+
+    cache.release("arm", "session_1")
+
+    assert cache.get("arm", "session_1", "1000.jpg") is None
+    assert cache.get("arm", "session_2", "1000.jpg") is not None
+    assert cache.stats()["resident_bytes"] == 300
+
+
+def test_cached_images_are_read_only():
+    cache = ImageCache(max_bytes=10 ** 6)
+    img = cache.put("arm", "session", "1000.jpg", make_image(1))
+
+    with pytest.raises(ValueError):
+        img[0, 0, 0] = 5
+
+
+def test_sessions_of_different_arms_are_separate():
+    cache = ImageCache(max_bytes=10 ** 6)
+    cache.put("arm_1", "session", "1000.jpg", make_image(1))
+    cache.put("arm_2", "session", "1000.jpg", make_image(2))
+
+    cache.release("arm_2", "session")
+
+    assert cache.get("arm_1", "session", "1000.jpg")[0, 0, 0] == 1
+    assert cache.get("arm_2", "session", "1000.jpg") is None
+
+
+def test_memory_mapped_images_are_stored_in_memory(tmp_path):
+    path = tmp_path.joinpath("frame.npy").as_posix()
+    np.save(path, make_image(3))
+    cache = ImageCache(max_bytes=10 ** 6)
+
+    img = cache.put("arm", "session", "1000.jpg", np.load(path, mmap_mode="r"))
+
+    assert not isinstance(img, np.memmap)
+    assert img[0, 0, 0] == 3
+    assert not img.flags.writeable
+    assert cache.stats()["resident_bytes"] == 300
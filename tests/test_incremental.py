@@ -0,0 +1,46 @@
+import cv2
+import numpy as np
+
+from stitcher.incremental import compose_panorama
+
+
+def make_session(tmp_path, n_images=3, width=400, step=250):
+    rng = np.random.default_rng(0)
+    scene = cv2.GaussianBlur(rng.integers(0, 255, (300, width + step * (n_images - 1), 3)).astype(np.uint8), (9, 9), 3)
+
+    tmp_path.joinpath("session", "original").mkdir(parents=True)
+    tmp_path.joinpath("session", "bboxes_original").mkdir(parents=True)
+
+    transforms = {}
+    for idx in range(n_images):
+        image_name = f"{1000 + idx * 100}.jpg"
+        cv2.imwrite(tmp_path.joinpath("session", "original", image_name).as_posix(), scene[:, idx * step:idx * step + width])
+        transforms[image_name] = np.array([[1, 0, idx * step], [0, 1, 0], [0, 0, 1]], dtype=np.float64)
+
+    return scene, transforms
+
+
+def test_compose_panorama(tmp_path):
+    scene, transforms = make_session(tmp_path)
+    images_with_objects = [{"image_name": image_name, "bboxes": np.empty((0, 4), dtype=np.int64)} for image_name in transforms]
+
+    result = compose_panorama(tmp_path.as_posix(), "session", "original", images_with_objects, transforms, jpeg_quality=100)
+
+    assert result["success"]
+    panorama = cv2.imread(result["stitched_path"])
+    assert panorama.shape == scene.shape
+    # Overlapping images show the same scene, so blending doesn't change it, apart from the edges of the images
+    assert np.abs(panorama[1:-1, 1:-1].astype(int) - scene[1:-1, 1:-1]).mean() < 3
+
+
+def test_compose_panorama_saves_images_with_bounding_boxes(tmp_path):
+    _, transforms = make_session(tmp_path)
+    images_with_objects = [{"image_name": image_name, "bboxes": np.array([[10, 10, 50, 50]])} for image_name in transforms]
+
+    compose_panorama(tmp_path.as_posix(), "session", "original", images_with_objects, transforms)
+
+    for image_name in transforms:
+        img = cv2.imread(tmp_path.joinpath("session", "bboxes_original", image_name).as_posix())
+        assert img is not None
+        # Bounding boxes are drawn in blue
+        assert img[10, 30, 0] > 200 and img[10, 30, 2] < 60
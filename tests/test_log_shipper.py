@@ -0,0 +1,111 @@
+import time
+import logging
+import threading
+from urllib.parse import parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from utils.log_shipper import LogShipper
+
+
+class ControlPanel(ThreadingHTTPServer):
+    def __init__(self, delay=0):
+        super().__init__(("127.0.0.1", 0), LogRequestHandler)
+        self.delay = delay
+        self.records = []
+        self.clients = set()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def host(self):
+        return f"127.0.0.1:{self.server_address[1]}"
+
+
+class LogRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+        time.sleep(self.server.delay)
+        self.server.records.append(parse_qs(body))
+        self.server.clients.add(self.client_address)
+
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def create_logger(shipper):
+    test_logger = logging.getLogger(f"test_log_shipper_{id(shipper)}")
+    test_logger.setLevel(logging.DEBUG)
+    test_logger.propagate = False
+    test_logger.addHandler(shipper)
+    return test_logger
+
+
+def test_records_are_sent_over_one_connection():
+    control_panel = ControlPanel()
+    shipper = LogShipper(control_panel.host)
+    test_logger = create_logger(shipper)
+
+    log_args = {"arm_id": "arm1", "bm_id": 2}
+    for idx in range(20):
+        test_logger.info(f"Image {idx} received.", log_args)
+    # Records are serialized when they are logged
+    log_args["bm_id"] = 3
+    shipper.close()
+    control_panel.shutdown()
+
+    assert len(control_panel.records) == 20
+    assert control_panel.records[0]["msg"] == ["Image 0 received."]
+    assert control_panel.records[0]["args"] == [str({"arm_id": "arm1", "bm_id": 2})]
+    assert len(control_panel.clients) == 1
+    assert shipper.stats()["sent"] == 20 and shipper.stats()["connections"] == 1
+
+
+def test_logging_does_not_wait_for_slow_control_panel():
+    control_panel = ControlPanel(delay=0.05)
+    shipper = LogShipper(control_panel.host, queue_size=10)
+    test_logger = create_logger(shipper)
+
+    start = time.monotonic()
+    for idx in range(100):
+        test_logger.info(f"Record {idx}")
+    duration = time.monotonic() - start
+
+    stats = shipper.stats()
+    assert duration < 0.05
+    assert stats["dropped"] > 0
+    assert stats["queued"] + stats["dropped"] == 100
+
+    shipper.backoff = 0
+    shipper.close()
+    control_panel.shutdown()
+
+
+def test_debug_records_are_sampled_under_pressure():
+    control_panel = ControlPanel(delay=0.02)
+    shipper = LogShipper(control_panel.host, queue_size=100, debug_sample_rate=0)
+    test_logger = create_logger(shipper)
+
+    for idx in range(60):
+        test_logger.info(f"Record {idx}")
+    for idx in range(10):
+        test_logger.debug(f"Debug record {idx}")
+
+    assert shipper.stats()["sampled_out"] == 10
+
+    shipper.close()
+    control_panel.shutdown()
+
+
+def test_unreachable_control_panel_is_counted():
+    shipper = LogShipper("127.0.0.1:9", timeout=0.5, backoff=0)
+    test_logger = create_logger(shipper)
+
+    test_logger.info("Record")
+    shipper.close()
+
+    assert shipper.stats()["failed"] == 1
@@ -0,0 +1,63 @@
+import urllib.request
+
+from utils.metrics import Metrics
+from utils.timing import Timings
+
+
+def parse(text):
+    samples = {}
+    for line in text.splitlines():
+        if line and not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+def test_counters():
+    metrics = Metrics()
+    metrics.inc("requests_total", "Number of requests.", command="recv_img_proc")
+    metrics.inc("requests_total", "Number of requests.", command="recv_img_proc")
+    metrics.inc("requests_total", "Number of requests.", command="get_commands_of_session")
+
+    text = metrics.render()
+    samples = parse(text)
+    assert "# TYPE sorterbot_requests_total counter" in text
+    assert samples['sorterbot_requests_total{command="recv_img_proc"}'] == 2
+    assert samples['sorterbot_requests_total{command="get_commands_of_session"}'] == 1
+    assert samples["sorterbot_process_resident_memory_bytes"] > 0
+
+
+def test_stage_histograms_are_cumulative():
+    timings = Timings(window=2)
+    for duration in (0.002, 0.02, 0.2, 20):
+        timings.record("detect", "arm1", "session1", duration)
+
+    metrics = Metrics()
+    metrics.add_timings(timings)
+    samples = parse(metrics.render())
+
+    assert samples['sorterbot_stage_duration_seconds_bucket{stage="detect",le="0.0025"}'] == 1
+    assert samples['sorterbot_stage_duration_seconds_bucket{stage="detect",le="0.25"}'] == 3
+    assert samples['sorterbot_stage_duration_seconds_bucket{stage="detect",le="+Inf"}'] == 4
+    assert samples['sorterbot_stage_duration_seconds_count{stage="detect"}'] == 4
+    assert abs(samples['sorterbot_stage_duration_seconds_sum{stage="detect"}'] - 20.222) < 1e-9
+
+
+def test_collectors_and_endpoint():
+    metrics = Metrics()
+    metrics.add_collector(lambda: [("executor_jobs", "gauge", "Number of jobs.", [({"executor": "dispatcher", "state": "queued"}, 3)])])
+
+    def failing_collector():
+        raise RuntimeError("Not loaded yet.")
+    metrics.add_collector(failing_collector)
+
+    port = metrics.serve(0, host="127.0.0.1")
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics") as response:
+            assert response.headers["Content-Type"].startswith("text/plain")
+            text = response.read().decode()
+    finally:
+        metrics.shutdown()
+
+    assert parse(text)['sorterbot_executor_jobs{executor="dispatcher",state="queued"}'] == 3
+    assert "# Collector failed" in text
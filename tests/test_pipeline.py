@@ -0,0 +1,138 @@
+import asyncio
+
+from utils.pipeline import Pipeline, queue_wait
+
+
+def run(coroutine):
+    return asyncio.get_event_loop().run_until_complete(coroutine)
+
+
+async def add_one(value):
+    await asyncio.sleep(0)
+    return value + 1
+
+
+async def double(value):
+    await asyncio.sleep(0)
+    return value * 2
+
+
+def test_items_pass_through_all_stages():
+    async def scenario():
+        results = {}
+
+        async def on_done(request_id, result):
+            results[request_id] = result
+
+        pipeline = Pipeline([("add", add_one, 1), ("double", double, 2)], on_done=on_done, queue_size=2)
+        for request_id in range(10):
+            await pipeline.submit(request_id, request_id)
+        await pipeline.join()
+        await pipeline.close()
+
+        return results
+
+    assert run(scenario()) == {request_id: (request_id + 1) * 2 for request_id in range(10)}
+
+
+def test_items_complete_out_of_order():
+    async def scenario():
+        completed = []
+
+        async def wait(value):
+            await asyncio.sleep(value)
+            return value
+
+        async def on_done(request_id, result):
+            completed.append(request_id)
+
+        pipeline = Pipeline([("wait", wait, 3)], on_done=on_done)
+        for request_id, delay in enumerate([0.05, 0.01, 0.03]):
+            await pipeline.submit(request_id, delay)
+        await pipeline.join()
+        await pipeline.close()
+
+        return completed
+
+    assert run(scenario()) == [1, 2, 0]
+
+
+def test_failed_items_are_completed_with_the_exception():
+    async def scenario():
+        results = {}
+
+        async def fail_on_odd(value):
+            if value % 2:
+                raise ValueError(value)
+            return value
+
+        async def on_done(request_id, result):
+            results[request_id] = result
+
+        pipeline = Pipeline([("check", fail_on_odd, 1), ("add", add_one, 1)], on_done=on_done)
+        for request_id in range(4):
+            await pipeline.submit(request_id, request_id)
+        await pipeline.join()
+        await pipeline.close()
+
+        return results
+
+    results = run(scenario())
+    assert results[0] == 1 and results[2] == 3
+    assert isinstance(results[1], ValueError) and isinstance(results[3], ValueError)
+
+
+def test_submit_waits_when_pipeline_is_full():
+    async def scenario():
+        release = asyncio.Event()
+
+        async def blocked(value):
+            await release.wait()
+            return value
+
+        async def on_done(request_id, result):
+            pass
+
+        pipeline = Pipeline([("blocked", blocked, 1)], on_done=on_done, queue_size=1)
+        # One item is being processed, one is queued
+        await pipeline.submit(0, 0)
+        await asyncio.sleep(0)
+        await pipeline.submit(1, 1)
+
+        third = asyncio.ensure_future(pipeline.submit(2, 2))
+        await asyncio.sleep(0.01)
+        was_blocked = not third.done()
+
+        release.set()
+        await third
+        await pipeline.join()
+        await pipeline.close()
+
+        return was_blocked
+
+    assert run(scenario())
+
+
+def test_stages_see_their_queue_wait():
+    async def scenario():
+        waits = {}
+
+        async def slow(value):
+            waits[value] = queue_wait.get()
+            await asyncio.sleep(0.02)
+            return value
+
+        async def on_done(request_id, result):
+            pass
+
+        pipeline = Pipeline([("slow", slow, 1)], on_done=on_done)
+        await pipeline.submit(0, 0)
+        await pipeline.submit(1, 1)
+        await pipeline.join()
+        await pipeline.close()
+
+        return waits
+
+    waits = run(scenario())
+    assert waits[0] < 0.01
+    assert waits[1] >= 0.015
@@ -2,6 +2,7 @@ import os
 import shutil
 import pytest
 import hashlib
+import numpy as np
 from pathlib import Path
 
 from mock_data import sample_preprocessor
@@ -34,6 +35,31 @@ class TestPreprocessor:
 
             assert checksums[i] == cropped_md5
 
+    def test_crop_to_batch(self):
+        images = [{"image_name": image_name, "objects": objects} for image_name, objects, _ in sample_preprocessor]
+        stats = {"mean": [0.485, 0.456, 0.406], "std": [0.229, 0.224, 0.225]}
+
+        keys, batch = self.preprocessor.crop_to_batch("test_arm", self.session_id, images, (224, 224), stats)
+
+        assert keys == [(int(Path(image["image_name"]).stem), obj["obj_id"]) for image in images for obj in image["objects"]]
+        assert batch.shape == (6, 3, 224, 224)
+        assert batch.dtype == np.float32
+
+    def test_fill_batch(self):
+        # BGR image with a different value in each channel
+        img = np.zeros((40, 60, 3), dtype=np.uint8)
+        img[:, :, 0], img[:, :, 1], img[:, :, 2] = 10, 20, 30
+        bboxes = [{"x1": 0, "y1": 0, "x2": 20, "y2": 10}, {"x1": 30, "y1": 5, "x2": 60, "y2": 40}]
+        batch = np.zeros((3, 3, 8, 8), dtype=np.float32)
+
+        crops = self.preprocessor.fill_batch(batch, 1, img, bboxes, {"mean": [0.5, 0.5, 0.5], "std": [0.25, 0.25, 0.25]})
+
+        assert [crop.shape for crop in crops] == [(10, 20, 3), (35, 30, 3)]
+        assert (batch[0] == 0).all()
+        # Crops are converted to RGB and normalized
+        for channel, value in enumerate((30, 20, 10)):
+            assert np.allclose(batch[1:, channel], (value / 255 - 0.5) / 0.25)
+
     @classmethod
     def teardown_class(cls):
         shutil.rmtree(cls.tmp_path)
@@ -0,0 +1,70 @@
+import pstats
+
+from utils.profiling import Profiler, profiled, parse_targets
+
+
+class Handlers:
+    def __init__(self, profiler):
+        self.profiler = profiler
+
+    @profiled
+    def process_image(self, arm_id, session_id, image_name):
+        return sum(range(1000))
+
+    @profiled
+    def vectorize_session_images(self, arm_constants, session_id):
+        return self.process_image(arm_constants["arm_id"], session_id, "1500.jpg")
+
+
+def test_parse_targets():
+    arms, sessions, everything = parse_targets("arm1, arm2/session1,")
+    assert arms == {"arm1"}
+    assert sessions == {("arm2", "session1")}
+    assert not everything
+
+    assert parse_targets("*")[2]
+    assert parse_targets(None) == (set(), set(), False)
+
+
+def test_disabled_profiler_writes_nothing(tmp_path):
+    handlers = Handlers(Profiler(tmp_path.as_posix()))
+
+    assert handlers.process_image("arm1", "session1", "1200.jpg") == sum(range(1000))
+    assert not tmp_path.joinpath("session1").exists()
+
+
+def test_profiles_are_written_for_enabled_session(tmp_path):
+    profiler = Profiler(tmp_path.as_posix(), sessions=[("arm1", "session1")])
+    handlers = Handlers(profiler)
+
+    handlers.process_image("arm1", "session1", "1200.jpg")
+    handlers.process_image("arm1", "session2", "1200.jpg")
+    handlers.process_image("arm2", "session1", "1200.jpg")
+
+    profiles_path = tmp_path.joinpath("session1", "profiles")
+    assert sorted(path.name for path in profiles_path.iterdir()) == ["process_image_1200.prof", "process_image_1200.txt"]
+    assert pstats.Stats(profiles_path.joinpath("process_image_1200.prof").as_posix()).total_calls > 0
+    assert not tmp_path.joinpath("session2").exists()
+
+
+def test_nested_handlers_are_included_in_outer_profile(tmp_path):
+    handlers = Handlers(Profiler(tmp_path.as_posix(), arms=["arm1"]))
+
+    handlers.vectorize_session_images({"arm_id": "arm1"}, "session1")
+
+    profiles_path = tmp_path.joinpath("session1", "profiles")
+    assert sorted(path.name for path in profiles_path.iterdir()) == ["vectorize_session_images.prof", "vectorize_session_images.txt"]
+    assert "process_image" in profiles_path.joinpath("vectorize_session_images.txt").read_text()
+
+
+def test_memory_profile_and_toggling(tmp_path):
+    profiler = Profiler(tmp_path.as_posix(), memory=True)
+    handlers = Handlers(profiler)
+
+    profiler.set_enabled(True, "arm1")
+    assert profiler.status() == {"arms": ["arm1"], "sessions": [], "everything": False}
+    handlers.process_image("arm1", "session1", "1200.jpg")
+    assert tmp_path.joinpath("session1", "profiles", "process_image_1200.memory.txt").read_text().startswith("Peak traced memory")
+
+    profiler.set_enabled(False)
+    assert not profiler.has_targets()
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from utils.stand_ins import MemoryPostgres, MemoryS3
+
+
+def result(image_name, obj_class, x1):
+    return {"image_name": image_name, "image_width": 1640, "image_height": 1232, "class": obj_class, "x1": x1, "y1": 10, "x2": x1 + 50, "y2": 60}
+
+
+def test_memory_postgres():
+    postgres = MemoryPostgres()
+
+    assert postgres.create_table("Arm1", "Session1")
+    assert not postgres.create_table("arm1", "session1")
+    assert postgres.is_known_table("ARM1", "session1")
+
+    ids = postgres.insert_results("arm1", "session1", [result("1100.jpg", 0, 100), result("1000.jpg", 1, 200)])
+    ids += postgres.insert_results("arm1", "session1", [result("1100.jpg", 1, 300)])
+    assert ids == [1, 2, 3]
+    assert postgres.insert_results("arm1", "session1", []) == []
+
+    session_objects = postgres.get_session_objects("arm1", "session1")
+    assert list(session_objects) == ["1000.jpg", "1100.jpg"]
+    assert session_objects["1100.jpg"].shape == (2, 8)
+    np.testing.assert_array_equal(session_objects["1000.jpg"], [[2, 1, 1640, 1232, 200, 10, 250, 60]])
+
+    assert postgres.get_unique_images("arm1", "session1") == ["1100.jpg", "1000.jpg"]
+    assert [obj["id"] for obj in postgres.get_objects_of_image("arm1", "session1", "1100.jpg")] == [1, 3]
+
+    with pytest.raises(Exception):
+        postgres.insert_results("arm1", "session2", [result("1000.jpg", 0, 100)])
+
+
+def test_memory_s3(tmp_path):
+    file_path = tmp_path.joinpath("after.jpg")
+    file_path.write_bytes(b"\xff\xd8" * 10)
+
+    s3 = MemoryS3()
+    s3.upload_file("sorterbot-loadtest", file_path.as_posix(), "arm1/session1/after_1000.jpg")
+
+    assert s3.uploads == {"sorterbot-loadtest/arm1/session1/after_1000.jpg": 20}
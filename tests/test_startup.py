@@ -0,0 +1,38 @@
+import logging
+import pytest
+
+from utils.startup import Startup
+
+
+def test_phases_are_timed():
+    startup = Startup(logging.getLogger("test_startup"))
+    with startup.phase("config"):
+        pass
+    with startup.phase("detectron"):
+        pass
+
+    status = startup.status()
+    assert status["status"] == "starting"
+    assert list(status["timings"]) == ["config", "detectron"]
+    assert status["total"] is None
+
+
+def test_ready():
+    startup = Startup(logging.getLogger("test_startup"))
+    startup.set_ready()
+
+    assert startup.status()["status"] == "ready"
+    assert startup.status()["total"] >= 0
+
+
+def test_failed_phase_is_not_recorded():
+    startup = Startup(logging.getLogger("test_startup"))
+    with pytest.raises(RuntimeError):
+        with startup.phase("postgres"):
+            raise RuntimeError("Connection refused")
+    startup.set_failed(RuntimeError("Connection refused"))
+
+    status = startup.status()
+    assert status["status"] == "failed"
+    assert "postgres" not in status["timings"]
+    assert "Connection refused" in status["error"]
@@ -0,0 +1,84 @@
+import json
+import time
+import pytest
+
+from utils.timing import Timings
+
+
+def test_spans_are_recorded_per_session():
+    timings = Timings()
+    with timings.span("decode", "arm1", "session1", "1200.jpg", queue_wait=0.5, payload_bytes=1024):
+        time.sleep(0.01)
+    with timings.span("detect", "arm1", "session1", "1200.jpg"):
+        pass
+    with timings.span("decode", "arm1", "session2", "1200.jpg"):
+        pass
+
+    timeline = timings.timeline("arm1", "session1")
+    assert [span["stage"] for span in timeline] == ["decode", "detect"]
+    assert timeline[0]["start"] == 0
+    assert timeline[0]["duration"] >= 0.01
+    assert timeline[0]["queue_wait"] == 0.5 and timeline[0]["payload_bytes"] == 1024
+    assert timeline[1]["start"] >= timeline[0]["duration"]
+
+    assert timings.timeline("arm1", "unknown") == []
+
+
+def test_failed_stage_is_recorded():
+    timings = Timings()
+    with pytest.raises(ValueError):
+        with timings.span("decode", "arm1", "session1"):
+            raise ValueError("Image could not be decoded.")
+
+    assert [span["stage"] for span in timings.timeline("arm1", "session1")] == ["decode"]
+
+
+def test_histograms_use_rolling_window():
+    timings = Timings(window=10)
+    for idx in range(20):
+        timings.record("detect", "arm1", "session1", duration=idx / 100)
+
+    summary = timings.summary()["detect"]
+    assert summary["count"] == 20
+    assert summary["max"] == pytest.approx(0.19)
+    assert summary["p50"] == pytest.approx(0.145)
+    assert sum(summary["buckets"].values()) == 10
+
+
+def test_spans_without_session_only_count_in_histograms():
+    timings = Timings()
+    timings.record("save", None, None, duration=0.1)
+
+    assert timings.summary()["save"]["count"] == 1
+    assert len(timings.sessions) == 0
+
+
+def test_oldest_sessions_are_dropped():
+    timings = Timings(max_sessions=2, max_spans=3)
+    for session_id in ("session1", "session2", "session3"):
+        for _ in range(5):
+            timings.record("detect", "arm1", session_id, duration=0.01)
+
+    assert timings.timeline("arm1", "session1") == []
+    assert len(timings.timeline("arm1", "session3")) == 3
+
+
+def test_chrome_trace_export(tmp_path):
+    timings = Timings()
+    timings.record("decode", "arm1", "session1", duration=0.002, image_name="1200.jpg", queue_wait=0.001)
+    timings.record("stitch", "arm1", "session1", duration=1.5)
+
+    path = tmp_path.joinpath("trace.json")
+    timings.export("arm1", "session1", path.as_posix())
+    with open(path) as trace_file:
+        events = json.load(trace_file)["traceEvents"]
+
+    spans = [event for event in events if event["ph"] == "X"]
+    # Spans are ordered by their start, the stitching started earlier
+    assert [event["name"] for event in spans] == ["stitch", "decode"]
+    assert spans[1]["dur"] == 2000
+    assert spans[1]["args"]["image_name"] == "1200.jpg"
+    assert any(event["ph"] == "M" and event["name"] == "thread_name" for event in events)
+
+    with pytest.raises(ValueError):
+        timings.export("arm1", "session1", path.as_posix(), trace_format="csv")
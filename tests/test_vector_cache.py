@@ -0,0 +1,28 @@
+import numpy as np
+
+from vectorizer.vector_cache import VectorCache
+
+
+def test_vectors_are_grouped_by_arm_and_session():
+    cache = VectorCache()
+    cache.add("arm_1", "session", "1000.jpg", [1, 2], [[0.1, 0.2], [0.3, 0.4]])
+    cache.add("arm_2", "session", "1000.jpg", [1], [[0.5, 0.6]])
+
+    np.testing.assert_allclose(cache.get("arm_1", "session", "1000.jpg", 2), [0.3, 0.4])
+    assert cache.get("arm_1", "session", "1100.jpg", 1) is None
+
+    cache.release("arm_1", "session")
+    assert cache.get("arm_1", "session", "1000.jpg", 1) is None
+    assert cache.get("arm_2", "session", "1000.jpg", 1) is not None
+
+
+def test_least_recently_used_sessions_are_evicted():
+    cache = VectorCache(max_sessions=2)
+    cache.add("arm", "session_1", "1000.jpg", [1], [[0.1]])
+    cache.add("arm", "session_2", "1000.jpg", [1], [[0.2]])
+    cache.add("arm", "session_1", "1100.jpg", [2], [[0.3]])
+    cache.add("arm", "session_3", "1000.jpg", [1], [[0.4]])
+
+    assert cache.get("arm", "session_2", "1000.jpg", 1) is None
+    assert cache.get("arm", "session_1", "1000.jpg", 1) is not None
+    assert list(cache.sessions) == [("arm", "session_1"), ("arm", "session_3")]
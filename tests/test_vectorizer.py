@@ -1,8 +1,15 @@
+import cv2
 import json
+import torch
+import shutil
+import pytest
 import numpy as np
 from pathlib import Path
 
+from mock_data import sample_preprocessor
 from vectorizer.vectorizer import Vectorizer
+from vectorizer.preprocessor import PreProcessor
+from vectorizer.feature_extractor import build_feature_extractor, cosine_similarities
 
 
 class TestVectorizer:
@@ -23,3 +30,76 @@ class TestVectorizer:
         abs_difference = np.absolute(np.array(vectors) - np.array(expected_vectors))
 
         assert (abs_difference < 0.0001).all()
+
+    @pytest.mark.parametrize("engine", ["sequential", "traced"])
+    def test_truncated_engines_match_eager(self, engine):
+        vectorizer = Vectorizer(
+            base_img_path=self.base_img_path, model_name="resnet18", input_dimensions=(224, 224), batch_size=512,
+            engine=engine, channels_last=True
+        )
+        assert vectorizer.engine == engine
+
+        inputs = torch.rand((4, 3, 224, 224))
+        similarities = cosine_similarities(self.vectorizer.vectorize_batch(inputs), vectorizer.vectorize_batch(inputs))
+
+        assert (similarities > 0.999).all()
+
+    def test_quantize_requires_linear_layer(self):
+        # ResNets are truncated at avgpool, which leaves no linear layer to quantize
+        with pytest.raises(ValueError):
+            build_feature_extractor(self.vectorizer.model, "avgpool", (224, 224), quantize=True)
+
+    def test_streaming_matches_disk_path(self, tmp_path):
+        session_id = "test_session_streaming"
+        shutil.copytree(Path(__file__).parent.joinpath("test_images", "test_preprocessor"), tmp_path.joinpath(session_id, "original"))
+        preprocessor = PreProcessor(base_img_path=tmp_path)
+        images = [{"image_name": image_name, "objects": objects} for image_name, objects, _ in sample_preprocessor]
+
+        # Crop into a batch in memory
+        keys, batch = preprocessor.crop_to_batch("test_arm", session_id, images, self.vectorizer.input_dimensions, self.vectorizer.stats)
+        streamed = dict(zip(keys, self.vectorizer.compute_vectors_of_batch(torch.from_numpy(batch))))
+
+        # Save crops to disk and load them back
+        preprocessor.run(session_id, images)
+        self.vectorizer.load_data(tmp_path.joinpath(session_id, "cropped"))
+        filenames, vectors = self.vectorizer.compute_vectors()
+        loaded = {(int(Path(filename).parent.name), int(Path(filename).stem.split("_")[1])): vector for filename, vector in zip(filenames, vectors)}
+
+        assert streamed.keys() == loaded.keys()
+        similarities = cosine_similarities(torch.tensor([streamed[key] for key in keys]), torch.tensor([loaded[key] for key in keys]))
+        # Crops on disk are JPEG compressed, otherwise the inputs of both paths are the same
+        assert (similarities > 0.98).all()
+
+    def test_run_uses_cached_vectors(self, monkeypatch):
+        arm_id, session_id = "test_arm", "test_session_cached"
+        images_path = Path(__file__).parent.joinpath("test_images", "test_preprocessor")
+
+        # Cache the vectors the way Main does when the results are persisted, with the ids returned by the database
+        for image_name, file_name, obj_ids in [("1000.jpg", "000000000139.jpg", [17, 18]), ("1100.jpg", "000000002153.jpg", [19, 20])]:
+            img = cv2.imread(images_path.joinpath(file_name).as_posix())
+            objects = [
+                {"id": obj_ids[0], "bbox_dims": {"x1": 0, "y1": 0, "x2": 320, "y2": 320}},
+                {"id": obj_ids[1], "bbox_dims": {"x1": 4, "y1": 4, "x2": 324, "y2": 324}}
+            ]
+            self.vectorizer.cache_object_vectors(arm_id, session_id, image_name, img, objects)
+
+        def extract(*args, **kwargs):
+            raise AssertionError("Cached vectors should not be computed again.")
+
+        monkeypatch.setattr(self.vectorizer, "compute_vectors_of_batch", extract)
+        monkeypatch.setattr(self.vectorizer, "compute_vectors", extract)
+        monkeypatch.setattr(self.vectorizer.preprocessor, "crop_to_batch", extract)
+        monkeypatch.setattr(self.vectorizer.preprocessor, "run", extract)
+
+        objects = [{"img_base_angle": img_base_angle, "obj_id": obj_id} for img_base_angle, obj_id in [(1000, 17), (1000, 18), (1100, 19), (1100, 20)]]
+        try:
+            pairings = self.vectorizer.run(arm_id, session_id, ["1000.jpg", "1100.jpg"], objects, n_containers=2)
+        finally:
+            self.vectorizer.vector_cache.release(arm_id, session_id)
+
+        clusters = {(pairing["image_id"], pairing["obj_id"]): pairing["cluster"] for pairing in pairings}
+        assert clusters.keys() == {(obj["img_base_angle"], obj["obj_id"]) for obj in objects}
+        # Almost the same crops of the same image end up in the same cluster
+        assert clusters[(1000, 17)] == clusters[(1000, 18)]
+        assert clusters[(1100, 19)] == clusters[(1100, 20)]
+        assert clusters[(1000, 17)] != clusters[(1100, 19)]